@@ -0,0 +1,397 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import lzma
+import os
+import stat
+import tarfile
+import threading
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from shutil import which
+from subprocess import Popen, PIPE, DEVNULL
+
+import config
+import file
+import generic
+
+NATIVE_EXTENSIONS = [".tar.gz", ".tar.xz", ".zip"]  # Archive types extracted without external programs
+STREAM_EXTENSIONS = [".tar.gz", ".tar.xz"]  # Archive types that can be extracted while they're downloaded
+CHUNK_SIZE = 1024 * 1024
+POOL_FILE_LIMIT = 8 * 1024 * 1024  # Files bigger than this are written by the decoding thread itself
+MAX_IN_FLIGHT = 64 * 1024 * 1024  # Most bytes of decoded files that can be waiting for a writer thread
+
+
+class _ProgressReader:
+    """Wraps a binary file, reporting how many bytes have been read from it and optionally hashing them."""
+
+    def __init__(self, f, on_read, hasher=None):
+        self._f = f
+        self._on_read = on_read
+        self._hasher = hasher
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.bytes_read += len(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+        self._on_read(self.bytes_read)
+        return data
+
+
+def _progress_reporter(total, start_percent, end_percent, show_progress):
+    """Get Progress Reporter.
+
+    Args:
+        total (int): Number of bytes that will be processed
+        start_percent (int): Where generic.progress() last was
+        end_percent (int): Where generic.progress() should end up
+        show_progress (bool): Whether to show progress
+
+    Returns:
+        function: Takes the number of bytes processed so far, and updates the progress bar whenever
+        that moves it by at least a percent.
+
+    """
+    last = [start_percent]
+
+    def report(done):
+        percent = start_percent + (end_percent - start_percent) * min(done / max(total, 1), 1)
+        if int(percent) > int(last[0]):
+            last[0] = percent
+            generic.progress(percent, show_progress)
+    return report
+
+
+def _safe_path(dest, name):
+    """Get Path Inside Destination.
+
+    Args:
+        dest (str): Directory being extracted to
+        name (str): Path of the archive member
+
+    Returns:
+        str/None: Full path to extract the member to, or None if it would end up outside of dest.
+
+    """
+    dest = os.path.realpath(dest)
+    path = os.path.realpath(os.path.join(dest, name.lstrip("/")))
+    if path != dest and not path.startswith(dest + os.sep):
+        return None
+    return path
+
+
+def extract_threads():
+    """Get Extraction Threads.
+
+    Returns:
+        int: The ExtractThreads option, or the number of CPUs if it's 0 (automatic) or invalid.
+
+    """
+    threads = config.read_config("ExtractThreads")
+    if not isinstance(threads, int) or isinstance(threads, bool) or threads <= 0:
+        return os.cpu_count() or 1
+    return threads
+
+
+def parallel_decompressor(file_extension, threads):
+    """Get Parallel Decompressor.
+
+    Args:
+        file_extension (str): Extension of the archive (including .)
+        threads (int): Number of threads to decompress with
+
+    Returns:
+        str[]/None: Command that decompresses stdin to stdout with multiple threads, or None if no
+        such program is installed (or only one thread should be used).
+
+    """
+    if threads <= 1:
+        return None
+    if file_extension == ".tar.gz" and which("pigz") is not None:
+        return ["pigz", "-d", "-c", "-p", str(threads)]
+    elif file_extension == ".tar.xz":
+        if which("pixz") is not None:
+            return ["pixz", "-d", "-p", str(threads)]
+        elif which("xz") is not None:
+            return ["xz", "-d", "-c", "-T", str(threads)]
+    return None
+
+
+def _member_path(dest, member):
+    """Get the path to extract a tar member to, or None if it should be skipped."""
+    path = _safe_path(dest, member.name)
+    if path is None or (member.islnk() and _safe_path(dest, member.linkname) is None):
+        config.vprint("Skipping {}, which would be extracted outside of the program!".format(member.name))
+        return None
+    return path
+
+
+def _extract_member(tar, member, dest):
+    if hasattr(tarfile, "tar_filter"):
+        tar.extract(member, dest, filter="tar")
+    else:
+        tar.extract(member, dest)
+
+
+def _write_member(path, data, mode, mtime):
+    """Write a regular file read from a tar archive, applying the same rules as the "tar" extraction filter."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.lexists(path):
+        os.remove(path)
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, mode & 0o777 & ~(stat.S_IWGRP | stat.S_IWOTH))
+    os.utime(path, (mtime, mtime))
+
+
+def _extract_members(tar, dest, threads):
+    """Extract Members.
+
+    Extracts every member of a streamed tar archive. With more than one thread, this thread only decodes
+    the archive while a pool of threads writes out the regular files it decodes.
+
+    Args:
+        tar (tarfile.TarFile): Archive opened in streaming mode
+        dest (str): Directory to extract into
+        threads (int): Number of threads to use
+
+    """
+    if threads <= 1:
+        for member in tar:  # Streamed, so each member is written as soon as it's decompressed
+            if _member_path(dest, member) is not None:
+                config.vprint(member.name)
+                _extract_member(tar, member, dest)
+        return
+    pending = deque()  # (future, size, path) of files waiting on a writer thread
+    pending_paths = set()
+    in_flight = 0
+
+    def wait_for(count):
+        nonlocal in_flight
+        for _ in range(count):
+            future, size, path = pending.popleft()
+            future.result()
+            in_flight -= size
+            pending_paths.discard(path)
+
+    with ThreadPoolExecutor(max_workers=max(threads - 1, 1)) as pool:
+        try:
+            for member in tar:
+                path = _member_path(dest, member)
+                if path is None:
+                    continue
+                config.vprint(member.name)
+                if member.islnk() or path in pending_paths:  # Depends on a file that might not be written yet
+                    wait_for(len(pending))
+                if member.isreg() and member.size <= POOL_FILE_LIMIT:
+                    data = tar.extractfile(member).read()
+                    while pending and in_flight + member.size > MAX_IN_FLIGHT:
+                        wait_for(1)
+                    pending.append((pool.submit(_write_member, path, data, member.mode, member.mtime), member.size, path))
+                    pending_paths.add(path)
+                    in_flight += member.size
+                else:
+                    _extract_member(tar, member, dest)
+            wait_for(len(pending))
+        finally:
+            for future, _, _ in pending:
+                future.cancel()
+
+
+def _feed(reader, pipe):
+    """Feed an archive to a decompressor's stdin."""
+    try:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            pipe.write(chunk)
+    except BrokenPipeError:
+        pass  # Decompressor exited early; its exit code reports why
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _extract_tar(reader, file_extension, dest, threads):
+    """Extract a compressed tar archive read from reader, which doesn't need to be seekable."""
+    command = parallel_decompressor(file_extension, threads)
+    if command is not None:
+        config.vprint("Decompressing with {} using {} threads".format(command[0], threads))
+        process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        feeder = threading.Thread(target=_feed, args=(reader, process.stdin))
+        feeder.start()
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+                _extract_members(tar, dest, threads)
+            # Read the padding after the end of the archive, or the decompressor fails writing it once stdout is closed
+            while process.stdout.read(CHUNK_SIZE):
+                pass
+        finally:
+            process.stdout.close()
+            feeder.join()
+            process.wait()
+        if process.returncode != 0:
+            raise OSError("{} exited with code {}".format(command[0], process.returncode))
+        return
+    mode = "r|gz" if file_extension == ".tar.gz" else "r|xz"
+    with tarfile.open(fileobj=reader, mode=mode) as tar:
+        _extract_members(tar, dest, threads)
+    while reader.read(CHUNK_SIZE):
+        pass  # Read anything after the end of the archive, so all of it is hashed
+
+
+def _extract_zip(archive_path, dest, start_percent, end_percent, show_progress):
+    with zipfile.ZipFile(archive_path) as zf:
+        infos = zf.infolist()
+        report = _progress_reporter(sum(i.file_size for i in infos), start_percent, end_percent, show_progress)
+        done = 0
+        for info in infos:
+            path = _safe_path(dest, info.filename)
+            if path is None:
+                config.vprint("Skipping {}, which would be extracted outside of the program!".format(info.filename))
+                continue
+            config.vprint(info.filename)
+            mode = info.external_attr >> 16  # zip doesn't store permissions itself, but Unix zips put them here
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if stat.S_ISLNK(mode):
+                os.symlink(zf.read(info).decode("utf-8"), path)
+                done += info.file_size
+                report(done)
+                continue
+            with zf.open(info) as src, open(path, "wb") as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    done += len(chunk)
+                    report(done)
+            if stat.S_IMODE(mode):
+                os.chmod(path, stat.S_IMODE(mode) & 0o777)
+
+
+def extract(archive_path, dest, start_percent=0, end_percent=100, show_progress=True, threads=None):
+    """Extract Archive.
+
+    Extracts a .tar.gz, .tar.xz, or .zip archive in-process, streaming it straight into dest.
+    Members that would end up outside of dest are skipped. Tar archives are decompressed by pigz,
+    pixz, or xz with multiple threads when those are installed, and files are written out by a
+    pool of threads.
+
+    Args:
+        archive_path (str): Path to the archive
+        dest (str): Directory to extract into. Must already exist.
+        start_percent (int): Where generic.progress() last was. Defaults to 0.
+        end_percent (int): Where generic.progress() should end up. Defaults to 100.
+        show_progress (bool): Whether to show progress. Defaults to True.
+        threads (int): Number of threads to use. Defaults to the ExtractThreads option.
+
+    Returns:
+        str: "Extracted", "Bad Filetype" if the archive type can't be extracted natively, or "Error".
+
+    """
+    archive_path = file.full(archive_path)
+    file_extension = file.extension(archive_path)
+    if threads is None:
+        threads = extract_threads()
+    try:
+        if file_extension in STREAM_EXTENSIONS:
+            report = _progress_reporter(os.path.getsize(archive_path), start_percent, end_percent, show_progress)
+            with open(archive_path, "rb") as raw:
+                _extract_tar(_ProgressReader(raw, report), file_extension, dest, threads)
+        elif file_extension == ".zip":
+            _extract_zip(archive_path, dest, start_percent, end_percent, show_progress)
+        else:
+            return "Bad Filetype"
+    except (tarfile.TarError, zipfile.BadZipFile, lzma.LZMAError, zlib.error, EOFError, OSError,
+            NotImplementedError, RuntimeError) as e:  # zipfile raises the last two for unsupported and encrypted zips
+        config.vprint("Failed to extract {}: {}".format(archive_path, e))
+        return "Error"
+    generic.progress(end_percent, show_progress)
+    return "Extracted"
+
+
+def extract_stream(stream, file_extension, dest, total=None, start_percent=0, end_percent=100, show_progress=True,
+                   threads=None, hasher=None):
+    """Extract Archive Stream.
+
+    Extracts a .tar.gz or .tar.xz archive as it's read from a stream, such as a download, so the archive
+    never has to be stored.
+
+    Args:
+        stream (file): Binary file-like object to read the archive from. Doesn't need to be seekable.
+        file_extension (str): Extension of the archive (including .)
+        dest (str): Directory to extract into. Must already exist.
+        total (int): Size of the archive in bytes, or None if it's unknown. Only used for progress.
+        start_percent (int): Where generic.progress() last was. Defaults to 0.
+        end_percent (int): Where generic.progress() should end up. Defaults to 100.
+        show_progress (bool): Whether to show progress. Defaults to True.
+        threads (int): Number of threads to use. Defaults to the ExtractThreads option.
+        hasher (hashlib hash): If supplied, updated with every byte of the archive. Defaults to None.
+
+    Returns:
+        str: "Extracted", "Bad Filetype" if the archive type can't be streamed, or "Error".
+
+    """
+    if file_extension not in STREAM_EXTENSIONS:
+        return "Bad Filetype"
+    if threads is None:
+        threads = extract_threads()
+    if total is None:
+        report = lambda done: None
+    else:
+        report = _progress_reporter(total, start_percent, end_percent, show_progress)
+    try:
+        _extract_tar(_ProgressReader(stream, report, hasher), file_extension, dest, threads)
+    except (tarfile.TarError, lzma.LZMAError, zlib.error, EOFError, OSError) as e:
+        config.vprint("Failed to extract stream: {}".format(e))
+        return "Error"
+    generic.progress(end_percent, show_progress)
+    return "Extracted"
+
+
+def program_root(extract_dir, program_internal_name):
+    """Find Program Root.
+
+    Works out which directory of an extracted archive holds the program, stripping a single
+    top-level folder (or one named after the program) that archives often wrap everything in.
+
+    Args:
+        extract_dir (str): Directory the archive was extracted into
+        program_internal_name (str): Name of the program being installed
+
+    Returns:
+        str: Path to the directory holding the program
+
+    """
+    contents = os.listdir(extract_dir)
+    if os.path.isdir(os.path.join(extract_dir, program_internal_name)):
+        config.vprint('Folder in folder detected! Using that directory instead...')
+        return os.path.join(extract_dir, program_internal_name)
+    elif len(contents) == 1 and os.path.isdir(os.path.join(extract_dir, contents[0])):
+        config.vprint("Single folder detected!")
+        return os.path.join(extract_dir, contents[0])
+    config.vprint('Folder in folder not detected!')
+    return extract_dir
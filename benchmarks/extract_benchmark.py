@@ -0,0 +1,95 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>.
+
+Extraction Benchmark
+
+Compares the wall time of extracting a generated archive with `tar xf` (how tarstall used to extract),
+tarstall's single-threaded extraction, and tarstall's multi-threaded extraction.
+
+Usage: python3 benchmarks/extract_benchmark.py [SIZE_MB] [THREADS]
+"""
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import time
+from shutil import rmtree
+from subprocess import call
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import archive
+
+
+def make_tree(root, size_mb):
+    """Make a tree of mostly-compressible files, like a typical toolchain, totalling size_mb."""
+    rng = random.Random(275)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(8)) for _ in range(512)]
+    written = 0
+    i = 0
+    while written < size_mb * 1024 * 1024:
+        directory = os.path.join(root, "program", "dir{}".format(i % 50))
+        os.makedirs(directory, exist_ok=True)
+        size = rng.choice([4, 16, 64, 256, 2048]) * 1024
+        data = b" ".join(rng.choice(words) for _ in range(size // 9))
+        with open(os.path.join(directory, "file{}".format(i)), "wb") as f:
+            f.write(data)
+        written += len(data)
+        i += 1
+    return i
+
+
+def time_run(label, dest, function):
+    rmtree(dest, ignore_errors=True)
+    os.mkdir(dest)
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print("{:<40}{:>8.2f}s".format(label, elapsed))
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    work = tempfile.mkdtemp(prefix="tarstall-benchmark-")
+    try:
+        files = make_tree(os.path.join(work, "tree"), size_mb)
+        print("Generated {} files ({} MB), using {} threads\n".format(files, size_mb, threads))
+        dest = os.path.join(work, "out")
+        for ext, mode in [(".tar.gz", "w:gz"), (".tar.xz", "w:xz")]:
+            path = os.path.join(work, "program" + ext)
+            with tarfile.open(path, mode) as tar:
+                tar.add(os.path.join(work, "tree", "program"), "program")
+            print("{} ({:.1f} MB compressed)".format(ext, os.path.getsize(path) / 1024 / 1024))
+            time_run("  tar xf (old)", dest, lambda: call(["tar", "xf", path, "-C", dest]))
+            time_run("  tarstall, 1 thread", dest, lambda: archive.extract(path, dest, show_progress=False, threads=1))
+            command = archive.parallel_decompressor(ext, threads)
+            if command is not None:
+                time_run("  tarstall, {} threads + {}".format(threads, command[0]), dest,
+                         lambda: archive.extract(path, dest, show_progress=False, threads=threads))
+            decompressor = archive.parallel_decompressor
+            archive.parallel_decompressor = lambda file_extension, threads: None
+            time_run("  tarstall, {} threads (Python only)".format(threads), dest,
+                     lambda: archive.extract(path, dest, show_progress=False, threads=threads))
+            archive.parallel_decompressor = decompressor
+            print()
+    finally:
+        rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
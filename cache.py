@@ -0,0 +1,286 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import json
+import os
+import time
+
+import config
+import file
+
+CACHE_PATH = "~/.tarstall/cache"
+STALE_TEMP_AGE = 60 * 60  # Seconds before prune() treats a leftover temporary file as abandoned
+
+"""
+Cache structure
+
+Downloaded archives are kept in ~/.tarstall/cache/objects, named after the sha256 of their contents
+followed by their extension, so an archive served from several URLs is only stored once.
+~/.tarstall/cache/index.json tracks them:
+
+{
+    "objects": {
+        "<sha256>.tar.gz": {"size": 1234, "used": 1660000000.0}
+    },
+    "urls": {
+        "https://example.com/program.tar.gz": {"object": "<sha256>.tar.gz", "validators": {...}}
+    }
+}
+
+validators are the ETag, Last-Modified, and size the server sent with the archive, so a conditional
+request can tell whether the cached archive is still what the URL serves. Once the archives add up
+to more than the CacheSize option, the ones used longest ago are removed first. CacheSize is 0 by default,
+which disables the cache.
+"""
+
+
+class Recorder:
+    """Wraps a binary stream, such as a download, writing everything read from it to a file."""
+
+    def __init__(self, stream, path):
+        self._stream = stream
+        self._f = open(path, "wb")
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._f.write(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+
+def max_size():
+    """Get Cache Size.
+
+    Returns:
+        int: Most bytes of archives to keep cached (the CacheSize option). 0 if the cache is disabled.
+
+    """
+    return config.read_config("CacheSize")
+
+
+def enabled():
+    """Check if the Cache is in Use.
+
+    Returns:
+        bool: Whether downloaded archives are cached
+
+    """
+    return max_size() > 0
+
+
+def object_path(name):
+    """Get Object Path.
+
+    Args:
+        name (str): Name of the cached archive
+
+    Returns:
+        str: Full path to the cached archive
+
+    """
+    return os.path.join(file.full(CACHE_PATH), "objects", name)
+
+
+def _read_index():
+    try:
+        with open(os.path.join(file.full(CACHE_PATH), "index.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {"objects": {}, "urls": {}}
+
+
+def _write_index(index):
+    os.makedirs(file.full(CACHE_PATH), exist_ok=True)
+    file.atomic_write(json.dumps(index), os.path.join(file.full(CACHE_PATH), "index.json"))
+
+
+def _remove_object(index, name):
+    """Remove an archive from the cache and index, returning its size."""
+    size = index["objects"].pop(name)["size"]
+    for url in [u for u, entry in index["urls"].items() if entry["object"] == name]:
+        del index["urls"][url]
+    try:
+        os.remove(object_path(name))
+    except FileNotFoundError:
+        pass
+    config.vprint("Removed {} from the download cache".format(name))
+    return size
+
+
+def _evict(index, limit):
+    """Remove the archives used longest ago until the cache holds at most limit bytes.
+
+    Returns:
+        (int, int): Number of archives removed and the number of bytes freed
+
+    """
+    total = sum(obj["size"] for obj in index["objects"].values())
+    removed = 0
+    freed = 0
+    for name in sorted(index["objects"], key=lambda n: index["objects"][n]["used"]):
+        if total - freed <= limit:
+            break
+        freed += _remove_object(index, name)
+        removed += 1
+    return removed, freed
+
+
+def _link(index, name, dest):
+    """Link (or copy) a cached archive to dest and mark it as used, returning whether it was cached."""
+    if name not in index["objects"]:
+        return False
+    try:
+        os.link(object_path(name), dest)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        file.copy_file(object_path(name), dest)
+    index["objects"][name]["used"] = time.time()
+    _write_index(index)
+    return True
+
+
+def lookup(url):
+    """Look Up Cached Archive.
+
+    Only reads the index, so nothing is linked and the archive doesn't count as used. Once the server says
+    the archive is still what url serves, fetch_hash() gets it.
+
+    Args:
+        url (str): URL the archive was downloaded from
+
+    Returns:
+        dict/None: "sha256" and "validators" of the cached archive, or None if url has no archive cached
+
+    """
+    entry = _read_index()["urls"].get(url)
+    if entry is None:
+        return None
+    return {"sha256": entry["object"].partition(".")[0], "validators": entry["validators"]}
+
+
+def fetch_hash(sha256, extension, dest):
+    """Fetch Cached Archive by Hash.
+
+    Hardlinks (or copies, if the cache is on another filesystem) the archive with the given sha256 to dest,
+    so it stays usable even if the cache is pruned meanwhile. The archive counts as used. Since archives
+    are found by their contents, one with a known sha256 never has to be downloaded again, whichever URL it came from.
+
+    Args:
+        sha256 (str): sha256 of the archive
+        extension (str): Extension of the archive (including .)
+        dest (str): Path to put the archive at. Must not exist.
+
+    Returns:
+        bool: Whether the archive was cached
+
+    """
+    try:
+        with file.cache_lock():
+            return _link(_read_index(), sha256 + extension, dest)
+    except (OSError, TimeoutError) as e:
+        config.vprint("Couldn't read the download cache: {}".format(e))
+        return False
+
+
+def add(path, url, sha256, extension, validators):
+    """Add Archive to Cache.
+
+    Moves a downloaded archive into the cache, then removes the archives used longest ago if the cache
+    grew past CacheSize. Failing to cache an archive is never an error; it's just downloaded again next time.
+
+    Args:
+        path (str): Path to the archive, which is moved into the cache
+        url (str): URL the archive was downloaded from
+        sha256 (str): sha256 of the archive
+        extension (str): Extension of the archive (including .)
+        validators (dict): Download.validators from downloading the archive
+
+    Returns:
+        bool: Whether the archive was cached
+
+    """
+    if not enabled():
+        return False
+    name = sha256 + extension
+    size = os.path.getsize(path)
+    if size > max_size():
+        config.vprint("{} is bigger than the download cache, so not caching it".format(url))
+        return False
+    try:
+        os.makedirs(os.path.dirname(object_path(name)), exist_ok=True)
+        temp_path = object_path(".{}.{}".format(name, os.getpid()))
+        file.move_tree(path, temp_path)  # Outside the lock, since this is a copy if the cache is on another filesystem
+        with file.cache_lock():
+            os.replace(temp_path, object_path(name))
+            index = _read_index()
+            index["objects"][name] = {"size": size, "used": time.time()}
+            index["urls"][url] = {"object": name, "validators": validators}
+            _evict(index, max_size())
+            _write_index(index)
+    except (OSError, TimeoutError) as e:
+        config.vprint("Couldn't add {} to the download cache: {}".format(url, e))
+        return False
+    config.vprint("Cached {} as {}".format(url, name))
+    return True
+
+
+def entries():
+    """List Cached Archives.
+
+    Returns:
+        dict[]: "name", "size", "used" (time it was last used), and "urls" of each cached archive,
+        most recently used first
+
+    """
+    index = _read_index()
+    listing = []
+    for name, obj in index["objects"].items():
+        urls = sorted(url for url, entry in index["urls"].items() if entry["object"] == name)
+        listing.append({"name": name, "size": obj["size"], "used": obj["used"], "urls": urls})
+    return sorted(listing, key=lambda entry: entry["used"], reverse=True)
+
+
+def prune():
+    """Prune Cache.
+
+    Removes the archives used longest ago until the cache fits in CacheSize (so everything, if the cache
+    is disabled), along with files the index doesn't know about, such as from a crash while adding one.
+
+    Returns:
+        (int, int): Number of archives removed and the number of bytes freed
+
+    """
+    objects_dir = os.path.join(file.full(CACHE_PATH), "objects")
+    with file.cache_lock():
+        index = _read_index()
+        for name in [n for n in index["objects"] if not os.path.isfile(object_path(n))]:
+            _remove_object(index, name)
+        removed, freed = _evict(index, max_size())
+        if os.path.isdir(objects_dir):
+            for name in os.listdir(objects_dir):
+                if name in index["objects"]:
+                    continue
+                st = os.lstat(object_path(name))
+                if name.startswith(".") and time.time() - st.st_mtime < STALE_TEMP_AGE:
+                    continue  # Probably still being added by another tarstall
+                config.vprint("Removing unknown file {} from the download cache".format(name))
+                os.remove(object_path(name))
+                removed += 1
+                freed += st.st_size
+        _write_index(index)
+    return removed, freed
@@ -14,15 +14,22 @@
     You should have received a copy of the GNU General Public License
     along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
 
+import os
 import sys
 import json
+import tempfile
+from contextlib import contextmanager
+from shutil import rmtree
 
 ###VERSIONS###
-from file import get_shell_file, unlock, full, get_db
+from file import get_shell_file, unlock, full, get_db, atomic_write, db_lock
+import journal
+import shell
+import sqlite_db
 
 version = "1.7.0"
 prog_internal_version = 129
-file_version = 20
+file_version = 23
 
 #############
 
@@ -37,9 +44,10 @@ def read_config(key):
 
 """
     try:
-        return db["options"][key]
+        return _get_section("options")[key]
     except KeyError:
-        if key in ["Verbose", "AutoInstall", "SkipQuestions", "UpdateURLPrograms"]:
+        if key in ["Verbose", "AutoInstall", "SkipQuestions", "UpdateURLPrograms", "UseShims",
+                   "FishAutoload", "UseStore", "VersionedInstalls"]:
             return False
         elif key in ["PressEnterKey", "WarnMissingDeps"]:
             return True
@@ -47,10 +55,54 @@ def read_config(key):
             return get_shell_file()
         elif key == "Mode":
             return "cli"
+        elif key == "ExtractThreads":
+            return 0
+        elif key == "DownloadSegments":
+            return 4
+        elif key == "WorkDir":
+            return "~/.tarstall/.work"
+        elif key == "CacheSize":
+            return 0  # Off unless asked for, since a cached archive is a second copy of every program downloaded
         else:
             return "Bad Value"
 
 
+def work_dir():
+    """Get Work Directory.
+
+    Installs and updates build everything in the work directory (the WorkDir option) before moving it
+    into place. By default, it's in ~/.tarstall, so that move is just a rename.
+
+    Returns:
+        str: Full path to the work directory, which is created if it doesn't exist
+
+    """
+    path = full(read_config("WorkDir"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def workspace(purpose):
+    """Operation Workspace.
+
+    Creates a directory in the work directory that only this operation uses, so operations never
+    clean up each other's files. It's removed when the with block ends, even if the block raises.
+
+    Args:
+        purpose (str): What the workspace is for, used in its name
+
+    Yields:
+        str: Full path to the workspace
+
+    """
+    path = tempfile.mkdtemp(prefix="tarstall-{}-".format(purpose), dir=work_dir())
+    try:
+        yield path
+    finally:
+        rmtree(path, ignore_errors=True)
+
+
 def change_config(key, mode, value=None):
     """Change Config Value.
 
@@ -65,20 +117,16 @@ def change_config(key, mode, value=None):
         Any type: Value the key was changed to
 
     """
+    db = _lazy("db")
     if mode == 'flip':
         try:
-            db["options"][key] = not db["options"][key]
-            r = db["options"][key]
+            r = not db["options"][key]
         except KeyError:  # All config values are False by default, so this should make them True.
-            db["options"][key] = True
             r = True
     elif mode == 'change':
-        try:
-            db["options"][key] = value
-            r = value
-        except KeyError:
-            db["options"][key] = value
-            r = value
+        r = value
+    journal.record("config", key=key, value=r)
+    db["options"][key] = r
     write_db()
     return r
 
@@ -95,10 +143,10 @@ def vcheck():
 
 def vprint(to_print, end=None):
     """Print a message only if we're verbose"""
-    if verbose:
-        if mode == "cli":
+    if _lazy("verbose"):
+        if _lazy("mode") == "cli":
             print(to_print, end=end)
-        elif mode == "gui":
+        elif _lazy("mode") == "gui":
             try:
                 if end is not None:
                     output_area.Update(to_print)
@@ -129,22 +177,107 @@ def get_version(version_type):
 def write_db():
     """Write Database.
 
-    Writes the database to file
+    Writes the database to file. If called inside of a transaction(), the write is
+    deferred until the outermost transaction finishes.
+
+    """
+    global _pending_write
+    if _transaction_depth > 0:
+        _pending_write = True
+        return
+    _flush_db()
+
+
+def _flush_db():
+    """Flush Database.
+
+    Atomically writes the database to file. If another tarstall wrote to the database since this one
+    read it, its changes are kept by re-reading the database and replaying this tarstall's changes on top.
 
     """
+    global _db_read_stamp
+    with db_lock():
+        refresh_db()
+        db = _lazy("db")
+        try:
+            if sqlite_db.enabled():
+                sqlite_db.save(db)
+            else:
+                atomic_write(json.dumps(db, indent=4), "~/.tarstall/database")
+            _db_read_stamp = _db_stamp()
+            vprint("Database written!")
+            if "programs" in db and shell.needs_rewrite(journal.pending(), db):
+                shell.write_shell_files(db)
+            journal.commit(db)
+            _write_section_cache(db)
+        except FileNotFoundError:
+            print(json.dumps(db, default=dict))
+            print("The tarstall database could not be written to! Something is very wrong...")
+            print("The database has been dumped to the screen; you should keep a copy of it.")
+            print("You may be able to restore tarstall to working order by placing the above" +
+                  " database dump into a file called \"database\" in ~/.tarstall")
+            print("Rest in peace if you're not in a CLI app right now...")
+            unlock()
+            sys.exit(3)
+
+
+def refresh_db():
+    """Refresh Database.
+
+    Re-reads the database if another tarstall has written to it since this one read it, then replays
+    the changes this tarstall hasn't written yet on top of it. Should be called after taking a program's
+    lock, so the program's information is current.
+
+    Returns:
+        bool: Whether the database was re-read
+
+    """
+    global db
+    if "db" not in globals() or _db_read_stamp is None or _db_stamp() == _db_read_stamp:
+        return False
+    new_db = _load_db()
+    if new_db == {}:
+        return False  # Keep what we have rather than replacing it with a broken database
+    vprint("Database was changed by another tarstall, merging changes")
+    journal.replay_pending(new_db)
+    db = new_db
+    return True
+
+
+def _load_db():
+    """Read the database, remembering the stamp of what was read for refresh_db()."""
+    global _db_read_stamp
+    _db_read_stamp = _db_stamp()
+    return get_db()
+
+
+@contextmanager
+def transaction():
+    """Database Transaction.
+
+    Collects every write_db() call made inside of the with block and writes the database once
+    when the outermost transaction ends. Transactions can be nested. If the block raises, or the
+    database can't be written (such as file.db_lock() timing out), nothing is written, the database
+    is reloaded from disk, and the exception is raised.
+
+    """
+    global _transaction_depth, _pending_write, db
+    _transaction_depth += 1
     try:
-        with open(full("~/.tarstall/database"), "w") as dbf:
-            json.dump(db, dbf, indent=4)
-        vprint("Database written!")
-    except FileNotFoundError:
-        print(json.dumps(db))
-        print("The tarstall database could not be written to! Something is very wrong...")
-        print("The database has been dumped to the screen; you should keep a copy of it.")
-        print("You may be able to restore tarstall to working order by placing the above" +
-              " database dump into a file called \"database\" in ~/.tarstall")
-        print("Rest in peace if you're not in a CLI app right now...")
-        unlock()
-        sys.exit(3)
+        yield
+        if _transaction_depth == 1 and _pending_write:
+            _flush_db()
+            _pending_write = False
+    except BaseException:
+        _transaction_depth -= 1
+        if _transaction_depth == 0:
+            journal.abort()
+            if _pending_write:
+                _pending_write = False
+                vprint("Transaction failed, discarding database changes!")
+                db = _load_db()
+        raise
+    _transaction_depth -= 1
 
 
 """
@@ -174,23 +307,111 @@ Database structure
             "update_url": None,
             "has_path": False,
             "binlinks": [],
-            "update_archive_type": None
+            "binlink_files": {},
+            "update_archive_type": None,
+            "update_validators": {
+                "etag": None,
+                "last_modified": None,
+                "length": None
+            },
+            "sha256": None,
+            "sha256_url": None
         }
     }
 }
 """
 
-db = get_db()
-verbose = vcheck()
-mode = read_config("Mode")
+OPTIONS_CACHE = "~/.tarstall/options_cache"  # Copy of the options and version sections, for reading them quickly
+
+_transaction_depth = 0  # How many transaction()s we're currently inside of
+_pending_write = False  # Whether write_db() was called during the current transaction
+_section_cache = {}  # Sections read from OPTIONS_CACHE, used until the database itself is loaded
+_db_read_stamp = None  # _db_stamp() of the database when this tarstall last read or wrote it
 
 install_bar = None  # Holds a progress bar if we're in a GUI
 output_area = None  # Holds a text area if we're in a GUI (for displaying status messages)
 
-if db != {}:
-    vprint("Database loaded successfully!")
 
-try:
-    branch = db["version"]["branch"]
-except KeyError:
-    branch = "master"
+def __getattr__(name):
+    """Lazily Load Module Attributes.
+
+    db, verbose, mode, and branch are loaded the first time they're accessed, so importing config
+    doesn't read the database.
+
+    """
+    if name == "db":
+        globals()["db"] = _load_db()
+        if globals()["db"] != {}:
+            vprint("Database loaded successfully!")
+    elif name == "verbose":
+        globals()["verbose"] = vcheck()
+    elif name == "mode":
+        globals()["mode"] = read_config("Mode")
+    elif name == "branch":
+        globals()["branch"] = _get_section("version").get("branch", "master")
+    else:
+        raise AttributeError("module 'config' has no attribute '{}'".format(name))
+    return globals()[name]
+
+
+def _lazy(name):
+    """Get a lazily loaded attribute from inside this module, where __getattr__ isn't used."""
+    try:
+        return globals()[name]
+    except KeyError:
+        return __getattr__(name)
+
+
+def _db_stamp():
+    """Get Database Stamp.
+
+    Returns:
+        list/None: Modification time and size of the database file, or None if it doesn't exist.
+
+    """
+    if sqlite_db.enabled():
+        path = full(sqlite_db.DB_PATH)
+    else:
+        path = full("~/.tarstall/database")
+    try:
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+    except FileNotFoundError:
+        return None
+
+
+def _get_section(section):
+    """Get Database Section.
+
+    Gets the options or version section of the database. If the database hasn't been loaded,
+    this is read from OPTIONS_CACHE instead, as long as the cache is up to date with the database.
+
+    Args:
+        section (str): "options" or "version"
+
+    Returns:
+        dict: The section, or {} if it doesn't exist.
+
+    """
+    if "db" in globals():
+        return db.get(section, {})
+    if section not in _section_cache:
+        try:
+            with open(full(OPTIONS_CACHE)) as f:
+                cache = json.load(f)
+            if cache["stamp"] != _db_stamp():
+                raise ValueError("Options cache is out of date")
+            _section_cache.update(cache)
+        except (FileNotFoundError, KeyError, ValueError):
+            _write_section_cache(_lazy("db"))
+            return _lazy("db").get(section, {})
+    return _section_cache.get(section, {})
+
+
+def _write_section_cache(db):
+    """Write the options and version sections of db to OPTIONS_CACHE, if tarstall is installed."""
+    try:
+        atomic_write(json.dumps({"stamp": _db_stamp(), "options": db.get("options", {}),
+                                 "version": db.get("version", {})}), OPTIONS_CACHE)
+    except OSError:
+        pass
@@ -13,10 +13,28 @@
 
     You should have received a copy of the GNU General Public License
     along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import ctypes
+import errno
+import fcntl
+import hashlib
 import json
 import os
 import re
 import shutil
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+LOCKS_PATH = "/tmp/tarstall-locks-{}".format(os.getuid())
+LOCK_TIMEOUT = 60  # Seconds to wait for a lock held by another tarstall before giving up
+FICLONE = 0x40049409  # ioctl to reflink a whole file, from linux/fs.h
+COPY_CHUNK = 8 * 1024 * 1024  # Bytes to copy per system call
+
+_locks = {}  # Lock name -> {"file", "mode" (fcntl.LOCK_SH/LOCK_EX), "owners" ({thread ID: times acquired}), "busy"}
+_locks_changed = threading.Condition()  # Guards _locks, and is notified whenever a lock is released or changes
 
 
 def file_vprint(to_print, end=None):
@@ -91,23 +109,234 @@ def get_shell_path():
         return None
 
 
-def lock():
+def _acquire(lock_name, mode, timeout):
+    """Acquire Lock.
+
+    Locks are counted per thread: acquiring a lock this thread already holds just counts another
+    holder, and each acquire needs a matching _release(). Other threads of this tarstall are kept
+    out of an exclusive lock just like other tarstalls are.
+
+    Args:
+        lock_name (str): Name of the lock file in LOCKS_PATH
+        mode (int): fcntl.LOCK_SH or fcntl.LOCK_EX
+        timeout (float/None): Seconds to wait for other tarstalls to release the lock, or None for LOCK_TIMEOUT
+
+    Returns:
+        bool: Whether the lock was acquired
+
+    """
+    if timeout is None:
+        timeout = LOCK_TIMEOUT
+    me = threading.get_ident()
+    deadline = time.monotonic() + timeout
+    with _locks_changed:
+        while True:
+            held = _locks.get(lock_name)
+            if held is None:
+                os.makedirs(LOCKS_PATH, mode=0o700, exist_ok=True)
+                held = {"file": open(os.path.join(LOCKS_PATH, lock_name + ".lock"), "a"), "mode": None, "owners": {},
+                        "busy": None}
+                _locks[lock_name] = held
+            others = [thread for thread in held["owners"] if thread != me]
+            if held["busy"] is None:
+                if (held["mode"] == fcntl.LOCK_EX and not others) or (held["mode"] == fcntl.LOCK_SH and mode == fcntl.LOCK_SH):
+                    held["owners"][me] = held["owners"].get(me, 0) + 1
+                    return True
+                if not others:
+                    held["busy"] = me  # Other threads wait while the lock file is locked or converted
+                    break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _locks_changed.wait(remaining)
+    acquired = _flock(held, lock_name, mode, deadline)
+    with _locks_changed:
+        held["busy"] = None
+        if acquired:
+            held["mode"] = mode
+            held["owners"][me] = held["owners"].get(me, 0) + 1
+        elif not held["owners"]:
+            held["file"].close()
+            del _locks[lock_name]
+        _locks_changed.notify_all()
+    return acquired
+
+
+def _flock(held, lock_name, mode, deadline):
+    """Lock a lock file against other tarstalls, waiting until deadline. Returns whether it was locked."""
+    waited = False
+    while True:
+        try:
+            fcntl.flock(held["file"], mode | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                if held["mode"] is not None:
+                    fcntl.flock(held["file"], held["mode"])  # Converting a lock drops it first, so take back the one we had
+                return False
+            if not waited:
+                file_vprint("Waiting for another tarstall to release the {} lock...".format(lock_name))
+                waited = True
+            time.sleep(0.05)
+
+
+def _release(lock_name, release_all=False):
+    """Release Lock.
+
+    Args:
+        lock_name (str): Name of the lock
+        release_all (bool): Whether to release the lock no matter how many times this thread acquired it.
+        Defaults to False.
+
+    """
+    me = threading.get_ident()
+    with _locks_changed:
+        held = _locks.get(lock_name)
+        if held is None or me not in held["owners"]:
+            return
+        held["owners"][me] -= 1
+        if held["owners"][me] <= 0 or release_all:
+            del held["owners"][me]
+        if not held["owners"]:
+            fcntl.flock(held["file"], fcntl.LOCK_UN)
+            held["file"].close()
+            del _locks[lock_name]
+        _locks_changed.notify_all()
+
+
+def lock(shared=False, timeout=None):
     """Lock tarstall.
 
-    Lock tarstall to prevent multiple instances of tarstall being used alongside each other
+    Every running tarstall holds a shared lock, so any number of them can run alongside each other.
+    Operations that change tarstall itself (first time setup, updating, erasing, repairing the database,
+    and migrations) take an exclusive lock instead, which waits for every other tarstall to finish.
+    Calling this again while holding the lock switches it between shared and exclusive.
+
+    Args:
+        shared (bool): Whether to take a shared lock instead of an exclusive one. Defaults to False.
+        timeout (float): Seconds to wait for other tarstalls. Defaults to None, which waits for LOCK_TIMEOUT seconds.
+
+    Returns:
+        bool: Whether tarstall was locked. False if other tarstalls held the lock for the whole timeout.
 
     """
-    create("/tmp/tarstall-lock")
-    file_vprint("Lock created!")
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    with _locks_changed:
+        held = _locks.get("tarstall")
+        if held is not None and threading.get_ident() in held["owners"]:
+            if held["mode"] == mode:
+                return True
+            elif shared:
+                fcntl.flock(held["file"], fcntl.LOCK_SH)
+                held["mode"] = fcntl.LOCK_SH
+                _locks_changed.notify_all()
+                return True
+    if not _acquire("tarstall", mode, timeout):
+        return False
+    file_vprint("Lock acquired!")
+    return True
 
 
 def unlock():
-    """Remove tarstall lock."""
+    """Release this tarstall's lock."""
+    _release("tarstall", release_all=True)
+    file_vprint("Lock released!")
+
+
+def remove_legacy_lock():
+    """Remove Legacy Lock.
+
+    Removes /tmp/tarstall-lock, which versions of tarstall from before locks were released automatically
+    could leave behind after crashing.
+
+    Returns:
+        bool: Whether there was a lock to remove
+
+    """
     try:
-        os.remove(full("/tmp/tarstall-lock"))
+        os.remove("/tmp/tarstall-lock")
+        return True
     except FileNotFoundError:
-        pass
-    file_vprint("Lock removed!")
+        return False
+
+
+@contextmanager
+def program_lock(programs, timeout=None):
+    """Program Lock.
+
+    Holds an exclusive lock on each program for the duration of the with block, so two tarstalls never
+    install, update, or remove the same program at once, while different programs can be worked on in parallel.
+    Locks are taken in sorted order, so two tarstalls locking overlapping programs can't deadlock.
+
+    Args:
+        programs (str/str[]): Name(s) of programs to lock
+        timeout (float): Seconds to wait for each program. Defaults to None, which waits for LOCK_TIMEOUT seconds.
+
+    Yields:
+        bool: Whether every program was locked. If False, none of them are.
+
+    """
+    if isinstance(programs, str):
+        programs = [programs]
+    programs = sorted(set(programs))
+    acquired = []
+    for program in programs:
+        if not _acquire("program-" + program, fcntl.LOCK_EX, timeout):
+            break
+        acquired.append(program)
+    if len(acquired) != len(programs):
+        for program in acquired:
+            _release("program-" + program)
+        acquired = []
+    try:
+        yield len(acquired) == len(programs)
+    finally:
+        for program in acquired:
+            _release("program-" + program)
+
+
+@contextmanager
+def db_lock(timeout=None):
+    """Database Lock.
+
+    Held while the database is re-read and written, so commits from different tarstalls never interleave.
+    Nothing slow should happen while it's held.
+
+    Args:
+        timeout (float): Seconds to wait for other tarstalls. Defaults to None, which waits for LOCK_TIMEOUT seconds.
+
+    Raises:
+        TimeoutError: If another tarstall held the lock for the whole timeout
+
+    """
+    if not _acquire("database", fcntl.LOCK_EX, timeout):
+        raise TimeoutError("Another tarstall held the database lock for too long")
+    try:
+        yield
+    finally:
+        _release("database")
+
+
+@contextmanager
+def cache_lock(timeout=None):
+    """Cache Lock.
+
+    Held while the download cache's index is read and written, so tarstalls adding to or pruning the cache
+    at the same time never lose each other's changes.
+
+    Args:
+        timeout (float): Seconds to wait for other tarstalls. Defaults to None, which waits for LOCK_TIMEOUT seconds.
+
+    Raises:
+        TimeoutError: If another tarstall held the lock for the whole timeout
+
+    """
+    if not _acquire("cache", fcntl.LOCK_EX, timeout):
+        raise TimeoutError("Another tarstall held the cache lock for too long")
+    try:
+        yield
+    finally:
+        _release("cache")
 
 
 def name(program):
@@ -187,10 +416,22 @@ def locked():
     """Get Lock State.
 
     Returns:
-        bool: True if tarstall is locked. False otherwise.
+        bool: True if another tarstall holds the exclusive lock, so a shared lock can't be taken right now.
+        False otherwise.
 
     """
-    return exists("/tmp/tarstall-lock")
+    if "tarstall" in _locks:
+        return False
+    try:
+        with open(os.path.join(LOCKS_PATH, "tarstall.lock")) as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        pass
+    return False
 
 
 def full(file_name):
@@ -234,17 +475,7 @@ def replace_in_file(old, new, file_path):
         file (str): Path to file to replace strings in
 
     """
-    rewrite = """"""
-    file_path = full(file_path)
-    f = open(file_path, 'r')
-    open_file = f.readlines()
-    f.close()
-    for l in open_file:
-        rewrite += l.replace(old, new)
-    written = open(file_path, 'w')
-    written.write(str(rewrite))
-    written.close()  # Write then close our new copy of the file
-    return
+    rewrite_file(file_path, [(old, lambda l: l.replace(old, new))])
 
 
 def check_line(line, file_path, mode):
@@ -302,28 +533,66 @@ def remove_line(line, file_path, mode):
         mode (str): Mode to use to find lines to remove
 
     """
-    rewrite = """"""
-    file_path = full(file_path)
-    f = open(file_path, 'r')
-    open_file = f.readlines()
-    f.close()
-    for l in open_file:
+    def matches(l):
         if mode == 'word' or mode == 'poundword':
-            new_l = l.rstrip()
-            new_l = new_l.split()
+            new_l = l.rstrip().split()
         elif mode == 'fuzzy':
             new_l = l.rstrip()
-        if line in new_l:
-            if not ('#' in new_l) and mode == 'poundword':
-                rewrite += l
-            else:
-                pass
+        return line in new_l and not ('#' not in new_l and mode == 'poundword')
+
+    rewrite_file(file_path, [(matches, None)])
+
+
+def rewrite_file(file_path, rules):
+    """Rewrite File.
+
+    Streams a file line by line through a list of rules, writing the result to a temporary file that
+    is swapped in atomically. Each line is checked against every rule in order. If nothing changes,
+    the file isn't written at all.
+
+    Args:
+        file_path (str): Path to file to rewrite
+        rules ((str/function, function/None)[]): List of (match, action) pairs. match is a string that
+        must be in the line, or a function that takes the line and returns whether it matches. action takes
+        the matching line and returns what to replace it with, or is None to remove the line.
+
+    Returns:
+        int[]: Number of lines each rule matched, in the same order as rules
+
+    """
+    file_path = full(file_path)
+    counts = [0] * len(rules)
+    changed = False
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=".{}.".format(os.path.basename(file_path)))
+    try:
+        with open(file_path) as src, os.fdopen(fd, "w") as dst:
+            for l in src:
+                new_l = l
+                for i, (match, action) in enumerate(rules):
+                    if (match in new_l) if isinstance(match, str) else match(new_l):
+                        counts[i] += 1
+                        new_l = None if action is None else action(new_l)
+                        if new_l is None:
+                            break
+                if new_l != l:
+                    changed = True
+                if new_l is not None:
+                    dst.write(new_l)
+            if changed:
+                dst.flush()
+                os.fsync(dst.fileno())
+        if changed:
+            os.chmod(temp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+            os.replace(temp_path, file_path)
         else:
-            rewrite += l
-    written = open(file_path, 'w')
-    written.write(str(rewrite))
-    written.close()  # Write then close our new copy of the file
-    return
+            os.remove(temp_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return counts
 
 
 def add_line(line, file_path):
@@ -334,6 +603,236 @@ def add_line(line, file_path):
     f.close()
 
 
+def atomic_write(contents, file_path):
+    """Write File Atomically.
+
+    Writes contents to a temporary file next to file_path, syncs it to disk, then renames it over
+    file_path. Readers will either see the old file or the new one, never a partially written one.
+
+    Args:
+        contents (str): Contents to write to the file
+        file_path (str): Path to file to write to
+
+    """
+    file_path = full(file_path)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=".{}.".format(os.path.basename(file_path)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _renameat2_exchange(path_a, path_b):
+    """Atomically swap two paths with renameat2(RENAME_EXCHANGE). Returns False if unsupported."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 2
+    if renameat2(AT_FDCWD, os.fsencode(path_a), AT_FDCWD, os.fsencode(path_b), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):  # Kernel or filesystem doesn't support it
+        return False
+    raise OSError(err, os.strerror(err), path_a)
+
+
+def exchange(path_a, path_b):
+    """Exchange Paths.
+
+    Swaps two files or directories on the same filesystem. On Linux this is a single atomic operation,
+    so anything opening path_b sees either the old or new version, never nothing. Elsewhere, it's done
+    with three renames.
+
+    Args:
+        path_a (str): First path
+        path_b (str): Second path
+
+    """
+    path_a = full(path_a)
+    path_b = full(path_b)
+    if _renameat2_exchange(path_a, path_b):
+        return
+    temp_path = path_b + ".tarstall-exchange"
+    os.rename(path_b, temp_path)
+    os.rename(path_a, path_b)
+    os.rename(temp_path, path_a)
+
+
+def hash_file(file_path):
+    """Hash File.
+
+    Args:
+        file_path (str): Path to file to hash
+
+    Returns:
+        str: Hex sha256 of the file's contents
+
+    """
+    h = hashlib.sha256()
+    with open(full(file_path), "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _copy_data(src_fd, dst_fd):
+    """Copy the contents of src_fd to dst_fd as cheaply as the filesystems allow, returning how it was done."""
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)  # Shares the source's blocks on btrfs, xfs, etc., copying no data at all
+        return "reflink"
+    except OSError:
+        pass
+    copied = 0
+    for name in ["copy_file_range", "sendfile"]:
+        try:
+            while True:
+                if name == "copy_file_range":
+                    n = os.copy_file_range(src_fd, dst_fd, COPY_CHUNK, copied, copied)
+                else:
+                    os.lseek(dst_fd, copied, os.SEEK_SET)
+                    n = os.sendfile(dst_fd, src_fd, copied, COPY_CHUNK)
+                if n == 0:
+                    return name
+                copied += n
+        except (AttributeError, OSError) as e:  # Not in this Python, or not supported between these filesystems
+            if isinstance(e, OSError) and e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                                          errno.ENOTSUP, errno.EBADF, errno.EPERM]:
+                raise
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while True:
+        data = os.read(src_fd, COPY_CHUNK)
+        if not data:
+            return "userspace"
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+
+def copy_file(source, dest):
+    """Copy File.
+
+    Copies a file along with its permissions and timestamps, like `cp -a`. The contents are reflinked
+    if the filesystem supports it, otherwise they're copied inside the kernel with copy_file_range()
+    or sendfile(), only falling back to reading and writing them here if neither works.
+
+    Args:
+        source (str): Path to file to copy
+        dest (str): Path to copy it to
+
+    Returns:
+        str: How the contents were copied: "reflink", "copy_file_range", "sendfile", or "userspace"
+
+    """
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        method = _copy_data(src.fileno(), dst.fileno())
+    shutil.copystat(source, dest)
+    return method
+
+
+def copy_tree(source, dest, threads=None):
+    """Copy Tree.
+
+    Copies a directory like `rsync -a`: symlinks are copied as symlinks, files hardlinked to each other
+    stay hardlinked, and permissions and timestamps are kept. Files are copied with copy_file() by a
+    pool of threads, so the kernel can work on several of them at once.
+
+    Args:
+        source (str): Path to directory to copy
+        dest (str): Path to copy it to. Must not exist.
+        threads (int): Number of files to copy at once. Defaults to the number of CPUs.
+
+    Returns:
+        dict: Number of files copied by each method from copy_file(), plus "hardlink" for files linked
+        to another copied file
+
+    """
+    source = full(source)
+    dest = full(dest)
+    os.mkdir(dest)
+    dirs = [(source, dest)]
+    first_copy = {}  # (st_dev, st_ino) of files with several links -> where the first was copied to
+    links = []
+    futures = []
+    with ThreadPoolExecutor(threads or os.cpu_count() or 1) as pool:
+        for root, dir_names, file_names in os.walk(source):
+            dest_root = os.path.join(dest, os.path.relpath(root, source))
+            for name in dir_names + file_names:
+                path = os.path.join(root, name)
+                target = os.path.join(dest_root, name)
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(path), target)
+                    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+                elif stat.S_ISDIR(st.st_mode):
+                    os.mkdir(target)
+                    dirs.append((path, target))
+                elif stat.S_ISREG(st.st_mode):
+                    if st.st_nlink > 1:
+                        if (st.st_dev, st.st_ino) in first_copy:
+                            links.append((first_copy[(st.st_dev, st.st_ino)], target))
+                            continue
+                        first_copy[(st.st_dev, st.st_ino)] = target
+                    futures.append(pool.submit(copy_file, path, target))
+                else:
+                    file_vprint("Skipping special file {}".format(path))
+    counts = {"hardlink": len(links)}
+    for future in futures:
+        method = future.result()
+        counts[method] = counts.get(method, 0) + 1
+    for existing, target in links:
+        os.link(existing, target)
+    for path, target in reversed(dirs):  # Deepest first, since filling a directory changes its timestamps
+        shutil.copystat(path, target)
+    return counts
+
+
+def move_tree(source, dest, threads=None):
+    """Move Tree.
+
+    Moves a file or directory. On the same filesystem this is a rename. Otherwise, it's copied with
+    copy_tree() or copy_file(), and only removed once the copy is complete.
+
+    Args:
+        source (str): Path to file or directory to move
+        dest (str): Path to move it to. Must not exist.
+        threads (int): Number of files to copy at once if it has to be copied. Defaults to the number of CPUs.
+
+    """
+    source = full(source)
+    dest = full(dest)
+    try:
+        os.rename(source, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    file_vprint("Copying {} to another filesystem".format(source))
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), dest)
+        os.remove(source)
+    elif os.path.isdir(source):
+        file_vprint("Copied files: {}".format(copy_tree(source, dest, threads)))
+        shutil.rmtree(source)
+    else:
+        copy_file(source, dest)
+        os.remove(source)
+
+
 def char_check(name):
     """Check Chars.
 
@@ -349,10 +848,15 @@ def char_check(name):
 def get_db(db_check=""):
     """Get Database.
 
+    Reads from ~/.tarstall/database.sqlite if it exists, or ~/.tarstall/database otherwise.
+
     Returns:
         dict: Database. {} if database fails to be read or found on disk.
 
     """
+    import sqlite_db  # Imported here to prevent a circular import
+    if sqlite_db.enabled():
+        return sqlite_db.load()
     try:
         with open(full("~/.tarstall/database")) as f:
             return json.load(f)
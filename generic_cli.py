@@ -78,6 +78,34 @@ def get_arg_extra(short, long, args):
     return None
 
 
+def get_arg_extras(short, long, args):
+    """Gets Extras for Argument.
+
+    Gets every extra value supplied for an argument, up to the next argument starting with "-".
+    For example, "install /tmp/a /tmp/b -v" would return ["/tmp/a", "/tmp/b"]
+
+    Args:
+        short (str): Short form of argument
+        long (str): Long form of argument
+        args (str[]): List of arguments
+
+    Returns:
+        str[]: Extra values supplied, None if the argument was not specified, or -1 if it has no extra values.
+
+    """
+    index = get_argument_index(short, long, args)
+    if index == -1:
+        return None
+    extras = []
+    for arg in args[index + 1:]:
+        if arg.startswith("-"):
+            break
+        extras.append(arg)
+    if extras == []:
+        return -1
+    return extras
+
+
 def ask_file(question):
     f = "asdf"
     while not file.exists(file.full(f)):
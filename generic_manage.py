@@ -13,6 +13,13 @@
 
     You should have received a copy of the GNU General Public License
     along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import http.client
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from subprocess import Popen, PIPE, STDOUT, call, DEVNULL
 
 import config
@@ -20,52 +27,33 @@ import generic
 
 try:
     import requests
+    import urllib3
     can_update = True
 except ImportError:
     can_update = False
 
-if config.verbose:
-    c_out = None
-else:
-    c_out = DEVNULL
+DOWNLOAD_TIMEOUT = (10, 60)  # Seconds to wait to connect, and for more data once connected
+DOWNLOAD_RETRIES = 3  # Times to resume a download that's cut off before giving up
+DOWNLOAD_CONNECTIONS = 8  # Connections kept open to each host
+HOST_CONNECTIONS = 4  # Most downloads from one host at once, counting each segment of a segmented download
+SEGMENT_MIN_SIZE = 4 * 1024 * 1024  # Smallest segment worth its own connection
+CHUNK_SIZE = 1024 * 1024
 
+_session = None
+_host_slots = {}  # Host -> semaphore with a slot for each connection allowed to it
+_host_slots_lock = threading.Lock()
 
-def wget_with_progress(url, start_percent, end_percent, show_progress=True):
-    """Wget with Progress.
 
-    The wget version of git_clone_with_progress()
+def __getattr__(name):
+    """Get c_out (where to send output of commands) based on the current verbosity."""
+    if name == "c_out":
+        if config.verbose:
+            return None
+        return DEVNULL
+    raise AttributeError("module 'generic_manage' has no attribute '{}'".format(name))
 
-    Args:
-        url (str): URL to file to grab
-        start_percent (int): Where generic.progress() last was
-        end_percent (int): Where generic.progress() should end up
-        show_progress (bool, optional): Whether to show progress if not verbose. Defaults to True.
 
-    Returns:
-        int: Exit code from wget
-
-    """
-    if config.verbose:
-        process = Popen(["wget", url])
-    else:
-        process = Popen(["wget", url], stdout=PIPE, stderr=STDOUT)
-    if not config.verbose and show_progress:
-        while process.poll() is None:
-            p_status = process.stdout.readline().decode("utf-8")
-            try:
-                index = p_status.rfind("%")
-                if index != -1:
-                    percent_complete = int(p_status[index-2:index].strip())
-                    if percent_complete > 0:
-                        generic.progress(start_percent + ((end_percent - start_percent) * (percent_complete / 100)))
-            except (TypeError, ValueError):
-                pass
-    else:
-        process.wait()
-    return process.poll()
-
-
-def git_clone_with_progress(url, start_percent, end_percent, branch=None):
+def git_clone_with_progress(url, start_percent, end_percent, branch=None, cwd=None, show_progress=True):
     """Performs a Git Clone with Progress.
 
     Args:
@@ -73,6 +61,8 @@ def git_clone_with_progress(url, start_percent, end_percent, branch=None):
         start_percent (int): Starting value for generic.progress()
         end_percent (int): Ending value for generic.progress()
         branch (str): If specified, use a custom branch to clone from. Defaults to None.
+        cwd (str): Directory to clone into. Defaults to the current directory.
+        show_progress (bool): Whether to show progress if not verbose. Defaults to True.
 
     Returns:
         [int: Exit code from git
@@ -83,10 +73,12 @@ def git_clone_with_progress(url, start_percent, end_percent, branch=None):
         command.append(branch)
     command.append(url)
     if config.verbose:
-        err = call(command)
+        err = call(command, cwd=cwd)
+    elif not show_progress:
+        err = call(command, stdout=DEVNULL, stderr=DEVNULL, cwd=cwd)
     else:
         command.append("--progress")
-        process = Popen(command, stderr=STDOUT, stdout=PIPE, universal_newlines=True)
+        process = Popen(command, stderr=STDOUT, stdout=PIPE, universal_newlines=True, cwd=cwd)
         multiplier = end_percent - start_percent
         while process.poll() is None:
             p_status = process.stdout.readline()
@@ -102,4 +94,396 @@ def git_clone_with_progress(url, start_percent, end_percent, branch=None):
             except (TypeError, ValueError):
                     pass
         err = process.poll()
-    return err
\ No newline at end of file
+    return err
+
+
+def session():
+    """Get Download Session.
+
+    Returns:
+        requests.Session: Session shared by every download, so connections to the same host are kept
+        alive and reused instead of being set up again for each download.
+
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=DOWNLOAD_CONNECTIONS, pool_maxsize=DOWNLOAD_CONNECTIONS)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+        _session.headers["User-Agent"] = "tarstall/{}".format(config.version)
+    return _session
+
+
+def _host_slot(url):
+    """Get the semaphore limiting downloads from url's host to HOST_CONNECTIONS at once."""
+    host = urllib.parse.urlsplit(url).netloc
+    with _host_slots_lock:
+        return _host_slots.setdefault(host, threading.BoundedSemaphore(HOST_CONNECTIONS))
+
+
+class Download:
+    """A download streamed from a URL, read from with read() like a file.
+
+    Uses the shared session() when requests is installed, and urllib otherwise. close() must be called
+    once reading is done. Each open Download takes one of its host's HOST_CONNECTIONS slots, waiting
+    for one to free up if needed.
+
+    Attributes:
+        size (int/None): Size of the whole file in bytes, if the server said
+        offset (int): Byte of the file reading starts at. This is the offset asked for if the server
+        supports resuming, or 0 if it sent the whole file instead.
+        validators (dict): "etag", "last_modified", and "length" of the file from the server, each None if not sent.
+        Passing these back in later makes the download conditional.
+        not_modified (bool): Whether the file is unchanged from the validators passed in. Nothing is read if so.
+        ranges (bool): Whether the server said it can send parts of the file
+
+    Raises:
+        OSError: If the download couldn't be started, such as the server returning an error
+
+    """
+
+    def __init__(self, url, offset=0, validators=None, end=None, if_range=None):
+        """Start Download.
+
+        Args:
+            url (str): URL to download
+            offset (int): Byte of the file to start at. Defaults to 0.
+            validators (dict): Download.validators from an earlier download, to only download the file if
+            it changed since. Defaults to None.
+            end (int): Last byte of the file to download, or None to download to the end. Defaults to None.
+            if_range (str): ETag or Last-Modified date the file must still have for only part of it to be sent.
+            If it changed, the whole file is sent instead. Defaults to None.
+
+        """
+        self.size = None
+        self.offset = 0
+        self.not_modified = False
+        self._response = None
+        self._slot = _host_slot(url)
+        self._slot.acquire()
+        headers = {"Accept-Encoding": "identity"}  # read() returns the bytes as sent, so they mustn't be compressed
+        if offset or end is not None:
+            headers["Range"] = "bytes={}-{}".format(offset, "" if end is None else end)
+        if if_range:
+            headers["If-Range"] = if_range
+        if validators and validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        elif validators and validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        try:
+            self._start(url, offset, validators, headers)
+        except BaseException:
+            self.close()
+            raise
+
+    def _start(self, url, offset, validators, headers):
+        try:
+            if can_update:
+                self._response = session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)
+                status = self._response.status_code
+                response_headers = self._response.headers
+                if status != 416:
+                    self._response.raise_for_status()
+            else:
+                try:
+                    self._response = urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                                            timeout=DOWNLOAD_TIMEOUT[1])
+                except urllib.error.HTTPError as e:
+                    if e.code not in [304, 416]:
+                        raise
+                    self._response = e
+                status = self._response.status
+                response_headers = self._response.headers
+        except (OSError, ValueError) as e:  # requests' and urllib's errors are OSErrors, except for bad URLs
+            raise OSError("Couldn't download {}: {}".format(url, e))
+        length = response_headers.get("Content-Length")
+        if status == 416:  # Nothing left after offset, so the file is already complete if it's the size the server says
+            total = response_headers.get("Content-Range", "").rpartition("/")[2]
+            self.close()
+            if total != str(offset):
+                raise OSError("Couldn't resume {}: the file changed on the server".format(url))
+            self.offset = self.size = offset
+        elif status == 206:
+            self.offset = offset
+            total = response_headers.get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit():
+                self.size = int(total)
+        elif length is not None and length.isdigit():
+            self.size = int(length)
+        self.ranges = response_headers.get("Accept-Ranges") == "bytes"
+        self.validators = {"etag": response_headers.get("ETag"), "last_modified": response_headers.get("Last-Modified"),
+                           "length": self.size}
+        if status == 304 or (validators and not offset and _unchanged(validators, self.validators)):
+            self.not_modified = True
+            self.close()
+
+    def read(self, size=-1):
+        if self._response is None:
+            return b""
+        try:
+            if can_update:
+                return self._response.raw.read(size)
+            return self._response.read(size)
+        except (urllib3.exceptions.HTTPError if can_update else http.client.HTTPException) as e:  # Such as the connection dropping
+            raise OSError(str(e))
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
+
+def _unchanged(old, new):
+    """Check whether validators from two downloads of a URL show the same file."""
+    if old.get("etag") and new["etag"]:
+        return old["etag"] == new["etag"]
+    return bool(old.get("last_modified")) and old.get("last_modified") == new["last_modified"] and \
+        old.get("length") is not None and old.get("length") == new["length"]
+
+
+def _if_range(validators):
+    """Get the If-Range value for validators, so a resumed download never mixes two versions of a file.
+
+    Returns:
+        str/None: The strong ETag, or the Last-Modified date if there isn't one. None if neither was sent.
+
+    """
+    etag = validators["etag"]
+    return etag if etag and not etag.startswith("W/") else validators["last_modified"]  # Weak ETags can't be used
+
+
+def segment_count(dl):
+    """Get Segment Count.
+
+    Args:
+        dl (Download): Download that was just started from the beginning of the file
+
+    Returns:
+        int: Number of segments to download the file in at once, up to the DownloadSegments option.
+        1 if the server can't send parts of the file, it's too small to be worth splitting, or the server
+        sent no strong ETag or Last-Modified date, since then a segment could come from a newer version of the file.
+
+    """
+    if not dl.ranges or dl.size is None or _if_range(dl.validators) is None:
+        return 1
+    return max(1, min(config.read_config("DownloadSegments"), dl.size // SEGMENT_MIN_SIZE))
+
+
+def _download_segment(url, path, start, end, done, index, if_range, stop, dl=None):
+    """Download Segment.
+
+    Downloads bytes start through end of url into the same bytes of path, resuming if cut off.
+
+    Args:
+        url (str): URL to download
+        path (str): Path to write to, which must already be at least end + 1 bytes long
+        start (int): First byte of the segment
+        end (int): Last byte of the segment
+        done (int[]): Bytes downloaded of each segment, updated at index as the segment downloads
+        index (int): Index of this segment in done
+        if_range (str): ETag or Last-Modified date of the file, so a changed file is never mixed with the old one
+        stop (threading.Event): Set if another segment failed, so this one stops early
+        dl (Download): Already started download to read the segment from. Defaults to None, which starts one.
+
+    Raises:
+        OSError: If the segment couldn't be downloaded
+
+    """
+    pos = start
+    retries = 0
+    with open(path, "r+b") as f:
+        while pos <= end and not stop.is_set():
+            try:
+                if dl is None:
+                    dl = Download(url, pos, end=end, if_range=if_range)
+                if dl.offset != pos:
+                    retries = DOWNLOAD_RETRIES  # The server sent the whole file, so retrying won't help
+                    raise OSError("{} changed on the server while it was downloading".format(url))
+                f.seek(pos)
+                while pos <= end and not stop.is_set():
+                    chunk = dl.read(min(CHUNK_SIZE, end + 1 - pos))
+                    if not chunk:
+                        raise OSError("Connection closed {} bytes early".format(end + 1 - pos))
+                    f.write(chunk)
+                    f.flush()  # So the chunk can be hashed as soon as it counts as done
+                    pos += len(chunk)
+                    done[index] = pos - start
+            except OSError as e:
+                retries += 1
+                if retries > DOWNLOAD_RETRIES:
+                    raise
+                config.vprint("Segment of {} cut off ({}), resuming from byte {}".format(url, e, pos))
+            finally:
+                if dl is not None:
+                    dl.close()
+                    dl = None
+
+
+def _hash_ready(f, hasher, hashed, bounds, done):
+    """Hash the bytes of a segmented download from hashed up to the first byte not yet downloaded.
+
+    Returns:
+        int: Number of bytes from the start of the file hashed so far
+
+    """
+    ready = 0
+    for (start, end), got in zip(bounds, done):
+        ready = start + got
+        if got < end + 1 - start:
+            break
+    f.seek(hashed)
+    while hashed < ready:
+        chunk = f.read(min(CHUNK_SIZE, ready - hashed))
+        hasher.update(chunk)
+        hashed += len(chunk)
+    return hashed
+
+
+def _download_segments(dl, url, path, count, start_percent, end_percent, show_progress, hasher=None):
+    """Download Segments.
+
+    Downloads a file as count byte ranges at once, each written straight into its place in a preallocated
+    file. The first range is read from dl, which has already started sending the file. Once every range is
+    done, the file is checked to be the size the server said. If anything fails, the file is removed, so it's
+    never mistaken for the start of a download to resume.
+
+    While the segments download, hasher is fed the file in order as far as it has been downloaded, so
+    the bytes are hashed while they're still cached in memory instead of in a second pass at the end.
+
+    Args:
+        dl (Download): Download started from the beginning of the file
+        url (str): URL to download
+        path (str): Path to save the download to
+        count (int): Number of segments, from segment_count()
+        start_percent (int): Where generic.progress() last was
+        end_percent (int): Where generic.progress() should end up
+        show_progress (bool): Whether to show progress
+        hasher (hashlib hash): If supplied, updated with every byte of the file. Defaults to None.
+
+    Raises:
+        OSError: If the download failed
+
+    """
+    size = dl.size
+    bounds = [(size * i // count, size * (i + 1) // count - 1) for i in range(count)]
+    if_range = _if_range(dl.validators)
+    done = [0] * count
+    stop = threading.Event()
+    config.vprint("Downloading {} in {} segments".format(url, count))
+    try:
+        with open(path, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError:  # Filesystem can't preallocate
+                f.truncate(size)
+        with ThreadPoolExecutor(count) as pool, open(path, "rb") as hash_f:
+            hashed = 0
+            try:
+                pending = [pool.submit(_download_segment, url, path, start, end, done, i, if_range, stop,
+                                       dl if i == 0 else None) for i, (start, end) in enumerate(bounds)]
+                last = start_percent
+                while pending:
+                    finished, pending = wait(pending, timeout=0.25, return_when=FIRST_EXCEPTION)
+                    for future in finished:
+                        future.result()
+                    if hasher is not None:
+                        hashed = _hash_ready(hash_f, hasher, hashed, bounds, done)
+                    percent = start_percent + (end_percent - start_percent) * sum(done) / size
+                    if int(percent) > int(last):
+                        last = percent
+                        generic.progress(percent, show_progress)
+            except BaseException:
+                stop.set()
+                raise
+        if sum(done) != size or os.path.getsize(path) != size:
+            raise OSError("Downloaded {} bytes of {}, but expected {}".format(sum(done), url, size))
+    except BaseException:
+        dl.close()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def download(url, path, start_percent=0, end_percent=100, show_progress=True, hasher=None, validators=None):
+    """Download File.
+
+    Streams a URL to a file in chunks, replacing whatever is at path. If the connection drops partway
+    through, only the rest is requested, up to DOWNLOAD_RETRIES times, as long as the server supports resuming.
+    The resumed request carries If-Range, so if the file changed meanwhile, the server sends it whole instead.
+
+    Large files are downloaded in segments at once (see segment_count()) if the server supports it. Those are
+    hashed in order, each stretch from the start of the file as soon as it has downloaded.
+
+    If validators from an earlier download are given, the file is only downloaded if it changed since.
+
+    Args:
+        url (str): URL to download
+        path (str): Path to save the download to
+        start_percent (int): Where generic.progress() last was. Defaults to 0.
+        end_percent (int): Where generic.progress() should end up. Defaults to 100.
+        show_progress (bool): Whether to show progress. Defaults to True.
+        hasher (hashlib hash): If supplied, updated with every byte of the file. Defaults to None.
+        validators (dict): Download.validators from an earlier download of url. Defaults to None.
+
+    Returns:
+        dict/None: Download.validators of the file, or None if it didn't change from validators (and wasn't downloaded)
+
+    Raises:
+        OSError: If the download failed
+
+    """
+    done = 0
+    hashed = 0
+    retries = 0
+    last = start_percent
+    new_validators = None
+    while True:
+        if new_validators is None:
+            dl = Download(url, validators=validators)
+        else:
+            dl = Download(url, done, if_range=_if_range(new_validators))
+        if dl.not_modified:
+            return None
+        if new_validators is None:
+            new_validators = dl.validators
+        try:
+            if dl.offset != done:
+                config.vprint("Server can't resume downloads, starting over")
+                if hashed:
+                    raise OSError("Couldn't resume {}: the server doesn't support it, or the file changed".format(url))
+                done = 0
+                new_validators = dl.validators
+            if not done and segment_count(dl) > 1:
+                _download_segments(dl, url, path, segment_count(dl), start_percent, end_percent, show_progress, hasher)
+                return new_validators
+            with open(path, "ab" if done else "wb") as f:
+                while True:
+                    chunk = dl.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    done += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                        hashed = done
+                    if dl.size:
+                        percent = start_percent + (end_percent - start_percent) * min(done / dl.size, 1)
+                        if int(percent) > int(last):
+                            last = percent
+                            generic.progress(percent, show_progress)
+            if dl.size is not None and done < dl.size:
+                raise OSError("Connection closed {} bytes early".format(dl.size - done))
+            return new_validators
+        except OSError as e:
+            retries += 1
+            if retries > DOWNLOAD_RETRIES or done == 0:
+                raise
+            config.vprint("Download of {} cut off ({}), resuming from byte {}".format(url, e, done))
+        finally:
+            dl.close()
@@ -0,0 +1,295 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import json
+import os
+import uuid
+
+import file
+import shell
+
+JOURNAL_PATH = "~/.tarstall/journal"
+CHECKPOINT_PATH = "~/.tarstall/journal_checkpoint"
+CHECKPOINT_EVERY = 100  # Number of commits between checkpoints
+
+_txn = None  # ID of the transaction entries are currently being recorded in
+_pending = []  # Entries recorded in the current transaction, for replaying onto a database re-read from disk
+
+"""
+Journal structure
+
+Each line of the journal is one entry:
+{"seq": 5, "txn": "2f1c...", "op": "pathify", "program": "package", "data": {}}
+
+Entries are only replayed if an entry with the op "commit" and the same txn exists, so operations
+from failed transactions or a crash before the database was written are never replayed. A failed
+transaction ends with an "abort" entry instead. Transactions are replayed in the order they committed.
+
+seq is shared by every tarstall: it's allocated while holding file.db_lock(), which every write to the
+journal holds, so a later entry always has a higher seq, whichever tarstall wrote it.
+
+The checkpoint holds a full copy of the database, and the seq of the last entry when it was taken:
+{"seq": 4, "db": {...}}
+
+Taking a checkpoint removes the entries of every transaction that committed or aborted. Entries of
+transactions that are still in progress in other tarstalls are kept, since the checkpoint doesn't have them.
+"""
+
+
+def _read_entries():
+    """Read Journal Entries.
+
+    Returns:
+        dict[]: Every complete entry in the journal. A partially written last line is skipped.
+
+    """
+    entries = []
+    try:
+        with open(file.full(JOURNAL_PATH)) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def _read_checkpoint():
+    """Read Checkpoint.
+
+    Returns:
+        dict/None: The checkpoint, or None if it doesn't exist or is unreadable.
+
+    """
+    try:
+        with open(file.full(CHECKPOINT_PATH)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+def _last_seq(entries):
+    """Get the seq of the last journal entry, or of the checkpoint if the journal has none after it."""
+    checkpoint = _read_checkpoint()
+    return max([checkpoint["seq"] if checkpoint is not None else 0] + [e["seq"] for e in entries])
+
+
+def _append(entry):
+    with open(file.full(JOURNAL_PATH), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _append_next(entry):
+    """Append entry to the journal with the next seq. file.db_lock() must be held."""
+    entry["seq"] = _last_seq(_read_entries()) + 1
+    _append(entry)
+    return entry
+
+
+def record(op, program=None, **data):
+    """Record Operation.
+
+    Appends an operation to the journal. This should be called before the operation changes the database.
+
+    Args:
+        op (str): Operation. See _apply() for valid operations.
+        program (str): Program the operation is performed on, if any.
+        **data: Extra information needed to replay the operation.
+
+    Raises:
+        TimeoutError: If another tarstall held the database lock for too long
+
+    """
+    global _txn
+    if _txn is None:
+        _txn = uuid.uuid4().hex
+    with file.db_lock():
+        entry = _append_next({"seq": None, "txn": _txn, "op": op, "program": program, "data": data})
+    _pending.append(json.loads(json.dumps(entry)))  # A copy, since the database keeps changing what entry refers to
+
+
+def commit(db):
+    """Commit Recorded Operations.
+
+    Marks every operation recorded since the last commit as written to the database, then
+    checkpoints if there have been enough commits since the last checkpoint.
+
+    Args:
+        db (dict): Database that was just written
+
+    """
+    global _txn
+    with file.db_lock():
+        if _txn is not None:
+            _append_next({"seq": None, "txn": _txn, "op": "commit"})
+            _txn = None
+        _pending.clear()
+        commits = sum(1 for e in _read_entries() if e["op"] == "commit")
+        if not file.exists(CHECKPOINT_PATH) or commits >= CHECKPOINT_EVERY:
+            checkpoint(db)
+
+
+def abort():
+    """Abort Recorded Operations.
+
+    Recorded operations that haven't been committed will never be replayed.
+
+    """
+    global _txn
+    if _txn is not None:
+        try:
+            with file.db_lock(timeout=1):  # Don't wait out another timeout after a write that timed out
+                _append_next({"seq": None, "txn": _txn, "op": "abort"})
+        except (OSError, TimeoutError):
+            pass  # Without a commit, the entries still never replay; they're just kept until the next checkpoint
+    _txn = None
+    _pending.clear()
+
+
+def pending():
+    """Get Pending Operations.
+
+    Returns:
+        dict[]: Every operation recorded since the last commit, oldest first
+
+    """
+    return list(_pending)
+
+
+def replay_pending(db):
+    """Replay Pending Operations.
+
+    Applies every operation recorded since the last commit to db, such as a copy of the database
+    that another tarstall has written to since this one read it.
+
+    Args:
+        db (dict): Database to apply the operations to
+
+    """
+    for entry in _pending:
+        try:
+            _apply(db, entry)
+        except (KeyError, ValueError):
+            pass  # Another tarstall removed what this entry changes
+
+
+def checkpoint(db):
+    """Checkpoint.
+
+    Saves a full copy of the database, then removes the entries of every finished transaction from
+    the journal. Entries of transactions other tarstalls are still recording are kept.
+
+    Args:
+        db (dict): Database to save, which must include every committed transaction
+
+    """
+    with file.db_lock():
+        entries = _read_entries()
+        finished = set(e["txn"] for e in entries if e["op"] in ["commit", "abort"])
+        file.atomic_write(json.dumps({"seq": _last_seq(entries), "db": db}, default=dict), CHECKPOINT_PATH)
+        file.atomic_write("".join(json.dumps(e) + "\n" for e in entries if e["txn"] not in finished), JOURNAL_PATH)
+
+
+def reset():
+    """Forget cached journal state, such as after tarstall is erased."""
+    global _txn
+    _txn = None
+    _pending.clear()
+
+
+def available():
+    """Check if Recovery is Possible.
+
+    Returns:
+        bool: Whether a checkpoint exists to recover the database from.
+
+    """
+    return _read_checkpoint() is not None
+
+
+def _apply(db, entry):
+    """Apply a journal entry to db."""
+    op = entry["op"]
+    data = entry["data"]
+    programs = db["programs"]
+    program = entry["program"]
+    if op == "install":
+        programs[program] = data["info"]
+    elif op == "uninstall":
+        programs.pop(program, None)
+    elif op == "rename":
+        programs[data["new_name"]] = programs.pop(program)
+        shell.rename_single_binlinks(programs[data["new_name"]], program, data["new_name"])
+    elif op == "binlink":
+        programs[program]["binlinks"].append(data["name"])
+        programs[program].setdefault("binlink_files", {})[data["name"]] = data.get("file", data["name"])
+    elif op == "pathify":
+        programs[program]["has_path"] = True
+    elif op == "remove_paths":
+        programs[program]["has_path"] = False
+        programs[program]["binlinks"] = []
+        programs[program]["binlink_files"] = {}
+    elif op == "desktop":
+        programs[program]["desktops"].append(data["name"])
+    elif op == "remove_desktop":
+        programs[program]["desktops"].remove(data["name"])
+    elif op == "update_url":
+        programs[program]["update_url"] = data["url"]
+        programs[program]["update_validators"] = None
+        programs[program]["sha256"] = None
+        programs[program]["sha256_url"] = None
+        if "type" in data:
+            programs[program]["update_archive_type"] = data["type"]
+    elif op == "update_validators":
+        programs[program]["update_validators"] = data["validators"]
+    elif op == "sha256":
+        programs[program]["sha256"] = data["sha256"]
+        programs[program]["sha256_url"] = data["url"]
+    elif op == "update_script":
+        programs[program]["post_upgrade_script"] = data["script"]
+    elif op == "config":
+        db["options"][data["key"]] = data["value"]
+    elif op == "branch":
+        db["version"]["branch"] = data["branch"]
+
+
+def recover():
+    """Recover Database.
+
+    Rebuilds the database from the last checkpoint and every committed operation in the journal after it.
+
+    Returns:
+        dict/None: Recovered database, or None if there is no checkpoint to recover from.
+
+    """
+    cp = _read_checkpoint()
+    if cp is None:
+        return None
+    db = cp["db"]
+    entries = _read_entries()
+    # Transactions that committed after the checkpoint was taken. Their entries can have a lower seq than
+    # the checkpoint, if they were recorded while it was taken.
+    committed = {e["txn"]: e["seq"] for e in entries if e["op"] == "commit" and e["seq"] > cp["seq"]}
+    to_replay = [e for e in entries if e["txn"] in committed and e["op"] not in ["commit", "abort"]]
+    for e in sorted(to_replay, key=lambda e: (committed[e["txn"]], e["seq"])):
+        try:
+            _apply(db, e)
+        except (KeyError, ValueError):
+            pass  # Entry refers to something the checkpoint doesn't have, so there's nothing to replay it on
+    return db
@@ -0,0 +1,239 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import json
+import os
+import stat
+
+import config
+import file
+
+MANIFESTS_PATH = "~/.tarstall/manifests"
+
+"""
+Manifest structure
+
+Every installed program has a manifest at ~/.tarstall/manifests/<program>.json, listing each file and
+symlink in the program's directory (except a top-level .git folder, which git manages itself):
+
+{
+    "relative/path": [size, mode, mtime_ns, hash]
+}
+
+hash is the sha256 of a file's contents, or the target of a symlink. Manifests are written whenever
+a program's files are placed, and can always be recreated with record().
+"""
+
+
+def manifest_path(program):
+    """Get Manifest Path.
+
+    Args:
+        program (str): Name of program
+
+    Returns:
+        str: Full path to the program's manifest
+
+    """
+    return os.path.join(file.full(MANIFESTS_PATH), program + ".json")
+
+
+def _entry(path, st, hashes):
+    if stat.S_ISLNK(st.st_mode):
+        return [0, st.st_mode, st.st_mtime_ns, os.readlink(path)]
+    return [st.st_size, st.st_mode, st.st_mtime_ns, file.hash_file(path) if hashes else None]
+
+
+def scan(tree_path, hashes=True):
+    """Scan Tree.
+
+    Args:
+        tree_path (str): Path to the program's directory
+        hashes (bool): Whether to hash the contents of files. Defaults to True.
+
+    Returns:
+        dict: Manifest entries for every file and symlink in the tree
+
+    """
+    tree_path = file.full(tree_path)
+    entries = {}
+    for root, dirs, files in os.walk(tree_path):
+        if root == tree_path and ".git" in dirs:
+            dirs.remove(".git")
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            entries[os.path.relpath(path, tree_path)] = _entry(path, os.lstat(path), hashes)
+    return entries
+
+
+def read(program):
+    """Read Manifest.
+
+    Args:
+        program (str): Name of program
+
+    Returns:
+        dict/None: The program's manifest entries, or None if it has no manifest
+
+    """
+    try:
+        with open(manifest_path(program)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+def write(program, entries):
+    """Write Manifest.
+
+    Args:
+        program (str): Name of program
+        entries (dict): Manifest entries, such as from scan()
+
+    """
+    os.makedirs(file.full(MANIFESTS_PATH), exist_ok=True)
+    file.atomic_write(json.dumps(entries, separators=(",", ":")), manifest_path(program))
+
+
+def record(program):
+    """Record Manifest.
+
+    Scans a program's directory and writes its manifest.
+
+    Args:
+        program (str): Name of program
+
+    Returns:
+        dict: The program's manifest entries
+
+    """
+    entries = scan("~/.tarstall/bin/" + program)
+    write(program, entries)
+    return entries
+
+
+def remove(program):
+    """Remove a program's manifest, if it has one."""
+    try:
+        os.remove(manifest_path(program))
+    except FileNotFoundError:
+        pass
+
+
+def rename(program, new_name):
+    """Rename a program's manifest, if it has one."""
+    try:
+        os.rename(manifest_path(program), manifest_path(new_name))
+    except FileNotFoundError:
+        pass
+
+
+def link_unchanged(tree_path, program, entries):
+    """Link Unchanged Files.
+
+    Replaces each file of a newly built program tree that's identical to the installed version's
+    file with a hardlink to it, so reinstalls and upgrades only store the files that changed.
+    Files of the installed version that no longer match its manifest are never linked to.
+
+    Args:
+        tree_path (str): Path to the new program tree, on the same filesystem as ~/.tarstall/bin
+        program (str): Name of program
+        entries (dict): Manifest entries of the new tree, from scan(). Updated for the files that are linked.
+
+    Returns:
+        int: Number of files linked
+
+    """
+    old_entries = read(program)
+    if old_entries is None:
+        return 0
+    program_dir = os.path.realpath(file.full("~/.tarstall/bin/" + program))
+    linked = 0
+    for rel, entry in entries.items():
+        old = old_entries.get(rel)
+        if old is None or not stat.S_ISREG(entry[1]) or entry[3] is None or old[:2] != entry[:2] or old[3] != entry[3]:
+            continue
+        old_path = os.path.join(program_dir, rel)
+        try:
+            st = os.lstat(old_path)
+        except FileNotFoundError:
+            continue
+        if st.st_size != old[0] or st.st_mode != old[1] or st.st_mtime_ns != old[2]:
+            continue  # Changed since it was installed
+        path = os.path.join(file.full(tree_path), rel)
+        tmp = path + ".tarstall-link"
+        try:
+            os.link(old_path, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            config.vprint("Couldn't reuse {}: {}".format(rel, e))
+            continue
+        entry[2] = st.st_mtime_ns
+        linked += 1
+    config.vprint("Reused {} unchanged files of {}".format(linked, program))
+    return linked
+
+
+def verify(program, check_hashes=True):
+    """Verify Program.
+
+    Args:
+        program (str): Name of program
+        check_hashes (bool): Whether to compare the contents of files, and not just their size, permissions,
+        and modification time. Defaults to True.
+
+    Returns:
+        dict/None: "missing", "changed", and "extra" lists of relative paths, or None if the program has no manifest
+
+    """
+    entries = read(program)
+    if entries is None:
+        return None
+    program_dir = os.path.realpath(file.full("~/.tarstall/bin/" + program))
+    current = scan(program_dir, hashes=False)
+    result = {"missing": [], "changed": [], "extra": sorted(set(current) - set(entries))}
+    for rel, entry in sorted(entries.items()):
+        if rel not in current:
+            result["missing"].append(rel)
+            continue
+        now = current[rel]
+        if now[0] != entry[0] or now[1] != entry[1]:
+            result["changed"].append(rel)
+        elif stat.S_ISLNK(entry[1]):
+            if now[3] != entry[3]:
+                result["changed"].append(rel)
+        elif check_hashes and entry[3] is not None:
+            if file.hash_file(os.path.join(program_dir, rel)) != entry[3]:
+                result["changed"].append(rel)
+        elif now[2] != entry[2]:
+            result["changed"].append(rel)
+    return result
+
+
+def disk_usage(program):
+    """Get Disk Usage.
+
+    Args:
+        program (str): Name of program
+
+    Returns:
+        int: Total size of the program's files in bytes. Read from the program's manifest if it has one,
+        otherwise its directory is scanned.
+
+    """
+    entries = read(program)
+    if entries is None:
+        entries = scan("~/.tarstall/bin/" + program, hashes=False)
+    return sum(entry[0] for entry in entries.values())
@@ -14,19 +14,128 @@
     You should have received a copy of the GNU General Public License
     along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
 
+import hashlib
 import os
+import queue
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from shutil import rmtree, move, which
 from subprocess import call, run, PIPE
 import re
 
+import archive
+import cache
 import file
-from generic_manage import wget_with_progress, git_clone_with_progress
+import generic_manage
+from generic_manage import git_clone_with_progress
 
 import config
 import generic
+import journal
+import manifest
+import shell
+import sqlite_db
+import store
 
-from generic_manage import c_out
-from config import verbose
+VERSIONS_DIR = "~/.tarstall/versions"  # Holds the kept versions of each program when VersionedInstalls is enabled
+KEEP_VERSIONS = 2  # The current version of a program and the one before it
+DOWNLOAD_WORKERS = 4  # Most downloads that run at once during a batch install
+
+
+def _remove_tree(path):
+    if os.path.islink(path):
+        os.remove(path)
+    else:
+        rmtree(path)
+
+
+def _place_program(source, program_internal_name):
+    """Place Program.
+
+    Makes a finished program tree the program's files. If the program is already installed, the old
+    tree is switched out for the new one in a single atomic step, so running programs never see a
+    missing or half-updated tree, and files that aren't in the new version don't linger.
+
+    With VersionedInstalls, the tree is kept in ~/.tarstall/versions/<program>/<number> and
+    ~/.tarstall/bin/<program> is a symlink to the current version.
+
+    The new tree's manifest is written. Files are only hashed when something reuses the hashes: the store,
+    or VersionedInstalls, where files that didn't change from the kept version are hardlinked to it so
+    they aren't stored twice.
+
+    Args:
+        source (str): Path to the program tree, such as in a config.workspace(). If it isn't on the same
+        filesystem as ~/.tarstall/bin, it's copied over first.
+        program_internal_name (str): Name of the program
+
+    """
+    source = file.full(source)
+    dest = file.full("~/.tarstall/bin/" + program_internal_name)
+    if os.stat(os.path.dirname(source)).st_dev != os.stat(os.path.dirname(dest)).st_dev:
+        config.vprint("Work directory is on another filesystem, so copying {} next to ~/.tarstall/bin".format(program_internal_name))
+        incoming = dest + ".tarstall-incoming"
+        if os.path.lexists(incoming):
+            _remove_tree(incoming)
+        file.move_tree(source, incoming)
+        source = incoming
+    versions = file.full("{}/{}".format(VERSIONS_DIR, program_internal_name))
+    versioned = config.read_config("VersionedInstalls")
+    config.vprint("Recording files of {}".format(program_internal_name))
+    entries = manifest.scan(source, hashes=versioned or store.enabled())  # The store reuses the manifest's hashes
+    if versioned and os.path.lexists(dest):  # Otherwise the old tree is deleted right after the switch
+        manifest.link_unchanged(source, program_internal_name, entries)
+    if versioned:
+        os.makedirs(versions, exist_ok=True)
+        numbers = [int(v) for v in os.listdir(versions) if v.isdigit()]
+        number = max(numbers, default=0) + 1
+        config.vprint("Switching {} to version {}".format(program_internal_name, number))
+        os.rename(source, os.path.join(versions, str(number)))
+        link = dest + ".tarstall-new"
+        if os.path.lexists(link):
+            _remove_tree(link)
+        os.symlink(os.path.join(versions, str(number)), link)
+        if os.path.islink(dest) or not os.path.lexists(dest):
+            os.replace(link, dest)
+        else:  # Moving an existing install over to versions
+            file.exchange(link, dest)
+            _remove_tree(link)
+        for old in sorted(numbers + [number])[:-KEEP_VERSIONS]:
+            config.vprint("Removing old version {} of {}".format(old, program_internal_name))
+            rmtree(os.path.join(versions, str(old)))
+    else:
+        if not os.path.lexists(dest):
+            os.rename(source, dest)
+        else:
+            config.vprint("Switching {} to its new files".format(program_internal_name))
+            file.exchange(source, dest)
+            _remove_tree(source)  # The old version is now here
+        if os.path.isdir(versions):
+            rmtree(versions)
+    manifest.write(program_internal_name, entries)
+
+
+def _remove_program_files(program):
+    """Remove the files of a program, including every kept version."""
+    _remove_tree(file.full("~/.tarstall/bin/" + program))
+    manifest.remove(program)
+    versions = file.full("{}/{}".format(VERSIONS_DIR, program))
+    if os.path.isdir(versions):
+        rmtree(versions)
+
+
+def _move_program_files(program, new_name):
+    """Move the files of a program, including every kept version, to new_name."""
+    dest = file.full("~/.tarstall/bin/" + program)
+    new_dest = file.full("~/.tarstall/bin/" + new_name)
+    manifest.rename(program, new_name)
+    if os.path.islink(dest):
+        new_versions = file.full("{}/{}".format(VERSIONS_DIR, new_name))
+        move(file.full("{}/{}".format(VERSIONS_DIR, program)), new_versions)
+        os.symlink(os.path.join(new_versions, os.path.basename(os.readlink(dest))), new_dest)
+        os.remove(dest)
+    else:
+        move(dest, new_dest)
 
 
 def add_upgrade_url(program, url, type_in=None):
@@ -54,8 +163,12 @@ def add_upgrade_url(program, url, type_in=None):
             return "Need Type"
     elif type_in not in supported_types:
         return "Bad Type"
+    journal.record("update_url", program, url=url, type=type_in)
     config.db["programs"][program]["update_url"] = url
     config.db["programs"][program]["update_archive_type"] = type_in
+    config.db["programs"][program]["update_validators"] = None
+    config.db["programs"][program]["sha256"] = None
+    config.db["programs"][program]["sha256_url"] = None
     config.write_db()
 
 
@@ -66,10 +179,81 @@ def remove_update_url(program):
         program (str): Program to remove URL of.
 
     """
+    journal.record("update_url", program, url=None)
     config.db["programs"][program]["update_url"] = None
+    config.db["programs"][program]["update_validators"] = None
+    config.db["programs"][program]["sha256"] = None
+    config.db["programs"][program]["sha256_url"] = None
+    config.write_db()
+
+
+def set_update_validators(program, validators):
+    """Set Update Validators.
+
+    Stores the ETag, Last-Modified, and size the server sent for a program's update_url, so the next
+    update only downloads the archive if it changed.
+
+    Args:
+        program (str): Program to set the validators of
+        validators (dict/None): Validators from generic_manage.Download, or None to forget them
+
+    """
+    journal.record("update_validators", program, validators=validators)
+    config.db["programs"][program]["update_validators"] = validators
+    config.write_db()
+
+
+def set_sha256(program, sha256, sha256_url=None):
+    """Set sha256.
+
+    Pins the sha256 of the archive a program is installed from. Every archive downloaded from its update_url
+    must then have this hash. If sha256_url is given, the hash is read from it on each update instead,
+    so the program updates whenever the hash there changes.
+
+    Args:
+        program (str): Program to set the sha256 of
+        sha256 (str/None): sha256 of the program's archive, or None to stop checking it
+        sha256_url (str): URL of a .sha256 file listing the hash of the update_url's archive. Defaults to None.
+
+    """
+    journal.record("sha256", program, sha256=sha256, url=sha256_url)
+    config.db["programs"][program]["sha256"] = sha256
+    config.db["programs"][program]["sha256_url"] = sha256_url
     config.write_db()
 
 
+def _read_sha256(sha256_url, url):
+    """Read sha256 File.
+
+    Reads the hash of the archive at url from a .sha256 file, as written by sha256sum. If the file lists
+    several files, the line naming the archive is used.
+
+    Args:
+        sha256_url (str): URL of the .sha256 file
+        url (str): URL of the archive
+
+    Returns:
+        str/None: sha256 of the archive, or None if the file doesn't have one
+
+    Raises:
+        OSError: If the .sha256 file couldn't be downloaded
+
+    """
+    download = generic_manage.Download(sha256_url)
+    try:
+        text = download.read(64 * 1024).decode(errors="replace")
+    finally:
+        download.close()
+    hashes = []
+    for line in text.splitlines():
+        parts = line.split()
+        if parts and re.fullmatch(r"[0-9a-fA-F]{64}", parts[0]):
+            if len(parts) > 1 and parts[1].lstrip("*") == url.rpartition("/")[2]:
+                return parts[0].lower()
+            hashes.append(parts[0].lower())
+    return hashes[0] if hashes else None
+
+
 def wget_program(program, show_progress=False, progress_modifier=1):
     """Wget an Archive and Overwrite Program.
 
@@ -79,44 +263,41 @@ def wget_program(program, show_progress=False, progress_modifier=1):
         progress_modifier (int): The number to divide the total progress by. Defaults to 1.
 
     Returns:
-        str: "No wget", "Wget error", "Install error" if install() fails, "Success" on success.
+        str: "Download error", "Install error" if install() fails, "No update" if the archive
+        didn't change since it was last downloaded, "Bad checksum" if the archive doesn't have the
+        program's sha256 (or its sha256 file has none), "Success" on success.
 
     """
-    if not file.check_bin("wget"):
-        return "No wget"
-    else:
-        config.vprint("Creating second temp folder for archive.")
+    generic.progress(10 / progress_modifier, show_progress)
+    info = config.db["programs"][program]
+    url = info["update_url"]
+    extension = info["update_archive_type"]
+    sha256 = info["sha256"]
+    if info["sha256_url"] is not None:
         try:
-            rmtree(file.full("/tmp/tarstall-temp2"))
-        except FileNotFoundError:
-            pass
-        os.mkdir("/tmp/tarstall-temp2")
-        os.chdir("/tmp/tarstall-temp2")
-        generic.progress(10 / progress_modifier, show_progress)
-        config.vprint("Downloading archive...")
-        url = config.db["programs"][program]["update_url"]
-        extension = config.db["programs"][program]["update_archive_type"]
-        err = wget_with_progress(url, 10 / progress_modifier, 65 / progress_modifier, show_progress=show_progress)
-        if err != 0:
-            return "Wget error"
-        generic.progress(65 / progress_modifier, show_progress)
-        files = os.listdir()
-        config.vprint("Renaming archive")
-        os.rename("/tmp/tarstall-temp2/{}".format(files[0]), "/tmp/tarstall-temp2/{}".format(program + extension))
-        os.chdir("/tmp/")
-        generic.progress(70 / progress_modifier, show_progress)
-        config.vprint("Using install to install the program.")
-        inst_status = install("/tmp/tarstall-temp2/{}".format(program + extension), True, show_progress=False)[0]
-        generic.progress(95 / progress_modifier, show_progress)
-        try:
-            rmtree(file.full("/tmp/tarstall-temp2"))
-        except FileNotFoundError:
-            pass
-        generic.progress(100 / progress_modifier, show_progress)
-        if inst_status != "Installed":
-            return "Install error"
-        else:
-            return "Success"
+            sha256 = _read_sha256(info["sha256_url"], url)
+        except OSError as e:
+            config.vprint("Failed to download {}: {}".format(info["sha256_url"], e))
+            return "Download error"
+        if sha256 is None:
+            return "Bad checksum"
+    if sha256 is not None and sha256 == info["sha256"]:
+        config.vprint("The installed archive already has the sha256 {}".format(sha256))
+        return "No update"
+    validators = dict(info["update_validators"] or {})
+    status, sha256 = _download_install(url, program, extension, 10 / progress_modifier, 90 / progress_modifier,
+                                       show_progress, validators, sha256)
+    if status in ["Download error", "No update", "Bad checksum"]:
+        return status
+    elif status != "Installed":
+        return "Install error"
+    set_update_validators(program, validators)
+    if info["sha256_url"] is not None:
+        set_sha256(program, sha256, info["sha256_url"])
+    if store.enabled():
+        store.add_program(program)
+    generic.progress(100 / progress_modifier, show_progress)
+    return "Success"
 
 
 def update_program(program, show_progress=False):
@@ -131,47 +312,75 @@ def update_program(program, show_progress=False):
         from update_git_program if the program supplied is a
         git installed program. Can also return "OSError" if the supplied
         script doesn't specify the shell to be used. Can also return
-        something from wget_program().
+        something from wget_program(), "Locked" if another tarstall is working
+        on the program, or "Not installed" if it was uninstalled meanwhile.
 
     """
-    progs = 0
-    if config.db["programs"][program]["install_type"] == "git" or config.db["programs"][program]["update_url"] is not None:
-        progs += 1
-    if config.db["programs"][program]["post_upgrade_script"] is not None:
-        if not file.exists(config.db["programs"][program]["post_upgrade_script"]):
-            config.db["programs"][program]["post_upgrade_script"] = None
-            config.write_db()
-            return "No script"
-        else:
-            progs += 1
-    if config.db["programs"][program]["install_type"] == "git":
-        status = update_git_program(program, show_progress, progs)
-        if status != "Success" and status != "No update":
-            return status
-        elif config.db["programs"][program]["post_upgrade_script"] is None:
-            return status
-        elif status == "No update":
-            generic.progress(100, show_progress)
-            return status
-    elif config.db["programs"][program]["update_url"] is not None:
-        status = wget_program(program, show_progress, progs)
-        if status != "Success":
-            return status
-        elif config.db["programs"][program]["post_upgrade_script"] is None:
-            return status
-    if config.db["programs"][program]["post_upgrade_script"] is not None:
-        try:
-            generic.progress(50 * (progs - 1), show_progress)
-            err = call(config.db["programs"][program]["post_upgrade_script"],
-                       cwd=file.full("~/.tarstall/bin/{}".format(program)), stdout=c_out)
-            generic.progress(100, show_progress)
-            if err != 0:
-                return "Script error"
-            else:
-                return "Success"
-        except OSError:
-            return "OSError"
-    return "Does not update"
+    with _locked(program) as locked:
+        if not locked:
+            return "Locked"
+        elif program not in config.db["programs"]:
+            return "Not installed"
+        with config.transaction():
+            progs = 0
+            if config.db["programs"][program]["install_type"] == "git" or config.db["programs"][program]["update_url"] is not None:
+                progs += 1
+            if config.db["programs"][program]["post_upgrade_script"] is not None:
+                if not file.exists(config.db["programs"][program]["post_upgrade_script"]):
+                    journal.record("update_script", program, script=None)
+                    config.db["programs"][program]["post_upgrade_script"] = None
+                    config.write_db()
+                    return "No script"
+                else:
+                    progs += 1
+            if config.db["programs"][program]["install_type"] == "git":
+                status = update_git_program(program, show_progress, progs)
+                if status == "Success":
+                    manifest.record(program)
+                    if store.enabled():
+                        store.add_program(program)
+                    _sync_updated_shims()
+                if status != "Success" and status != "No update":
+                    return status
+                elif config.db["programs"][program]["post_upgrade_script"] is None:
+                    return status
+                elif status == "No update":
+                    generic.progress(100, show_progress)
+                    return status
+            elif config.db["programs"][program]["update_url"] is not None:
+                status = wget_program(program, show_progress, progs)
+                if status == "No update":
+                    generic.progress(100, show_progress)
+                    return status
+                elif status != "Success":
+                    return status
+                elif config.db["programs"][program]["post_upgrade_script"] is None:
+                    return status
+            if config.db["programs"][program]["post_upgrade_script"] is not None:
+                try:
+                    generic.progress(50 * (progs - 1), show_progress)
+                    err = call(config.db["programs"][program]["post_upgrade_script"],
+                               cwd=file.full("~/.tarstall/bin/{}".format(program)), stdout=generic_manage.c_out)
+                    generic.progress(100, show_progress)
+                    if err != 0:
+                        return "Script error"
+                    else:
+                        manifest.record(program)  # Scripts often build the program
+                        _sync_updated_shims()
+                        return "Success"
+                except OSError:
+                    return "OSError"
+            return "Does not update"
+
+
+def _sync_updated_shims():
+    """Resynchronize shims after a git pull or post-upgrade script, which can add or remove executables.
+
+    These updates don't change the database, so writing it won't resynchronize the shims.
+
+    """
+    if shell.use_shims(config.db):
+        shell.sync_shims(config.db)
 
 
 def update_script(program, script_path):
@@ -188,10 +397,12 @@ def update_script(program, script_path):
 
     """
     if script_path == "":
+        journal.record("update_script", program, script=None)
         config.db["programs"][program]["post_upgrade_script"] = None
         return "Wiped"
     if not file.exists(file.full(script_path)):
         return "Bad path"
+    journal.record("update_script", program, script=file.full(script_path))
     config.db["programs"][program]["post_upgrade_script"] = file.full(script_path)
     config.write_db()
     return "Success"
@@ -241,18 +452,17 @@ def update_programs():
         It can also return "No programs" if no programs are installed.
 
     """
-    if len(config.db["programs"].keys()) == 0:
+    if len(config.db["programs"]) == 0:
         return "No programs"
     if not file.check_bin("git"):
         return "No git"
-    increment = int(100 / len(config.db["programs"].keys()))
+    increment = int(100 / len(config.db["programs"]))
     progress = 0
     statuses = {}
     generic.progress(progress)
-    for p in config.db["programs"].keys():
-        if not config.db["programs"][p]["update_url"] and (config.db["programs"][p]["install_type"] == "git" or config.db["programs"][p]["post_upgrade_script"]):
-            statuses[p] = update_program(p, False)
-        elif (config.db["programs"][p]["update_url"] and config.read_config("UpdateURLPrograms")):
+    to_update = set(updatable_programs(config.read_config("UpdateURLPrograms")))
+    for p in config.db["programs"]:
+        if p in to_update:
             statuses[p] = update_program(p, False)
         else:
             statuses[p] = "Does not update"
@@ -263,6 +473,29 @@ def update_programs():
     return statuses
 
 
+def updatable_programs(include_urls=False):
+    """Get Updatable Programs.
+
+    Args:
+        include_urls (bool): Whether to include programs that update from a URL. Defaults to False.
+
+    Returns:
+        str[]: Programs that are installed through git, have an upgrade script, or have an update URL
+        (if include_urls is True).
+
+    """
+    programs = config.db["programs"]
+    if isinstance(programs, sqlite_db.LazyPrograms):
+        return programs.updatable(include_urls)
+    to_update = []
+    for p in programs:
+        if not programs[p]["update_url"] and (programs[p]["install_type"] == "git" or programs[p]["post_upgrade_script"]):
+            to_update.append(p)
+        elif programs[p]["update_url"] and include_urls:
+            to_update.append(p)
+    return to_update
+
+
 def change_git_branch(program, branch):
     """Change Git Program's Branch.
 
@@ -276,26 +509,38 @@ def change_git_branch(program, branch):
     """
     if not file.check_bin("git"):
         return "No git"
-    err = call(["git", "checkout", "-f", branch], cwd=file.full("~/.tarstall/bin/{}".format(program)), stdout=c_out)
+    err = call(["git", "checkout", "-f", branch], cwd=file.full("~/.tarstall/bin/{}".format(program)), stdout=generic_manage.c_out)
     if err != 0:
         return "Error changing"
     else:
         return "Success"
 
 
-def install(path, overwrite=None, show_progress=True, override_name=None):
-    """Install a Program.
+@contextmanager
+def _locked(programs):
+    """Hold the locks of programs (see file.program_lock()), re-reading the database once they're held.
+
+    Yields:
+        bool: Whether every program was locked
+
+    """
+    with file.program_lock(programs) as locked:
+        if locked:
+            config.refresh_db()
+        yield locked
 
-    Allows installing an archive, a directory, a single file, or a link to a git repo.
+
+def _classify(path, override_name=None):
+    """Classify Install.
 
     Args:
         path (str): The path to the file or the URL.
-        overwrite (bool/None): See above
-        show_progress: Whether to show installation progress or not.
-        override_name (str): The name for the program if using a wget install
+        override_name (str): The name for the program, or None to work it out from path
 
     Returns:
-        (str, str): A status from the installation method and the program's internal name.
+        (str, str, str, str): A status ("Bad URL", "Bad file", "Needs name", or None if the program can be
+        installed), the install type, path (with a / added to directories), and the program's internal name.
+
     """
     is_url = path.startswith("http://") or path.startswith("https://")
     prog_type = None
@@ -307,10 +552,10 @@ def install(path, overwrite=None, show_progress=True, override_name=None):
                 prog_type = "wget"
                 break
         if prog_type is None:
-            return "Bad URL", None
+            return "Bad URL", None, path, None
     else:
         if not file.exists(path):
-            return "Bad file", None
+            return "Bad file", None, path, None
 
         if os.path.isdir(path):
             prog_type = "dir"
@@ -329,34 +574,274 @@ def install(path, overwrite=None, show_progress=True, override_name=None):
     else:
         program_internal_name = file.name(path)
     if prog_type == "wget" and override_name is None:
-        return "Needs name", None
-    if program_internal_name in config.db["programs"]:
-        if overwrite is None:
-            return "Application exists", None
-        else:
-            if not overwrite:
-                uninstall(program_internal_name, show_progress=False)
-                return (_install(path, prog_type, program_internal_name, False, True, show_progress),
-                        program_internal_name)
-            elif overwrite:
-                return (_install(path, prog_type, program_internal_name, True, True, show_progress),
+        return "Needs name", prog_type, path, None
+    return None, prog_type, path, program_internal_name
+
+
+def install(path, overwrite=None, show_progress=True, override_name=None, sha256=None):
+    """Install a Program.
+
+    Allows installing an archive, a directory, a single file, or a link to a git repo.
+
+    Args:
+        path (str): The path to the file or the URL.
+        overwrite (bool/None): See above
+        show_progress: Whether to show installation progress or not.
+        override_name (str): The name for the program if using a wget install
+        sha256 (str): For archive URLs, the sha256 the archive must have, or the URL of a .sha256 file
+        to read it from. See set_sha256().
+
+    Returns:
+        (str, str): A status from the installation method and the program's internal name. The status is
+        "Locked" if another tarstall is working on the program.
+    """
+    status, prog_type, path, program_internal_name = _classify(path, override_name)
+    if status is not None:
+        return status, None
+    with _locked(program_internal_name) as locked:
+        if not locked:
+            return "Locked", program_internal_name
+        with config.transaction():
+            if program_internal_name in config.db["programs"]:
+                if overwrite is None:
+                    return "Application exists", None
+                else:
+                    if not overwrite:
+                        uninstall(program_internal_name, show_progress=False)
+                        return (_install(path, prog_type, program_internal_name, False, True, show_progress, sha256),
+                                program_internal_name)
+                    elif overwrite:
+                        return (_install(path, prog_type, program_internal_name, True, True, show_progress, sha256),
+                                program_internal_name)
+            else:
+                return (_install(path, prog_type, program_internal_name, False, False, show_progress, sha256),
                         program_internal_name)
-    else:
-        return (_install(path, prog_type, program_internal_name, False, False, show_progress),
-                program_internal_name)
 
 
-def _install(program, program_type, program_internal_name, overwrite=False, reinstall=False, show_progress=True):
+def _install(program, program_type, program_internal_name, overwrite=False, reinstall=False, show_progress=True,
+             sha256=None):
     if program_type == "git":
-        return _git_install(program, program_internal_name, overwrite=overwrite, reinstall=reinstall)
+        status = _git_install(program, program_internal_name, overwrite=overwrite, reinstall=reinstall)
     elif program_type == "single":
-        return _single_install(program, program_internal_name, reinstall=reinstall)
+        status = _single_install(program, program_internal_name)
     elif program_type == "dir":
-        return _dir_install(program, program_internal_name, overwrite=overwrite, reinstall=reinstall)
+        status = _dir_install(program, program_internal_name, overwrite=overwrite)
     elif program_type == "archive":
-        return _archive_install(program, program_internal_name=program_internal_name, overwrite=overwrite, reinstall=reinstall, show_progress=show_progress)
+        status = _archive_install(program, program_internal_name=program_internal_name, overwrite=overwrite, reinstall=reinstall, show_progress=show_progress)
     elif program_type == "wget":
-        return _wget_install(program, program_internal_name, overwrite=overwrite, reinstall=reinstall)
+        status = _wget_install(program, program_internal_name, overwrite=overwrite, reinstall=reinstall, sha256=sha256)
+    if status == "Installed" and store.enabled():
+        config.vprint("Adding program to the store")
+        store.add_program(program_internal_name)
+    return status
+
+def read_batch_file(list_path):
+    """Read Batch File.
+
+    Reads a list of programs to install, one per line. Each line is a path or URL, optionally followed
+    by a space and the name to install the program as. Blank lines and lines starting with # are skipped.
+
+    Args:
+        list_path (str): Path to the list
+
+    Returns:
+        (str, str)[]: Paths and names (or None) to hand to install_batch(), or None if the list doesn't exist.
+
+    """
+    if not file.exists(list_path):
+        return None
+    programs = []
+    with open(file.full(list_path)) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            parts = line.split(maxsplit=1)
+            programs.append((parts[0], parts[1] if len(parts) > 1 else None))
+    return programs
+
+
+def _batch_download(job, threads):
+    """Download a batch install job's program, if it comes from the internet.
+
+    .tar.gz and .tar.xz archives are extracted as they download, so they skip the extraction pool.
+    Archives in the download cache that the server says are still current aren't downloaded at all.
+
+    """
+    if job["type"] == "wget":
+        if file.char_check(job["name"]):
+            return "Bad name"
+        config.vprint("Downloading {}".format(job["path"]))
+        job["url"] = job["path"]
+        job["path"] = os.path.join(job["dir"], "download" + job["extension"])
+        cached_path = os.path.join(job["dir"], "cached" + job["extension"])
+        cached = cache.lookup(job["url"]) if cache.enabled() else None
+        asked = cached["validators"] if cached is not None else None
+        hasher = hashlib.sha256()
+        streamed = job["extension"] in archive.STREAM_EXTENSIONS
+        status, job["validators"] = _fetch_archive(job["url"], job["extension"], job["path"], job["tree"], asked, hasher,
+                                                   streamed, threads=threads)
+        if job["validators"] is None:
+            if cache.fetch_hash(cached["sha256"], job["extension"], cached_path):
+                config.vprint("Using the cached archive of {}".format(job["url"]))
+                job["path"] = cached_path
+                job["validators"] = cached["validators"]
+                job["type"] = "archive"
+                return None
+            config.vprint("The cached archive of {} was removed, downloading it again".format(job["url"]))
+            status, job["validators"] = _fetch_archive(job["url"], job["extension"], job["path"], job["tree"], None,
+                                                       hasher, streamed, threads=threads)
+        if status not in ["Downloaded", "Extracted"]:
+            return "Error"
+        job["type"] = "streamed" if status == "Extracted" else "archive"
+        job["sha256"] = hasher.hexdigest()
+    elif job["type"] == "git":
+        if not file.check_bin("git"):
+            return "No git"
+        config.vprint("Cloning {}".format(job["path"]))
+        os.mkdir(job["tree"])
+        if git_clone_with_progress(job["path"], 0, 0, cwd=job["tree"], show_progress=False) != 0:
+            return "Error"
+    return None
+
+
+def _batch_build(job, threads):
+    """Build a batch install job's program tree in its staging directory, ready to be placed."""
+    name = job["name"]
+    if job["type"] == "archive":
+        if file.char_check(name):
+            return "Bad name"
+        os.mkdir(job["tree"])
+        config.vprint("Extracting {}".format(job["path"]))
+        if job["extension"] in archive.NATIVE_EXTENSIONS:
+            if archive.extract(job["path"], job["tree"], show_progress=False, threads=threads) != "Extracted":
+                return "Error"
+        else:
+            command_to_go = create_command(job["extension"], file.spaceify(file.full(job["path"])), file.spaceify(job["tree"]) + "/")
+            if command_to_go.startswith("No") or command_to_go == "Bad Filetype":
+                return command_to_go
+            if os.system(command_to_go) != 0:
+                return "Error"
+        job["root"] = archive.program_root(job["tree"], name)
+    elif job["type"] == "streamed":
+        job["root"] = archive.program_root(job["tree"], name)
+    elif job["type"] == "git":
+        job["root"] = os.path.join(job["tree"], os.listdir(job["tree"])[0])
+    elif job["type"] == "single":
+        job["root"] = os.path.join(job["tree"], name)
+        os.makedirs(job["root"])
+        path = file.full(job["path"])
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        file.move_tree(path, os.path.join(job["root"], name))
+    elif job["type"] == "dir":
+        os.mkdir(job["tree"])
+        job["root"] = os.path.join(job["tree"], name)
+        file.move_tree(job["path"], job["root"])
+    return None
+
+
+def _batch_fetch(job, extract_pool, threads, done):
+    try:
+        job["status"] = _batch_download(job, threads)
+    except Exception as e:  # Anything uncaught would leave install_batch() waiting on this job forever
+        config.vprint("Failed to download {}: {}".format(job["url"] or job["path"], e))
+        job["status"] = "Error"
+    if job["status"] is None:
+        extract_pool.submit(_batch_extract, job, threads, done)
+    else:
+        done.put(job)
+
+
+def _batch_extract(job, threads, done):
+    try:
+        job["status"] = _batch_build(job, threads)
+    except Exception as e:  # Anything uncaught would leave install_batch() waiting on this job forever
+        config.vprint("Failed to prepare {}: {}".format(job["path"], e))
+        job["status"] = "Error"
+    finally:
+        done.put(job)
+
+
+def install_batch(programs, show_progress=True):
+    """Install Batch.
+
+    Installs many programs at once as a pipeline: downloads run in one pool of threads, extractions in
+    another, and this thread moves each finished program into place. One program can be downloading while
+    another is extracting and a third is being moved. The database and shell files are only written once,
+    after every program is installed.
+
+    Programs that are already installed are skipped. Archive URLs without a name are named after the archive.
+    Every program is locked for the whole batch; if another tarstall holds any of them, nothing is installed.
+
+    Args:
+        programs ((str, str)[]): Paths/URLs of programs to install, each with the name to install it as, or None
+        show_progress (bool): Whether to show progress. Defaults to True.
+
+    Returns:
+        (str, str, str)[]: For each program, in order: its path/URL, a status ("Installed", or a status from
+        install() or the installation methods), and its internal name
+
+    """
+    jobs = []
+    for path, override_name in programs:
+        status, prog_type, path, program_internal_name = _classify(path, override_name)
+        if status == "Needs name":
+            program_internal_name = file.name(path.rstrip("/"))
+            status = None
+        jobs.append({"path": path, "type": prog_type, "name": program_internal_name, "status": status,
+                     "extension": file.extension(path), "url": None, "validators": None, "sha256": None})
+    with _locked([job["name"] for job in jobs if job["status"] is None]) as locked:
+        with config.transaction():
+            names = set()
+            for job in jobs:
+                if job["status"] is not None:
+                    continue
+                elif not locked:
+                    job["status"] = "Locked"
+                elif job["name"] in config.db["programs"] or job["name"] in names:
+                    job["status"] = "Application exists"
+                else:
+                    names.add(job["name"])
+            to_run = [job for job in jobs if job["status"] is None]
+            with config.workspace("batch") as workspace:
+                return _run_batch(jobs, to_run, workspace, show_progress)
+
+
+def _run_batch(jobs, to_run, workspace, show_progress):
+    """Run the jobs of install_batch() through its pipeline, using workspace for their files."""
+    for job in to_run:
+        job["dir"] = os.path.join(workspace, job["name"])
+        job["tree"] = os.path.join(job["dir"], "tree")
+        os.mkdir(job["dir"])
+    extract_workers = max(min(archive.extract_threads(), len(to_run)), 1)
+    threads = max(archive.extract_threads() // extract_workers, 1)
+    done = queue.Queue()
+    with ThreadPoolExecutor(max_workers=extract_workers) as extract_pool:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_pool:
+            for job in to_run:
+                if job["type"] in ["wget", "git"]:
+                    download_pool.submit(_batch_fetch, job, extract_pool, threads, done)
+                else:
+                    extract_pool.submit(_batch_extract, job, threads, done)
+            for finished in range(1, len(to_run) + 1):
+                job = done.get()
+                if job["status"] is None:
+                    config.vprint("Moving {} into place".format(job["name"]))
+                    _place_program(job["root"], job["name"])
+                    install_type = {"single": "single", "git": "git"}.get(job["type"], "default")
+                    job["status"] = finish_install(job["name"], install_type, show_progress=False)
+                    if job["url"] is not None:
+                        add_upgrade_url(job["name"], job["url"], job["extension"])
+                        set_update_validators(job["name"], job["validators"])
+                        if job["sha256"] is not None:
+                            cache.add(os.path.join(job["dir"], "download" + job["extension"]), job["url"],
+                                      job["sha256"], job["extension"], job["validators"])
+                    if store.enabled():
+                        store.add_program(job["name"])
+                rmtree(job["dir"], ignore_errors=True)
+                generic.progress(100 * finished / len(to_run), show_progress)
+    return [(job["url"] or job["path"], job["status"], job["name"]) for job in jobs]
+
 
 def remove_desktop(program, desktop):
     """Remove .desktop
@@ -373,6 +858,7 @@ def remove_desktop(program, desktop):
         os.remove(file.full("~/.local/share/applications/tarstall/{}.desktop".format(desktop)))
     except FileNotFoundError:
         pass
+    journal.record("remove_desktop", program, name=desktop)
     config.db["programs"][program]["desktops"].remove(desktop)
     config.write_db()
 
@@ -389,14 +875,36 @@ def remove_paths_and_binlinks(program):
     """
     if not config.db["programs"][program]["has_path"] and config.db["programs"][program]["binlinks"] == []:
         return "None exist"
-    file.remove_line(program, "~/.tarstall/.bashrc", 'poundword')
-    file.remove_line(program, "~/.tarstall/.fishrc", 'poundword')
+    journal.record("remove_paths", program)
     config.db["programs"][program]["has_path"] = False
     config.db["programs"][program]["binlinks"] = []
+    config.db["programs"][program]["binlink_files"] = {}
     config.write_db()
     return "Complete"
 
 
+def _rename_files(program, new_name, is_single, desktops):
+    """Move a program's files, .desktop files, and manifest over to new_name."""
+    old_dir = "/.tarstall/bin/{}".format(program)
+    new_dir = "/.tarstall/bin/{}".format(new_name)
+    rules = [(old_dir, lambda l: l.replace(old_dir, new_dir))]
+    if is_single:
+        rules.append((new_dir + "/" + program, lambda l: l.replace(new_dir + "/" + program, new_dir + "/" + new_name)))
+    for d in desktops:
+        file.rewrite_file("~/.local/share/applications/tarstall/{}.desktop".format(d), rules)
+        if is_single:
+            move(file.full("~/.local/share/applications/tarstall/{p}-{p}.desktop".format(p=program)),
+                 file.full("~/.local/share/applications/tarstall/{p}-{p}.desktop".format(p=new_name)))
+    _move_program_files(program, new_name)
+    if is_single:
+        config.vprint("Renaming single-file")
+        move(file.full("~/.tarstall/bin/{}/{}".format(new_name, program)), file.full("~/.tarstall/bin/{}/{}".format(new_name, new_name)))
+        entries = manifest.read(new_name)
+        if entries is not None and program in entries:
+            entries[new_name] = entries.pop(program)
+            manifest.write(new_name, entries)
+
+
 def rename(program, new_name):
     """Rename Program.
 
@@ -404,52 +912,39 @@ def rename(program, new_name):
         program (str): Name of program to rename
 
     Returns:
-        str/None: New program name or None if program already exists
+        str/None: New program name, "Locked" if another tarstall is working on either name or held the
+        database, or None if program already exists
 
     """
-    is_single = config.db["programs"][program]["install_type"] == "single"
-    config.vprint("Checking that program name isn't already in use")
-    if new_name in config.db["programs"]:
-        return None
-    config.vprint("Updating .desktop files")
-    for d in config.db["programs"][program]["desktops"]:
-        file.replace_in_file("/.tarstall/bin/{}".format(program), "/.tarstall/bin/{}".format(new_name),
-        "~/.local/share/applications/tarstall/{}.desktop".format(d))
-        if is_single:
-            file.replace_in_file("/.tarstall/bin/{}/{}".format(new_name, program), "/.tarstall/bin/{}/{}".format(new_name, new_name),
-        "~/.local/share/applications/tarstall/{}.desktop".format(d))
-            move(file.full("~/.local/share/applications/tarstall/{p}-{p}.desktop".format(p=program)),
-                 file.full("~/.local/share/applications/tarstall/{p}-{p}.desktop".format(p=new_name)))
-    generic.progress(25)
-    config.vprint("Replacing PATHs")
-    config.db["programs"][new_name] = config.db["programs"].pop(program)
-    file.replace_in_file("export PATH=$PATH:~/.tarstall/bin/" + program,
-    "export PATH=$PATH:~/.tarstall/bin/" + new_name, "~/.tarstall/.bashrc")
-    file.replace_in_file("set PATH $PATH ~/.tarstall/bin/" + program + ' # ' + program,
-    "set PATH $PATH ~/.tarstall/bin/" + new_name + ' # ' + new_name, "~/.tarstall/.fishrc")
-    generic.progress(50)
-    config.vprint("Replacing binlinks")
-    file.replace_in_file("'cd " + file.full('~/.tarstall/bin/' + program),
-    "'cd " + file.full('~/.tarstall/bin/' + new_name), "~/.tarstall/.bashrc")
-    file.replace_in_file(";cd " + file.full("~/.tarstall/bin/" + program) + "/;./",
-    ";cd " + file.full("~/.tarstall/bin/" + new_name) + "/;./", "~/.tarstall/.fishrc")
-    if is_single:
-        file.replace_in_file("./" + program, "./" + new_name, "~/.tarstall/.bashrc")
-        file.replace_in_file("alias " + program, "alias " + new_name, "~/.tarstall/.bashrc")
-        file.replace_in_file("./" + program, "./" + new_name, "~/.tarstall/.fishrc")
-        file.replace_in_file("function " + program, "function " + new_name, "~/.tarstall/.fishrc")
-    generic.progress(75)
-    config.vprint("Replacing program recognisers")
-    file.replace_in_file("# " + program, "# " + new_name, "~/.tarstall/.bashrc")
-    file.replace_in_file("# " + program, "# " + new_name, "~/.tarstall/.fishrc")
-    move(file.full("~/.tarstall/bin/" + program), file.full("~/.tarstall/bin/" + new_name))
-    config.write_db()
-    generic.progress(90)
-    if is_single:
-        config.vprint("Renaming single-file")
-        move(file.full("~/.tarstall/bin/{}/{}".format(new_name, program)), file.full("~/.tarstall/bin/{}/{}".format(new_name, new_name)))
-    generic.progress(100)
-    return new_name
+    with _locked([program, new_name]) as locked:
+        if not locked:
+            return "Locked"
+        moved = False
+        try:
+            with config.transaction():
+                is_single = config.db["programs"][program]["install_type"] == "single"
+                desktops = list(config.db["programs"][program]["desktops"])
+                config.vprint("Checking that program name isn't already in use")
+                if new_name in config.db["programs"]:
+                    return None
+                config.vprint("Renaming program in database")
+                journal.record("rename", program, new_name=new_name)
+                config.db["programs"][new_name] = config.db["programs"].pop(program)
+                shell.rename_single_binlinks(config.db["programs"][new_name], program, new_name)
+                generic.progress(25)
+                config.vprint("Moving program files")
+                moved = True
+                _rename_files(program, new_name, is_single, desktops)
+                generic.progress(75)
+                config.write_db()
+                generic.progress(90)
+        except TimeoutError as e:  # Raised by file.db_lock() while writing the database, which was then reloaded
+            config.vprint("Couldn't rename {}: {}".format(program, e))
+            if moved:
+                _rename_files(new_name, program, is_single, desktops)
+            return "Locked"
+        generic.progress(100)
+        return new_name
 
 
 def finish_install(program_internal_name, install_type="default",
@@ -467,15 +962,13 @@ def finish_install(program_internal_name, install_type="default",
 
     """
     generic.progress(90, show_progress)
-    config.vprint("Removing temporary install directory (if it exists)")
-    try:
-        rmtree("/tmp/tarstall-temp")
-    except FileNotFoundError:
-        pass
     config.vprint("Adding program to tarstall list of programs")
     generic.progress(95, show_progress)
-    config.db["programs"].update({program_internal_name: {"install_type": install_type, "desktops": [],
-    "post_upgrade_script": None, "update_url": None, "has_path": False, "binlinks": []}})
+    info = {"install_type": install_type, "desktops": [], "post_upgrade_script": None, "update_url": None,
+            "has_path": False, "binlinks": [], "binlink_files": {}, "update_validators": None, "sha256": None,
+            "sha256_url": None}
+    journal.record("install", program_internal_name, info=info)
+    config.db["programs"].update({program_internal_name: info})
     config.write_db()
     generic.progress(100, show_progress)
     return "Installed"
@@ -543,6 +1036,7 @@ Categories={categories}
     with open(file.full("./{}.desktop".format(desktop_name)), 'w') as f:
         f.write(to_write)
     if program_internal_name is not None:
+        journal.record("desktop", program_internal_name, name=desktop_name)
         config.db["programs"][program_internal_name]["desktops"].append(desktop_name)
         config.write_db()
     return "Created"
@@ -559,28 +1053,17 @@ def _git_install(git_url, program_internal_name, overwrite=False, reinstall=Fals
         overwrite (bool): Whether or not to assume the program is already installed and to overwite it
 
     Returns:
-       str: A string from finish_install(), "No rsync", "Installed", or "Error"
+       str: A string from finish_install(), "Installed", or "Error"
 
     """
-    if not file.check_bin("rsync") and overwrite:
-        return "No rsync"
     config.vprint("Downloading git repository")
-    if overwrite:
-        try:
-            rmtree(file.full("/tmp/tarstall-temp"))  # Removes temp directory (used during installs)
-        except FileNotFoundError:
-            pass
-        os.mkdir("/tmp/tarstall-temp")
-        os.chdir("/tmp/tarstall-temp")
-    else:
-        os.chdir(file.full("~/.tarstall/bin"))
-    generic.progress(5)
-    err = git_clone_with_progress(git_url, 5, 65)
-    if err != 0:
-        return "Error"
-    generic.progress(65)
-    if overwrite:
-        call(["rsync", "-a", "/tmp/tarstall-temp/{}/".format(program_internal_name), file.full("~/.tarstall/bin/{}".format(program_internal_name))], stdout=c_out)
+    with config.workspace("git") as workspace:
+        generic.progress(5)
+        err = git_clone_with_progress(git_url, 5, 65, cwd=workspace)
+        if err != 0:
+            return "Error"
+        generic.progress(65)
+        _place_program(os.path.join(workspace, os.listdir(workspace)[0]), program_internal_name)
     if not overwrite:
         return finish_install(program_internal_name, "git")
     else:
@@ -605,13 +1088,10 @@ def add_binlink(file_chosen, program_internal_name):
         name = file.name(name)
     if name in config.db["programs"][program_internal_name]["binlinks"]:
         return "Already there"
-    line_to_add = '\nalias ' + name + "='cd " + file.full('~/.tarstall/bin/' + program_internal_name) + \
-    '/ && ./' + file_chosen + "' # " + program_internal_name
-    config.vprint("Adding alias to bashrc and fishrc")
-    file.add_line(line_to_add, "~/.tarstall/.bashrc")
-    line_to_add = "\nfunction " + name + ";cd " + file.full("~/.tarstall/bin/" + program_internal_name) + "/;./" + file_chosen + ";end # " + program_internal_name
-    file.add_line(line_to_add, "~/.tarstall/.fishrc")
+    config.vprint("Adding binlink to database")
+    journal.record("binlink", program_internal_name, name=name, file=file_chosen)
     config.db["programs"][program_internal_name]["binlinks"].append(name)
+    config.db["programs"][program_internal_name].setdefault("binlink_files", {})[name] = file_chosen
     config.write_db()
     return "Added"
 
@@ -619,7 +1099,8 @@ def add_binlink(file_chosen, program_internal_name):
 def pathify(program_internal_name):
     """Add Program to Path.
 
-    Adds a program to PATH through ~/.tarstall/.bashrc and ~/.tarstall/.fishrc
+    Adds a program to PATH through ~/.tarstall/.bashrc and ~/.tarstall/.fishrc, or through ~/.tarstall/shims
+    if UseShims is enabled
 
     Args:
         program_internal_name (str): Name of program to add to PATH
@@ -631,22 +1112,19 @@ def pathify(program_internal_name):
     if config.db["programs"][program_internal_name]["has_path"]:
         return "Already there"
     config.vprint('Adding program to PATH')
-    line_to_write = "\nexport PATH=$PATH:~/.tarstall/bin/" + program_internal_name + ' # ' + program_internal_name
-    file.add_line(line_to_write, "~/.tarstall/.bashrc")
-    line_to_write = "\nset PATH $PATH ~/.tarstall/bin/" + program_internal_name + ' # ' + program_internal_name
-    file.add_line(line_to_write, "~/.tarstall/.fishrc")
+    journal.record("pathify", program_internal_name)
     config.db["programs"][program_internal_name]["has_path"] = True
     config.write_db()
     return "Complete"
 
 
-def create_command(file_extension, program):
+def create_command(file_extension, program, dest):
     """Create Extraction Command.
 
     Args:
         file_extension (str): File extension of program (including .)
         program (str): Program name
-        overwrite_files (bool): Whether or not the command should overwrite files. Defaults to False.
+        dest (str): Directory to extract to, with a trailing slash
 
     Returns:
         str: Command to run, "Bad Filetype", or "No bin_that_is_needed"
@@ -671,22 +1149,22 @@ def create_command(file_extension, program):
         elif file_extension == '.rar':
             vflag = '-idcdpq '
     if file_extension == '.tar.gz' or file_extension == '.tar.xz':
-        command_to_go = "tar " + vflag + "xf " + program + " -C /tmp/tarstall-temp/"
+        command_to_go = "tar " + vflag + "xf " + program + " -C " + dest
         if which("tar") is None:
             config.vprint("tar not installed!")
             return "No tar"
     elif file_extension == '.zip':
-        command_to_go = 'unzip ' + vflag + ' ' + program + ' -d /tmp/tarstall-temp/'
+        command_to_go = 'unzip ' + vflag + ' ' + program + ' -d ' + dest
         if which("unzip") is None:
             config.vprint("unzip not installed!")
             return "No unzip"
     elif file_extension == '.7z':
-        command_to_go = '7z x ' + vflag + program + ' -o/tmp/tarstall-temp/'
+        command_to_go = '7z x ' + vflag + program + ' -o' + dest
         if which("7z") is None:
             config.vprint("7z not installed!")
             return "No 7z"
     elif file_extension == '.rar':
-        command_to_go = 'unrar x ' + vflag + program + ' /tmp/tarstall-temp/'
+        command_to_go = 'unrar x ' + vflag + program + ' ' + dest
         if which("unrar") is None:
             config.vprint("unrar not installed!")
             return "No unrar"
@@ -697,58 +1175,213 @@ def create_command(file_extension, program):
     return command_to_go
 
 
-def _wget_install(url, program_internal_name, reinstall=False, overwrite=False):
-    if not file.check_bin("wget"):
-        return "No wget"
-    if reinstall:
-        try:
-            config.vprint("Removing old copy of program to reinstall (if it exists!)")
-            rmtree("~/.tarstall/bin/{}".format(program_internal_name))
-        except FileNotFoundError:
-            pass
-    config.vprint("Creating temporary folder")
-    try:
-        rmtree(file.full("/tmp/tarstall-temp2"))
-    except FileNotFoundError:
-        pass
-    os.mkdir("/tmp/tarstall-temp2")
-    os.chdir("/tmp/tarstall-temp2")
-    generic.progress(10)
-    config.vprint("Downloading archive...")
-
+def _wget_install(url, program_internal_name, reinstall=False, overwrite=False, sha256=None):
     extension = None
     for typ in ["7z", "rar", "zip", "tar.gz", "tar.xz"]:
         if url.endswith(typ):
             extension = "." + typ
             break
     if extension is None:
-        return "Bad URL", None
+        return "Bad URL"
+    sha256_url = None
+    if sha256 is not None and re.match(r"https?://", sha256):
+        sha256_url = sha256
+        try:
+            sha256 = _read_sha256(sha256_url, url)
+        except OSError as e:
+            config.vprint("Failed to download {}: {}".format(sha256_url, e))
+            return "Download error"
+        if sha256 is None:
+            return "Bad checksum"
+    elif sha256 is not None:
+        if not re.fullmatch(r"[0-9a-fA-F]{64}", sha256):
+            return "Bad sha256"
+        sha256 = sha256.lower()
+    generic.progress(10)
+    validators = {}
+    status, archive_sha256 = _download_install(url, program_internal_name, extension, 10, 80, validators=validators,
+                                               sha256=sha256)
+    if status != "Installed":
+        return status
+    if not overwrite:
+        finish_install(program_internal_name)
+    config.vprint("Automatically adding update URL to be install URL")
+    add_upgrade_url(program_internal_name, url, extension)
+    set_update_validators(program_internal_name, validators)
+    if sha256 is not None:
+        set_sha256(program_internal_name, sha256, sha256_url)
+    generic.progress(100)
+    return "Installed"
 
-    err = wget_with_progress(url, 10, 65, show_progress=True)
-    if err != 0:
-        return "Wget error"
 
-    config.vprint("Renaming archive")
-    files = os.listdir()
-    os.rename("/tmp/tarstall-temp2/{}".format(files[0]), "/tmp/tarstall-temp2/{}".format(program_internal_name + extension))
-    os.chdir("/tmp/")
-    generic.progress(70)
+def _extract_archive(program, dest, start_percent=15, end_percent=50, show_progress=True):
+    """Extract Archive.
 
-    config.vprint("Re-running installer with archive to finish installation")
+    Args:
+        program (str): Path to archive to extract
+        dest (str): Directory to extract into
+        start_percent (int): Where generic.progress() last was. Defaults to 15.
+        end_percent (int): Where generic.progress() should end up. Defaults to 50.
+        show_progress (bool): Whether to show progress. Defaults to True.
 
-    inst_status = install("/tmp/tarstall-temp2/{}".format(program_internal_name + extension), overwrite=overwrite, show_progress=False)[0]
-    generic.progress(95)
+    Returns:
+        str: "Extracted", "Error", or a string from create_command().
+
+    """
+    file_extension = file.extension(program)
+    config.vprint('File type detected: ' + file_extension)
+    if file_extension in archive.NATIVE_EXTENSIONS:
+        config.vprint("Extracting archive to staging directory")
+        if archive.extract(program, dest, start_percent, end_percent, show_progress) != "Extracted":
+            config.vprint("Failed to extract archive! Program installation halted!")
+            return "Error"
+    else:
+        config.vprint("Extracting archive to staging directory with an external program")
+        command_to_go = create_command(file_extension, file.spaceify(program), file.spaceify(dest) + "/")
+        if command_to_go.startswith("No") or command_to_go == "Bad Filetype":
+            return command_to_go
+        try:
+            os.system(command_to_go)  # Extracts program archive
+        except:
+            config.vprint('Failed to run command: ' + command_to_go + "! Program installation halted!")
+            return "Error"
+    generic.progress(end_percent, show_progress)
+    return "Extracted"
+
+
+def _download_install(url, program_internal_name, extension, start_percent=10, end_percent=80, show_progress=True,
+                      validators=None, sha256=None):
+    """Download and Place Program.
+
+    Downloads an archive and makes it the program's files. .tar.gz and .tar.xz archives are extracted
+    while they download, so they're never written to disk. Other archives are downloaded into the staging
+    directory, then extracted.
+
+    If validators are given, the archive is only downloaded if the server says it changed since they were
+    stored, and they're replaced with the validators of the new download. Archives are also kept in the
+    download cache, and a cached archive the server says is still current is used instead of downloading it.
+
+    If sha256 is given, the archive is hashed as it downloads, and installing stops if it doesn't match. Archives
+    downloaded to a file are checked before they're extracted. Streamed archives are checked after extracting
+    into the staging directory, but before anything is placed. A cached archive with the hash isn't downloaded.
+
+    Args:
+        url (str): URL of the archive
+        program_internal_name (str): Name of program
+        extension (str): Extension of the archive (including .)
+        start_percent (int): Where generic.progress() last was. Defaults to 10.
+        end_percent (int): Where generic.progress() should end up. Defaults to 80.
+        show_progress (bool): Whether to show progress. Defaults to True.
+        validators (dict): Validators from an earlier download of url, updated in place. Defaults to None.
+        sha256 (str): sha256 the archive must have. Defaults to None.
+
+    Returns:
+        (str, str): "Installed", "Bad name", "Download error", "No update", "Bad checksum", "Error", or a string
+        from create_command(), and the sha256 of the archive (or None if it wasn't installed).
+
+    """
+    if file.char_check(program_internal_name):
+        return "Bad name", None
+    with config.workspace("download") as workspace:
+        return _download_place(url, program_internal_name, extension, start_percent, end_percent, show_progress,
+                               workspace, validators, sha256)
+
+
+def _fetch_archive(url, extension, archive_path, tree, validators, hasher, streamed, start_percent=0, end_percent=100,
+                   show_progress=False, threads=None):
+    """Fetch Archive.
+
+    Downloads an archive to archive_path or, if streamed, extracts it into tree as it downloads, also saving
+    it to archive_path if the download cache is in use.
+
+    Returns:
+        (str, dict/None): "Downloaded", "Extracted", or an error from archive.extract_stream(), and the
+        Download.validators of the archive, or None if it didn't change from validators (and wasn't downloaded)
+
+    Raises:
+        OSError: If the download failed
+
+    """
+    if not streamed:
+        new_validators = generic_manage.download(url, archive_path, start_percent, end_percent, show_progress,
+                                                 hasher, validators)
+        return "Downloaded", new_validators
+    download = generic_manage.Download(url, validators=validators)
+    recorder = None
     try:
-        rmtree(file.full("/tmp/tarstall-temp2"))
-    except FileNotFoundError:
-        pass
-    generic.progress(100)
-    if inst_status != "Installed":
-        return "Error"
+        if download.not_modified:
+            return "Downloaded", None
+        os.makedirs(tree, exist_ok=True)
+        reader = download
+        if cache.enabled():
+            reader = recorder = cache.Recorder(download, archive_path)
+        status = archive.extract_stream(reader, extension, tree, download.size, start_percent, end_percent,
+                                        show_progress, threads, hasher)
+        return status, download.validators
+    finally:
+        download.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def _download_place(url, program_internal_name, extension, start_percent, end_percent, show_progress, workspace,
+                    validators, sha256):
+    tree = os.path.join(workspace, "tree")
+    os.mkdir(tree)
+    hasher = hashlib.sha256()
+    streamed = extension in archive.STREAM_EXTENSIONS and sha256 is None  # Archives with a known hash are checked first
+    middle = start_percent + (end_percent - start_percent) * 0.6
+    archive_path = os.path.join(workspace, "download" + extension)
+    cached_path = os.path.join(workspace, "cached" + extension)
+    if sha256 is not None and cache.enabled() and cache.fetch_hash(sha256, extension, cached_path):
+        config.vprint("The archive with sha256 {} is cached, so not downloading it".format(sha256))
+        cached = {"sha256": sha256, "validators": dict(validators or {})}  # Nothing was asked of the server
+        status = "Cached"
     else:
-        config.vprint("Automatically adding update URL to be install URL")
-        add_upgrade_url(program_internal_name, url, extension)
-        return "Installed"
+        cached = cache.lookup(url) if cache.enabled() else None
+        config.vprint("Downloading archive...")
+        fetch_end = end_percent if streamed else middle
+        try:
+            asked = cached["validators"] if cached is not None else validators
+            status, new_validators = _fetch_archive(url, extension, archive_path, tree, asked, hasher, streamed,
+                                                    start_percent, fetch_end, show_progress)
+            if new_validators is None:
+                if cached is None or (validators and validators == cached["validators"]):
+                    config.vprint("{} hasn't changed since it was last downloaded".format(url))
+                    return "No update", None
+                if cache.fetch_hash(cached["sha256"], extension, cached_path):
+                    config.vprint("{} hasn't changed since it was cached, using the cached archive".format(url))
+                    status = "Cached"
+                else:
+                    config.vprint("The cached archive of {} was removed, downloading it again".format(url))
+                    status, new_validators = _fetch_archive(url, extension, archive_path, tree, None, hasher, streamed,
+                                                            start_percent, fetch_end, show_progress)
+        except OSError as e:
+            config.vprint("Failed to download {}: {}".format(url, e))
+            status = "Download error"
+    if status == "Cached":
+        archive_path = cached_path
+        new_validators = cached["validators"]
+        archive_sha256 = cached["sha256"]
+    elif status in ["Downloaded", "Extracted"]:
+        archive_sha256 = hasher.hexdigest()
+    else:
+        return status, None
+    config.vprint("sha256 of the archive: " + archive_sha256)
+    if sha256 is not None and archive_sha256 != sha256:
+        config.vprint("Expected the archive to have a sha256 of {}! Program installation halted!".format(sha256))
+        return "Bad checksum", None
+    if status != "Extracted":  # Streamed archives were extracted as they downloaded, but not placed until checked
+        status = _extract_archive(archive_path, tree, middle, end_percent, show_progress)
+        if status != "Extracted":
+            return status, None
+    if archive_path != cached_path:
+        cache.add(archive_path, url, archive_sha256, extension, new_validators)
+    _place_program(archive.program_root(tree, program_internal_name), program_internal_name)
+    if validators is not None:
+        validators.clear()
+        validators.update(new_validators)
+    return "Installed", archive_sha256
 
 
 def _archive_install(program, program_internal_name, overwrite=False, reinstall=False, show_progress=True):
@@ -761,66 +1394,23 @@ def _archive_install(program, program_internal_name, overwrite=False, reinstall=
         overwrite (bool): Whether or not to assume the program is already installed and to overwite it
 
     Returns:
-       str: A string from finish_install() a string from create_command(), "No rsync", "Bad name", "Installed", or "Error".
+       str: A string from finish_install() a string from create_command(), "Bad name", "Installed", or "Error".
 
     """
-    if not file.check_bin("rsync") and overwrite:
-        return "No rsync"
     if file.char_check(program_internal_name):
         return "Bad name"
-    config.vprint("Removing old temp directory (if it exists!)")
-    try:
-        rmtree(file.full("/tmp/tarstall-temp"))  # Removes temp directory (used during installs)
-    except FileNotFoundError:
-        pass
-    generic.progress(10, show_progress)
-    config.vprint("Creating new temp directory")
-    os.mkdir(file.full("/tmp/tarstall-temp"))  # Creates temp directory for extracting archive
-    config.vprint("Extracting archive to temp directory")
-    file_extension = file.extension(program)
-    program = file.spaceify(program)
-    command_to_go = create_command(file_extension, program)
-    config.vprint('File type detected: ' + file_extension)
-    generic.progress(15, show_progress)
-    if command_to_go.startswith("No") or command_to_go == "Bad Filetype":
-        return command_to_go
-    try:
-        os.system(command_to_go)  # Extracts program archive
-    except:
-        config.vprint('Failed to run command: ' + command_to_go + "! Program installation halted!")
-        return "Error"
-    generic.progress(50, show_progress)
-    config.vprint('Checking for folder in folder')
-    os.chdir("/tmp/tarstall-temp/")
-    if os.path.isdir(file.full('/tmp/tarstall-temp/' + program_internal_name + '/')):
-        config.vprint('Folder in folder detected! Using that directory instead...')
-        source = file.full('/tmp/tarstall-temp/' + program_internal_name) + '/'
-        dest = file.full('~/.tarstall/bin/' + program_internal_name) + '/'
-    elif len(os.listdir()) == 1 and os.path.isdir(os.listdir()[0]):
-        config.vprint("Single folder detected!")
-        folder = os.listdir()[0]
-        source = file.full("/tmp/tarstall-temp/" + folder) + '/'
-        dest = file.full("~/.tarstall/bin/" + program_internal_name) + '/'
-    else:
-        config.vprint('Folder in folder not detected!')
-        source = file.full('/tmp/tarstall-temp') + '/'
-        dest = file.full('~/.tarstall/bin/' + program_internal_name) + '/'
-    config.vprint("Moving program to directory")
-    if overwrite:
-        if verbose:
-            verbose_flag = "v"
-        else:
-            verbose_flag = ""
-        call(["rsync", "-a{}".format(verbose_flag), source, dest], stdout=c_out)
-    else:
-        move(source, dest)
-    generic.progress(80, show_progress)
-    config.vprint('Removing old temp directory...')
-    os.chdir("/tmp")
-    try:
-        rmtree(file.full("/tmp/tarstall-temp"))
-    except FileNotFoundError:
-        config.vprint('Temp folder not found so not deleted!')
+    with config.workspace("archive") as workspace:  # In the work directory, so moving the program in is just a rename
+        generic.progress(10, show_progress)
+        tree = os.path.join(workspace, "tree")
+        os.mkdir(tree)
+        status = _extract_archive(program, tree, 15, 50, show_progress)
+        if status != "Extracted":
+            return status
+        config.vprint('Checking for folder in folder')
+        source = archive.program_root(tree, program_internal_name)
+        config.vprint("Moving program to directory")
+        _place_program(source, program_internal_name)
+        generic.progress(80, show_progress)
     if not overwrite:
         return finish_install(program_internal_name, show_progress=show_progress)
     else:
@@ -828,7 +1418,7 @@ def _archive_install(program, program_internal_name, overwrite=False, reinstall=
         return "Installed"
 
 
-def _single_install(program, program_internal_name, reinstall=False):
+def _single_install(program, program_internal_name):
     """Install Single File.
 
     Will create a folder to put the single file in.
@@ -836,27 +1426,23 @@ def _single_install(program, program_internal_name, reinstall=False):
     Args:
         program (str): Path to file to install
         program_internal_name (str): Name to use internally for program
-        reinstall (bool, optional): Whether to reinstall or not. Defaults to False.
 
     """
-    if not reinstall:
+    with config.workspace("single") as workspace:
         config.vprint("Creating folder to house file in")
-        os.mkdir(file.full("~/.tarstall/bin/{}".format(program_internal_name)))
-    generic.progress(5)
-    config.vprint("Marking executable as... executable")
-    os.system('sh -c "chmod +x {}"'.format(program))
-    generic.progress(10)
-    if reinstall:
-        config.vprint("Deleting old single-executable...")
-        os.remove(file.full("~/.tarstall/bin/{p}/{p}".format(p=program_internal_name)))
-    generic.progress(15)
-    config.vprint("Moving to tarstall directory and renaming...")
-    move(file.full(program), file.full("~/.tarstall/bin/{p}/{p}".format(p=program_internal_name)))
+        os.mkdir(os.path.join(workspace, program_internal_name))
+        generic.progress(5)
+        config.vprint("Marking executable as... executable")
+        os.system('sh -c "chmod +x {}"'.format(program))
+        generic.progress(15)
+        config.vprint("Moving to tarstall directory and renaming...")
+        file.move_tree(program, os.path.join(workspace, program_internal_name, program_internal_name))
+        _place_program(os.path.join(workspace, program_internal_name), program_internal_name)
     generic.progress(90)
     return finish_install(program_internal_name, "single")
 
 
-def _dir_install(program_path, program_internal_name, overwrite=False, reinstall=False):
+def _dir_install(program_path, program_internal_name, overwrite=False):
     """Install Directory.
 
     Installs a directory as a program
@@ -867,18 +1453,14 @@ def _dir_install(program_path, program_internal_name, overwrite=False, reinstall
         overwrite (bool): Whether or not to assume the program is already installed and to overwite it
 
     Returns:
-       str: A string from finish_install(), "Installed", or "No rsync"
+       str: A string from finish_install() or "Installed"
 
     """
     generic.progress(10)
-    if not file.check_bin("rsync") and overwrite:
-        return "No rsync"
     config.vprint("Moving folder to tarstall destination")
-    if overwrite:
-        call(["rsync", "-a", program_path, file.full("~/.tarstall/bin/{}".format(program_internal_name))], stdout=c_out)
-        rmtree(program_path)
-    else:
-        move(program_path, file.full("~/.tarstall/bin/"))
+    with config.workspace("dir") as workspace:
+        file.move_tree(program_path, os.path.join(workspace, program_internal_name))
+        _place_program(os.path.join(workspace, program_internal_name), program_internal_name)
     if not overwrite:
         return finish_install(program_internal_name)
     else:
@@ -893,34 +1475,38 @@ def uninstall(program, show_progress=True):
         show_progress (bool): Whether to show progress or not.
 
     Returns:
-        str: Status detailing the uninstall. Can be: "Not installed" or "Success".
-
-    """
-    if not program in config.db["programs"]:
-        return "Not installed"
-    config.vprint("Removing program files")
-    rmtree(file.full("~/.tarstall/bin/" + program + '/'))
-    generic.progress(40, show_progress)
-    config.vprint("Removing program from PATH and any binlinks for the program")
-    file.remove_line(program, "~/.tarstall/.bashrc", 'poundword')
-    generic.progress(50, show_progress)
-    config.vprint("Removing program desktop files")
-    if config.db["programs"][program]["desktops"]:
-        progress = 50
-        adder = int(30 / len(config.db["programs"][program]["desktops"]))
-        for d in config.db["programs"][program]["desktops"]:
-            try:
-                os.remove(file.full("~/.local/share/applications/tarstall/{}.desktop".format(d)))
-            except FileNotFoundError:
-                pass
-            progress += adder
-            generic.progress(progress, show_progress)
-    generic.progress(80, show_progress)
-    config.vprint("Removing program from tarstall list of programs")
-    del config.db["programs"][program]
-    config.write_db()
-    generic.progress(100, show_progress)
-    return "Success"
+        str: Status detailing the uninstall. Can be: "Not installed", "Locked" if another tarstall is working
+        on the program, or "Success".
+
+    """
+    with _locked(program) as locked:
+        if not locked:
+            return "Locked"
+        with config.transaction():
+            if not program in config.db["programs"]:
+                return "Not installed"
+            config.vprint("Removing program files")
+            _remove_program_files(program)
+            generic.progress(40, show_progress)
+            generic.progress(50, show_progress)
+            config.vprint("Removing program desktop files")
+            if config.db["programs"][program]["desktops"]:
+                progress = 50
+                adder = int(30 / len(config.db["programs"][program]["desktops"]))
+                for d in config.db["programs"][program]["desktops"]:
+                    try:
+                        os.remove(file.full("~/.local/share/applications/tarstall/{}.desktop".format(d)))
+                    except FileNotFoundError:
+                        pass
+                    progress += adder
+                    generic.progress(progress, show_progress)
+            generic.progress(80, show_progress)
+            config.vprint("Removing program from tarstall list of programs")
+            journal.record("uninstall", program)
+            del config.db["programs"][program]
+            config.write_db()
+            generic.progress(100, show_progress)
+            return "Success"
 
 
 def list_programs():
@@ -930,5 +1516,5 @@ def list_programs():
         str[]: List of installed programs by name
     
     """
-    return list(config.db["programs"].keys())
+    return list(config.db["programs"])
 
@@ -0,0 +1,368 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import json
+import os
+import shlex
+from shutil import rmtree
+
+import file
+
+BASHRC_PATH = "~/.tarstall/.bashrc"
+FISHRC_PATH = "~/.tarstall/.fishrc"
+SHIMS_PATH = "~/.tarstall/shims"
+SHIM_INDEX_PATH = "~/.tarstall/shim_index"  # {program: {"mtime": dir_mtime, "executables": [...]}}
+FISH_FUNCTIONS_PATH = "~/.tarstall/fish_functions"
+SHELL_OPS = ["install", "uninstall", "rename", "binlink", "pathify", "remove_paths"]  # Journal operations the shell files depend on
+SHELL_OPTIONS = ["UseShims", "FishAutoload"]
+
+"""
+~/.tarstall/.bashrc and ~/.tarstall/.fishrc are generated from the database; they should never be edited
+by hand or line-by-line. Every line added for a program ends with "# program", which repair_db() relies on.
+
+With the UseShims option, the shell files only add ~/.tarstall/shims to PATH. Every executable of a program
+added to PATH gets a symlink in there, and every binlink gets a small wrapper script, so PATH never grows.
+
+With the FishAutoload option, fish binlinks are written as one file each to ~/.tarstall/fish_functions, which
+is added to fish_function_path, so fish only loads a binlink the first time it's run.
+"""
+
+
+def binlink_file(info, name):
+    """Get Binlinked File.
+
+    Args:
+        info (dict): Program's entry in the database
+        name (str): Name of the binlink
+
+    Returns:
+        str: Path to the file the binlink runs, relative to the program's directory
+
+    """
+    return info.get("binlink_files", {}).get(name, name)
+
+
+def rename_single_binlinks(info, program, new_name):
+    """Rename Single-File Binlinks.
+
+    A single-file program's file is renamed along with the program, so binlinks to it are renamed too.
+
+    Args:
+        info (dict): Program's entry in the database
+        program (str): Old name of the program
+        new_name (str): New name of the program
+
+    """
+    if info["install_type"] != "single" or binlink_file(info, program) != program:
+        return
+    if program in info["binlinks"]:
+        info["binlinks"][info["binlinks"].index(program)] = new_name
+    files = info.setdefault("binlink_files", {})
+    files.pop(program, None)
+    files[new_name] = new_name
+
+
+def render(db):
+    """Render Shell Files.
+
+    Args:
+        db (dict): Database to render the shell files from
+
+    Returns:
+        (str, str): Contents of ~/.tarstall/.bashrc and ~/.tarstall/.fishrc
+
+    """
+    execs = file.full("~/.tarstall/tarstall_execs")
+    bash = ["export PATH=$PATH:{}".format(execs)]
+    fish = ["set PATH $PATH {}".format(execs)]
+    if use_shims(db):
+        bash.append("export PATH=$PATH:{}".format(file.full(SHIMS_PATH)))
+        fish.append("set PATH $PATH {}".format(file.full(SHIMS_PATH)))
+        return "\n".join(bash) + "\n", "\n".join(fish) + "\n"
+    fish_autoload = use_fish_autoload(db)
+    if fish_autoload:
+        fish.append("set fish_function_path $fish_function_path {}".format(file.full(FISH_FUNCTIONS_PATH)))
+    programs = db.get("programs", {})
+    for program in programs:
+        info = programs[program]
+        if info.get("has_path"):
+            bash.append("export PATH=$PATH:~/.tarstall/bin/{p} # {p}".format(p=program))
+            fish.append("set PATH $PATH ~/.tarstall/bin/{p} # {p}".format(p=program))
+        program_dir = file.full("~/.tarstall/bin/" + program)
+        for name in info.get("binlinks", []):
+            to_run = binlink_file(info, name)
+            bash.append("alias {}='cd {}/ && ./{}' # {}".format(name, program_dir, to_run, program))
+            if not fish_autoload:
+                fish.append("function {};cd {}/;./{};end # {}".format(name, program_dir, to_run, program))
+    return "\n".join(bash) + "\n", "\n".join(fish) + "\n"
+
+
+def _read(file_path):
+    try:
+        with open(file.full(file_path)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def use_shims(db):
+    """Check if Shims are in Use.
+
+    Args:
+        db (dict): Database
+
+    Returns:
+        bool: Whether the UseShims option is enabled
+
+    """
+    return db.get("options", {}).get("UseShims", False)
+
+
+def _read_index():
+    try:
+        with open(file.full(SHIM_INDEX_PATH)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def _executables(program, index):
+    """Get Program Executables.
+
+    Lists the executable files at the top level of a program's directory. The listing is kept in the index,
+    and only redone when the directory's modification time changes.
+
+    Args:
+        program (str): Program to list executables of
+        index (dict): Shim index, updated in place
+
+    Returns:
+        str[]: Names of executable files
+
+    """
+    program_dir = file.full("~/.tarstall/bin/" + program)
+    try:
+        mtime = os.stat(program_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    if program in index and index[program]["mtime"] == mtime:
+        return index[program]["executables"]
+    executables = sorted(e.name for e in os.scandir(program_dir)
+                         if e.is_file() and os.access(e.path, os.X_OK))
+    index[program] = {"mtime": mtime, "executables": executables}
+    return executables
+
+
+def _shim_script(program, to_run):
+    return "#!/bin/sh\n# {}\ncd {} && exec ./{} \"$@\"\n".format(
+        program, shlex.quote(file.full("~/.tarstall/bin/" + program) + "/"), shlex.quote(to_run))
+
+
+def _sync_dir(dir_path, wanted):
+    """Synchronize Directory.
+
+    Makes dir_path contain exactly the entries in wanted, only touching entries that differ.
+
+    Args:
+        dir_path (str): Full path to the directory
+        wanted (dict): Entry name to ("link", target), ("script", contents), or ("file", contents)
+
+    Returns:
+        int: Number of entries created, changed, or removed
+
+    """
+    os.makedirs(dir_path, exist_ok=True)
+    changed = 0
+    for name in os.listdir(dir_path):
+        if name not in wanted:
+            os.remove(os.path.join(dir_path, name))
+            changed += 1
+    for name, (kind, value) in wanted.items():
+        entry = os.path.join(dir_path, name)
+        if kind == "link":
+            if os.path.islink(entry) and os.readlink(entry) == value:
+                continue
+            tmp = entry + ".tmp"
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(value, tmp)
+            os.replace(tmp, entry)
+        else:
+            if not os.path.islink(entry) and _read(entry) == value:
+                continue
+            file.atomic_write(value, entry)
+            if kind == "script":
+                os.chmod(entry, 0o755)
+        changed += 1
+    return changed
+
+
+def sync_shims(db):
+    """Synchronize Shims.
+
+    Makes ~/.tarstall/shims hold exactly one entry per executable of each program added to PATH and
+    per binlink. Binlinks win over PATH executables with the same name, like aliases would. Entries that
+    are already correct are left alone. If UseShims is disabled, the shims directory is removed.
+
+    Args:
+        db (dict): Database to create shims for
+
+    Returns:
+        int: Number of shims created, changed, or removed
+
+    """
+    shims_dir = file.full(SHIMS_PATH)
+    if not use_shims(db):
+        if os.path.isdir(shims_dir):
+            rmtree(shims_dir)
+        if file.exists(SHIM_INDEX_PATH):
+            os.remove(file.full(SHIM_INDEX_PATH))
+        return 0
+    index = _read_index()
+    new_index = {}
+    wanted = {}  # Shim name to ("link", target) or ("script", contents)
+    programs = db.get("programs", {})
+    for program in programs:
+        info = programs[program]
+        if info.get("has_path"):
+            if program in index:
+                new_index[program] = index[program]
+            for exe in _executables(program, new_index):
+                wanted.setdefault(exe, ("link", file.full("~/.tarstall/bin/{}/{}".format(program, exe))))
+    for program in programs:
+        info = programs[program]
+        for name in info.get("binlinks", []):
+            wanted[name] = ("script", _shim_script(program, binlink_file(info, name)))
+    changed = _sync_dir(shims_dir, wanted)
+    if new_index != index:
+        file.atomic_write(json.dumps(new_index), SHIM_INDEX_PATH)
+    return changed
+
+
+def use_fish_autoload(db):
+    """Check if Fish Binlinks are Autoloaded.
+
+    Args:
+        db (dict): Database
+
+    Returns:
+        bool: Whether the FishAutoload option is enabled. Always False when shims are in use, since
+        binlinks are shims then.
+
+    """
+    return db.get("options", {}).get("FishAutoload", False) and not use_shims(db)
+
+
+def sync_fish_functions(db):
+    """Synchronize Fish Functions.
+
+    Makes ~/.tarstall/fish_functions hold one autoloaded function file per binlink. If FishAutoload
+    is disabled, the directory is removed.
+
+    Args:
+        db (dict): Database to create fish functions for
+
+    Returns:
+        int: Number of function files created, changed, or removed
+
+    """
+    functions_dir = file.full(FISH_FUNCTIONS_PATH)
+    if not use_fish_autoload(db):
+        if os.path.isdir(functions_dir):
+            rmtree(functions_dir)
+        return 0
+    wanted = {}
+    programs = db.get("programs", {})
+    for program in programs:
+        info = programs[program]
+        program_dir = file.full("~/.tarstall/bin/" + program)
+        for name in info.get("binlinks", []):
+            wanted[name + ".fish"] = ("file", "function {};cd {}/;./{};end # {}\n".format(
+                name, program_dir, binlink_file(info, name), program))
+    return _sync_dir(functions_dir, wanted)
+
+
+def needs_rewrite(entries, db):
+    """Check if Shell Files Need Rewriting.
+
+    Rendering the shell files reads every program, which under SQLite means loading every row, so
+    writing the database only rewrites them when what changed can affect them.
+
+    Args:
+        entries (dict[]): Journal entries being written to the database. Empty if the database was written
+        without recording what changed, such as by a migration, in which case anything may have.
+        db (dict): Database being written
+
+    Returns:
+        bool: Whether write_shell_files() should be called
+
+    """
+    if not entries:
+        return True
+    for entry in entries:
+        if entry["op"] in SHELL_OPS:
+            return True
+        if entry["op"] == "config" and entry["data"]["key"] in SHELL_OPTIONS:
+            return True
+        if entry["op"] in ["update_validators", "sha256"] and use_shims(db):
+            return True  # Recorded after a program is updated, which can change the executables it has shims for
+    return False
+
+
+def write_shell_files(db):
+    """Write Shell Files.
+
+    Renders ~/.tarstall/.bashrc and ~/.tarstall/.fishrc from the database, atomically replaces
+    whichever of them changed, and synchronizes the shims and fish functions directories.
+
+    Args:
+        db (dict): Database to render the shell files from
+
+    Returns:
+        int: Number of files written, including shims
+
+    """
+    written = 0
+    for contents, file_path in zip(render(db), [BASHRC_PATH, FISHRC_PATH]):
+        if _read(file_path) != contents:
+            file.atomic_write(contents, file_path)
+            written += 1
+    return written + sync_shims(db) + sync_fish_functions(db)
+
+
+def parse_binlinks(file_path=BASHRC_PATH):
+    """Parse Binlinks.
+
+    Reads binlinks back out of a .bashrc written by tarstall, including ones written before the
+    shell files were generated from the database.
+
+    Args:
+        file_path (str): Path to the .bashrc to read. Defaults to ~/.tarstall/.bashrc
+
+    Returns:
+        dict: {program: {binlink_name: binlinked_file}}
+
+    """
+    found = {}
+    contents = _read(file_path)
+    if contents is None:
+        return found
+    for l in contents.splitlines():
+        if l.startswith("alias ") and '#' in l:
+            program = l[l.rfind("#")+2:].rstrip()
+            name = l[6:l.find("=")]
+            to_run = l[l.find("&& ./")+5:l.rfind("' #")] if "&& ./" in l else name
+            found.setdefault(program, {})[name] = to_run
+    return found
@@ -0,0 +1,281 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import json
+import os
+import sqlite3
+from collections.abc import MutableMapping
+
+import file
+
+DB_PATH = "~/.tarstall/database.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS options (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS version (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS programs (name TEXT PRIMARY KEY, install_type TEXT, update_url TEXT,
+                                     post_upgrade_script TEXT, data TEXT);
+CREATE TABLE IF NOT EXISTS binlinks (program TEXT, position INTEGER, name TEXT, PRIMARY KEY (program, position));
+CREATE TABLE IF NOT EXISTS desktops (program TEXT, position INTEGER, name TEXT, PRIMARY KEY (program, position));
+CREATE INDEX IF NOT EXISTS programs_install_type ON programs (install_type);
+CREATE INDEX IF NOT EXISTS programs_update_url ON programs (update_url);
+"""
+
+_conn = None  # Cached connection to the database
+_conn_inode = None  # Inode of the database file _conn was opened on
+_saved = {}  # Serialized copy of every section/row as last loaded or saved, used to find what changed
+
+
+def enabled():
+    """Check if SQLite Database is in Use.
+
+    Returns:
+        bool: Whether ~/.tarstall/database.sqlite exists
+
+    """
+    return os.path.isfile(file.full(DB_PATH))
+
+
+def _connection():
+    """Get Database Connection.
+
+    Returns:
+        sqlite3.Connection: Connection to the SQLite database, re-opened if the file was replaced.
+
+    """
+    global _conn, _conn_inode
+    inode = os.stat(file.full(DB_PATH)).st_ino
+    if _conn is None or _conn_inode != inode:
+        if _conn is not None:
+            _conn.close()
+        _conn = sqlite3.connect(file.full(DB_PATH))
+        _conn.executescript(SCHEMA)
+        _conn_inode = inode
+    return _conn
+
+
+def _serialize(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _program_from_rows(data, binlinks, desktops):
+    program = json.loads(data)
+    program["binlinks"] = [b[0] for b in binlinks]
+    program["desktops"] = [d[0] for d in desktops]
+    return program
+
+
+class LazyPrograms(MutableMapping):
+    """Programs Section Backed by SQLite.
+
+    Acts like the "programs" dictionary of the database, but only reads the rows for programs
+    that are actually accessed. Rows that were accessed are compared against their saved copy
+    when saving, so only changed programs are written back.
+
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._names = None
+        self._deleted = set()
+
+    def _load_names(self):
+        if self._names is None:
+            self._names = [r[0] for r in _connection().execute("SELECT name FROM programs ORDER BY rowid")]
+        return self._names
+
+    def __getitem__(self, name):
+        if name in self._cache:
+            return self._cache[name]
+        if name in self._deleted:
+            raise KeyError(name)
+        conn = _connection()
+        row = conn.execute("SELECT data FROM programs WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        binlinks = conn.execute("SELECT name FROM binlinks WHERE program = ? ORDER BY position", (name,)).fetchall()
+        desktops = conn.execute("SELECT name FROM desktops WHERE program = ? ORDER BY position", (name,)).fetchall()
+        program = _program_from_rows(row[0], binlinks, desktops)
+        _saved[("programs", name)] = _serialize(program)
+        self._cache[name] = program
+        return program
+
+    def __setitem__(self, name, value):
+        if name not in self:
+            self._load_names().append(name)
+        self._deleted.discard(name)
+        self._cache[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._load_names().remove(name)
+        self._cache.pop(name, None)
+        self._deleted.add(name)
+
+    def __contains__(self, name):
+        return name in self._load_names()
+
+    def __iter__(self):
+        return iter(list(self._load_names()))
+
+    def __len__(self):
+        return len(self._load_names())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def updatable(self, include_urls):
+        """Get Updatable Programs.
+
+        Uses the install_type and update_url indexes to find programs that can be updated without
+        reading every program.
+
+        Args:
+            include_urls (bool): Whether programs with an update URL should be included
+
+        Returns:
+            str[]: Names of programs that have a way of updating
+
+        """
+        rows = _connection().execute("SELECT name FROM programs WHERE (update_url IS NULL AND "
+                                     "(install_type = 'git' OR post_upgrade_script IS NOT NULL)) OR "
+                                     "(update_url IS NOT NULL AND ?)", (include_urls,))
+        names = set(r[0] for r in rows if r[0] not in self._cache and r[0] not in self._deleted)
+        for name, program in self._cache.items():
+            if program["update_url"]:
+                if include_urls:
+                    names.add(name)
+            elif program["install_type"] == "git" or program["post_upgrade_script"]:
+                names.add(name)
+        return [n for n in self._load_names() if n in names]
+
+
+def load():
+    """Load Database.
+
+    Returns:
+        dict: Database, with the programs section being a LazyPrograms. {} if the database couldn't be read.
+
+    """
+    _saved.clear()
+    try:
+        conn = _connection()
+        db = {}
+        meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        for key in json.loads(meta.get("sections", "[]")):
+            if key in ["options", "version"]:
+                db[key] = {}
+                for k, v in conn.execute("SELECT key, value FROM {}".format(key)):
+                    db[key][k] = json.loads(v)
+                    _saved[(key, k)] = v
+            elif key == "programs":
+                db[key] = LazyPrograms()
+            else:
+                db[key] = json.loads(meta[key])
+        return db
+    except (sqlite3.DatabaseError, FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def _write_program(conn, name, program):
+    info = dict(program)
+    binlinks = info.pop("binlinks", [])
+    desktops = info.pop("desktops", [])
+    conn.execute("INSERT INTO programs (name, install_type, update_url, post_upgrade_script, data) VALUES (?, ?, ?, ?, ?) "
+                 "ON CONFLICT(name) DO UPDATE SET install_type = excluded.install_type, update_url = excluded.update_url, "
+                 "post_upgrade_script = excluded.post_upgrade_script, data = excluded.data",
+                 (name, info.get("install_type"), info.get("update_url") or None, info.get("post_upgrade_script") or None,
+                  _serialize(info)))
+    conn.execute("DELETE FROM binlinks WHERE program = ?", (name,))
+    conn.execute("DELETE FROM desktops WHERE program = ?", (name,))
+    conn.executemany("INSERT INTO binlinks (program, position, name) VALUES (?, ?, ?)",
+                     [(name, i, b) for i, b in enumerate(binlinks)])
+    conn.executemany("INSERT INTO desktops (program, position, name) VALUES (?, ?, ?)",
+                     [(name, i, d) for i, d in enumerate(desktops)])
+
+
+def _delete_program(conn, name):
+    conn.execute("DELETE FROM programs WHERE name = ?", (name,))
+    conn.execute("DELETE FROM binlinks WHERE program = ?", (name,))
+    conn.execute("DELETE FROM desktops WHERE program = ?", (name,))
+
+
+def save(db):
+    """Save Database.
+
+    Writes only the options, versions, and programs that changed since they were last loaded or saved,
+    all inside of a single SQLite transaction.
+
+    Args:
+        db (dict): Database to save
+
+    """
+    conn = _connection()
+    with conn:
+        sections = [k for k in db.keys()]
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('sections', ?)", (json.dumps(sections),))
+        conn.execute("DELETE FROM meta WHERE key != 'sections'")
+        for key in sections:
+            if key not in ["options", "version", "programs"]:
+                conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (key, _serialize(db[key])))
+        for key in ["options", "version"]:
+            section = db.get(key, {})
+            for k, v in section.items():
+                value = _serialize(v)
+                if _saved.get((key, k)) != value:
+                    conn.execute("INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(key), (k, value))
+                    _saved[(key, k)] = value
+            for k in [s[1] for s in _saved if s[0] == key and s[1] not in section]:
+                conn.execute("DELETE FROM {} WHERE key = ?".format(key), (k,))
+                del _saved[(key, k)]
+        programs = db.get("programs", {})
+        if isinstance(programs, LazyPrograms):
+            for name in programs._deleted:
+                _delete_program(conn, name)
+                _saved.pop(("programs", name), None)
+            programs._deleted.clear()
+            touched = programs._cache
+        else:  # Replaced wholesale (new or repaired database), so rewrite every program
+            conn.execute("DELETE FROM programs")
+            conn.execute("DELETE FROM binlinks")
+            conn.execute("DELETE FROM desktops")
+            for k in [s for s in _saved if s[0] == "programs"]:
+                del _saved[k]
+            touched = programs
+        for name, program in touched.items():
+            value = _serialize(program)
+            if _saved.get(("programs", name)) != value:
+                _write_program(conn, name, program)
+                _saved[("programs", name)] = value
+
+
+def import_json(db):
+    """Import JSON Database.
+
+    Creates ~/.tarstall/database.sqlite holding everything in db.
+
+    Args:
+        db (dict): Database, as read from the JSON database file
+
+    """
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+    file.create(DB_PATH)
+    _saved.clear()
+    save(db)
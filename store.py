@@ -0,0 +1,178 @@
+"""tarstall: A package manager for managing archives
+    Copyright (C) 2022  hammy275
+
+    tarstall is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    tarstall is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import os
+import stat
+
+import config
+import file
+import manifest
+
+STORE_PATH = "~/.tarstall/store"
+
+"""
+Store structure
+
+Every file is stored once under ~/.tarstall/store/objects/<first two characters of key>/<key>, where the key
+is the sha256 of the file's contents followed by its permissions (hardlinks share permissions, so files that
+only differ in permissions can't share an object). Files in ~/.tarstall/bin are hardlinks to these objects,
+so an object with a link count of 1 isn't used by any program anymore.
+"""
+
+
+def enabled():
+    """Check if the Store is in Use.
+
+    Returns:
+        bool: Whether the UseStore option is enabled
+
+    """
+    return config.read_config("UseStore") is True
+
+
+def object_path(key):
+    """Get Object Path.
+
+    Args:
+        key (str): Object key
+
+    Returns:
+        str: Full path to the object
+
+    """
+    return os.path.join(file.full(STORE_PATH), "objects", key[:2], key)
+
+
+def _link_over(source, path):
+    """Atomically replace path with a hardlink to source."""
+    tmp = path + ".tarstall-link"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.link(source, tmp)
+    os.replace(tmp, path)
+
+
+def add_tree(tree_path, entries=None):
+    """Add Tree to Store.
+
+    Moves every regular file in a directory tree into the store, replacing it with a hardlink to its object.
+    Files whose contents are already in the store are linked to the existing object, so their copy is freed.
+
+    Files whose size, permissions, and modification time match their manifest entry aren't hashed again,
+    so files that are already hardlinks to their object only cost a stat().
+
+    Args:
+        tree_path (str): Path to the directory tree
+        entries (dict): Manifest entries of the tree, such as from manifest.read(). Updated with the hashes
+        computed and the modification times of files linked to existing objects. Defaults to None.
+
+    Returns:
+        dict: "files" (regular files seen), "linked" (files that now share an object that already existed),
+        and "bytes_saved" (size of those files)
+
+    """
+    stats = {"files": 0, "linked": 0, "bytes_saved": 0}
+    for root, dirs, files in os.walk(file.full(tree_path)):
+        if root == file.full(tree_path) and ".git" in dirs:
+            dirs.remove(".git")  # git rewrites these itself, and they're rarely shared between programs
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            stats["files"] += 1
+            entry = entries.get(os.path.relpath(path, file.full(tree_path))) if entries else None
+            if entry is None or entry[:3] != [st.st_size, st.st_mode, st.st_mtime_ns]:
+                entry = None  # Changed since the manifest was written
+            elif entry[3] is None:
+                entry[3] = file.hash_file(path)
+            digest = entry[3] if entry is not None else file.hash_file(path)
+            key = "{}-{:o}".format(digest, stat.S_IMODE(st.st_mode))
+            obj = object_path(key)
+            try:
+                obj_st = os.stat(obj)
+            except FileNotFoundError:
+                obj_st = None
+            try:
+                if obj_st is None:
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    os.link(path, obj)
+                elif obj_st.st_ino != st.st_ino or obj_st.st_dev != st.st_dev:
+                    _link_over(obj, path)
+                    if entry is not None:
+                        entry[2] = obj_st.st_mtime_ns  # The file is now the object
+                    stats["linked"] += 1
+                    stats["bytes_saved"] += st.st_size
+            except OSError as e:  # Different filesystem, too many links, etc.
+                config.vprint("Couldn't add {} to the store: {}".format(path, e))
+    config.vprint("Stored {} files, {} of which were already in the store".format(stats["files"], stats["linked"]))
+    return stats
+
+
+def add_program(program):
+    """Add Program to Store.
+
+    The program's manifest supplies the hashes of files that haven't changed, and gets the ones computed.
+
+    Args:
+        program (str): Name of program to add to the store
+
+    Returns:
+        dict: See add_tree()
+
+    """
+    entries = manifest.read(program)
+    stats = add_tree("~/.tarstall/bin/{}".format(program), entries)
+    if entries is not None:
+        manifest.write(program, entries)
+    return stats
+
+
+def gc():
+    """Collect Garbage.
+
+    Deletes every object that no program links to anymore. Holds tarstall's exclusive lock while doing so,
+    since another tarstall could link an object between it being found unused and it being deleted.
+
+    Returns:
+        (int, int): Number of objects deleted and the number of bytes freed
+
+    Raises:
+        TimeoutError: If other tarstalls kept running for too long
+
+    """
+    if not file.lock():
+        raise TimeoutError("Other tarstalls kept running for too long")
+    removed = 0
+    freed = 0
+    objects_dir = os.path.join(file.full(STORE_PATH), "objects")
+    try:
+        if not os.path.isdir(objects_dir):
+            return 0, 0
+        for prefix in os.listdir(objects_dir):
+            prefix_dir = os.path.join(objects_dir, prefix)
+            for name in os.listdir(prefix_dir):
+                obj = os.path.join(prefix_dir, name)
+                st = os.lstat(obj)
+                if st.st_nlink <= 1:
+                    config.vprint("Removing unused object " + name)
+                    os.remove(obj)
+                    removed += 1
+                    freed += st.st_size
+            if not os.listdir(prefix_dir):
+                os.rmdir(prefix_dir)
+    finally:
+        file.lock(shared=True)
+    return removed, freed
@@ -13,12 +13,14 @@
 
     You should have received a copy of the GNU General Public License
     along with tarstall.  If not, see <https://www.gnu.org/licenses/>."""
+import copy
 import datetime
 import getpass
 import json
 import os
 import sys
-from shutil import which, rmtree, move, copyfile, copytree
+import time
+from shutil import rmtree, move, copyfile, copytree
 from subprocess import call
 
 import requests
@@ -26,7 +28,11 @@ import requests
 import config
 import file
 import generic
-from generic_manage import wget_with_progress, git_clone_with_progress, c_out, can_update
+import journal
+import shell
+import sqlite_db
+import generic_manage
+from generic_manage import git_clone_with_progress, can_update
 
 
 def reinstall_deps():
@@ -35,28 +41,24 @@ def reinstall_deps():
     Install the dependencies for tarstall by using the installer.
 
     Returns:
-        str: "No wget", "Wget error", "Installer error", or "Success"
+        str: "Download error", "Installer error", or "Success"
 
     """
-    if which("wget") is None:
-        return "No wget"
-    config.vprint("Deleting and re-creating temp directory")
-    try:
-        rmtree("/tmp/tarstall-temp")
-    except FileNotFoundError:
-        pass
-    os.mkdir("/tmp/tarstall-temp/")
-    os.chdir("/tmp/tarstall-temp/")
-    generic.progress(5)
-    config.vprint("Obtaining tarstall installer...")
-    url = "https://raw.githubusercontent.com/hammy275/tarstall/{}/install_tarstall".format(config.db["version"]["branch"])
-    err = wget_with_progress(url, 5, 60)
-    if err != 0:
-        return "Wget error"
-    generic.progress(60)
-    config.vprint("Running tarstall setup to (re)-install dependencies")
-    input("")
-    err = call([sys.executable, "install_tarstall", "--skip-questions"], stdout=c_out, stderr=c_out)
+    config.vprint("Creating temp directory")
+    with config.workspace("deps") as deps_dir:
+        generic.progress(5)
+        config.vprint("Obtaining tarstall installer...")
+        url = "https://raw.githubusercontent.com/hammy275/tarstall/{}/install_tarstall".format(config.db["version"]["branch"])
+        try:
+            generic_manage.download(url, os.path.join(deps_dir, "install_tarstall"), 5, 60)
+        except OSError as e:
+            config.vprint("Failed to download the installer: {}".format(e))
+            return "Download error"
+        generic.progress(60)
+        config.vprint("Running tarstall setup to (re)-install dependencies")
+        input("")
+        err = call([sys.executable, "install_tarstall", "--skip-questions"], cwd=deps_dir, stdout=generic_manage.c_out,
+                   stderr=generic_manage.c_out)
     generic.progress(95)
     config.vprint("Removing installer skip file")
     generic.progress(100)
@@ -78,15 +80,54 @@ def repair_tarstall():
     return update(True, True)
 
 
+def _replace_db(new_db):
+    """Back up the current database and replace it with new_db."""
+    config.vprint("Backing up old database...")
+    date_str = datetime.datetime.today().strftime("%d-%m-%Y-%H-%M-%S")
+    was_sqlite = sqlite_db.enabled()
+    if was_sqlite:
+        move(file.full(sqlite_db.DB_PATH), file.full("~/.tarstall/database-backup-{}.sqlite.bak".format(date_str)))
+    elif file.exists("~/.tarstall/database"):
+        move(file.full("~/.tarstall/database"), file.full("~/.tarstall/database-backup-{}.bak".format(date_str)))
+
+    config.vprint("Writing new database...")
+    config.db = new_db
+    if was_sqlite:
+        sqlite_db.import_json(new_db)
+        config.db = file.get_db()
+    else:
+        config.write_db()
+    journal.checkpoint(config.db)
+
+
 def repair_db():
     """Attempts to Repair Tarstall DB.
 
-    WARNING: THIS SHOULD NOT BE USED UNLESS THE DATABASE CANNOT BE RECOVERED OTHERWISE!!!
+    If tarstall's journal has a checkpoint, the database is rebuilt from it and every operation
+    recorded after it, so nothing is lost. Otherwise, the database is rebuilt by scanning ~/.tarstall.
+
+    WARNING: IF THERE IS NO JOURNAL, THIS SHOULD NOT BE USED UNLESS THE DATABASE CANNOT BE RECOVERED OTHERWISE!!!
     BECAUSE AN EMPTY DATABASE ONLY HAS LIMITED KNOWLEDGE OF PAST OPERATIONS, SEVERAL THINGS CANNOT
     AND WILL NOT BE RECOVERED!!!!!!
+
+    Returns:
+        str: "Journal" if the database was recovered from the journal, "Rescan" if it was rebuilt by scanning files,
+        or "Locked" if other tarstalls kept running for too long.
+
     """
+    if not file.lock():
+        return "Locked"
     config.vprint("Attempting repair of database...")
 
+    recovered = journal.recover()
+    if recovered is not None:
+        config.vprint("Replaying journal on top of last checkpoint")
+        generic.progress(50)
+        _replace_db(recovered)
+        config.vprint("Database repair complete!")
+        generic.progress(100)
+        return "Journal"
+
     config.vprint("Getting stock database to build off of")
     new_db = get_default_db()
     generic.progress(5)
@@ -95,7 +136,8 @@ def repair_db():
     for pf in os.listdir(file.full("~/.tarstall/bin/")):
         config.vprint("Re-discovering " + pf, end="\r")
         prog_info = {pf: {"install_type": "default", "desktops": [],
-        "post_upgrade_script": None, "update_url": None, "has_path": False, "binlinks": []}}
+        "post_upgrade_script": None, "update_url": None, "has_path": False, "binlinks": [], "binlink_files": {},
+        "update_validators": None, "sha256": None, "sha256_url": None}}
         if ".git" in os.listdir(file.full("~/.tarstall/bin/{}".format(pf))):
             prog_info[pf]["install_type"] = "git"
         elif len(os.listdir(file.full("~/.tarstall/bin/{}".format(pf)))) == 1:
@@ -120,19 +162,13 @@ def repair_db():
     generic.progress(35)
 
     config.vprint("Re-registering binlinks")
-    for l in bashrc_lines:
-        if l.startswith("alias ") and '#' in l:
-            program = l[l.find("#")+2:].rstrip()
-            config.vprint("Re-registering a binlink or binlinks for " + program, end="\r")
-            binlinked_file = l[6:l.find("=")]
-            new_db["programs"][program]["binlinks"].append(binlinked_file)
+    for program, binlinks in shell.parse_binlinks().items():
+        config.vprint("Re-registering a binlink or binlinks for " + program, end="\r")
+        new_db["programs"][program]["binlinks"] += list(binlinks)
+        new_db["programs"][program]["binlink_files"].update(binlinks)
 
     generic.progress(60)
 
-    config.vprint("Backing up old database...")
-    date_str = datetime.datetime.today().strftime("%d-%m-%Y-%H-%M-%S")
-    move(file.full("~/.tarstall/database"), file.full("~/.tarstall/database-backup-{}.bak".format(date_str)))
-
     generic.progress(80)
 
     config.vprint("Re-discovering .desktop files...")
@@ -145,13 +181,53 @@ def repair_db():
 
     generic.progress(95)
 
-    config.vprint("Writing new database...")
-    config.db = new_db
-    config.write_db()
+    _replace_db(new_db)
 
     config.vprint("Database repair complete!")
     generic.progress(100)
-    return
+    return "Rescan"
+
+
+def regen_shell():
+    """Regenerate Shell Files.
+
+    Rebuilds ~/.tarstall/.bashrc and ~/.tarstall/.fishrc from the database.
+
+    Returns:
+        str: "Regenerated" if either file was rewritten, or "Up to date" if both already matched the database.
+
+    """
+    config.vprint("Regenerating shell files from the database")
+    if shell.write_shell_files(config.db) > 0:
+        return "Regenerated"
+    return "Up to date"
+
+
+def convert_db_to_sqlite():
+    """Convert Database to SQLite.
+
+    Imports the JSON database into ~/.tarstall/database.sqlite, which is used from then on.
+    The JSON database is kept as a backup.
+
+    Returns:
+        str: "Already converted" if the SQLite database is already in use, "Locked" if other tarstalls kept running
+        for too long, or "Converted" on success.
+
+    """
+    if sqlite_db.enabled():
+        return "Already converted"
+    elif not file.lock():
+        return "Locked"
+    config.vprint("Importing database into SQLite")
+    generic.progress(10)
+    sqlite_db.import_json(config.db)
+    generic.progress(80)
+    config.vprint("Backing up JSON database")
+    move(file.full("~/.tarstall/database"), file.full("~/.tarstall/database-json-backup.bak"))
+    config.db = file.get_db()
+    file.lock(shared=True)
+    generic.progress(100)
+    return "Converted"
 
 
 def change_branch(branch, reset=False):
@@ -174,6 +250,7 @@ def change_branch(branch, reset=False):
     if branch not in ["master", "beta"]:
         return "Bad branch"
     config.vprint("Switching branch and writing change to file")
+    journal.record("branch", branch=branch)
     config.db["version"]["branch"] = branch
     config.branch = branch
     config.write_db()
@@ -209,6 +286,169 @@ def change_branch(branch, reset=False):
             return "Waiting"
 
 
+def _migrate_11(program, info):
+    info["update_url"] = None
+
+
+def _migrate_12(program, info):
+    info["has_path"] = False
+    info["binlinks"] = []
+
+
+def _migrate_13_once(db):
+    db["options"]["UpdateURLPrograms"] = False
+
+
+def _migrate_14_once(db):
+    db["options"]["PressEnterKey"] = True
+
+
+def _migrate_15(program, info):
+    if info["git_installed"]:
+        info["install_type"] = "git"
+    else:
+        info["install_type"] = "default"
+    del info["git_installed"]
+
+
+def _migrate_16_once(db):
+    db["options"]["WarnMissingDeps"] = True
+
+
+def _migrate_17_once(db):
+    if not file.exists("~/.local/share/applications/tarstall"):
+        config.vprint("Creating tarstall .desktop directory")
+        os.mkdir(file.full("~/.local/share/applications/tarstall"))
+
+
+def _migrate_17(program, info):
+    for desktop in info["desktops"]:
+        if file.exists("~/.local/share/applications/{}.desktop".format(desktop)):
+            config.vprint("Moving {} to tarstall subdirectory".format(desktop))
+            move(file.full("~/.local/share/applications/{}.desktop".format(desktop)), file.full("~/.local/share/applications/tarstall/{}.desktop".format(desktop)))
+        elif file.exists("~/.local/share/applications/tarstall/{}.desktop".format(desktop)):
+            config.vprint("Not moving {}, it's already in our new directory!".format(desktop))
+
+
+def _migrate_18_once(db):
+    if file.exists("~/.tarstall/version.json"):
+        os.remove(file.full("~/.tarstall/version.json"))
+
+
+def _migrate_19(program, info):
+    if info["update_url"] is not None:
+        info["update_archive_type"] = ".tar.gz"
+    else:
+        info["update_archive_type"] = None
+
+
+def _migrate_20_once(db):
+    global _bashrc_binlinks
+    _bashrc_binlinks = shell.parse_binlinks()
+
+
+def _migrate_20(program, info):
+    info["binlink_files"] = {}
+    for name in info["binlinks"]:
+        info["binlink_files"][name] = _bashrc_binlinks.get(program, {}).get(name, name)
+
+
+def _migrate_21(program, info):
+    info["update_validators"] = None
+
+
+def _migrate_22(program, info):
+    info["sha256"] = None
+    info["sha256_url"] = None
+
+
+"""
+Migrations, keyed by the file_version they upgrade from.
+
+"once" is run a single time with the database, and "program" is run with each program's name and
+entry in the database. "touches_files" marks migrations that change files outside of the database,
+which are skipped (but still reported) during a dry run.
+"""
+MIGRATIONS = {
+    11: {"description": "Adding 'update_url' key in database for all programs", "program": _migrate_11},
+    12: {"description": "Adding 'has_path' and 'binlinks' to programs", "program": _migrate_12},
+    13: {"description": "Adding 'UpdateURLPrograms' to config database", "once": _migrate_13_once},
+    14: {"description": "Adding 'PressEnterKey' to config database", "once": _migrate_14_once},
+    15: {"description": "Swapping to new saving of program type", "program": _migrate_15},
+    16: {"description": "Adding WarnMissingDeps key", "once": _migrate_16_once},
+    17: {"description": "Moving .desktop files to tarstall subdirectory", "once": _migrate_17_once,
+         "program": _migrate_17, "touches_files": True},
+    18: {"description": "Deleting version.json (if it exists!)", "once": _migrate_18_once, "touches_files": True},
+    19: {"description": "Upgrading all URL-updatable programs to specify archive type", "program": _migrate_19},
+    20: {"description": "Storing the file each binlink runs", "once": _migrate_20_once, "program": _migrate_20},
+    21: {"description": "Adding 'update_validators' to programs", "program": _migrate_21},
+    22: {"description": "Adding 'sha256' and 'sha256_url' to programs", "program": _migrate_22}
+}
+
+_bashrc_binlinks = {}  # Binlinks read from ~/.tarstall/.bashrc by _migrate_20_once()
+
+
+def run_migrations(dry_run=False):
+    """Run Migrations.
+
+    Upgrades the database from its file_version to the current one. Every pending migration is
+    applied to each program in a single pass over the programs, and the database is written once.
+
+    Args:
+        dry_run (bool): If True, only report what would change without changing anything. Defaults to False.
+
+    Returns:
+        dict[]: One dictionary per pending migration, containing "version" (the version it upgrades from),
+        "description", "programs" (the number of programs it changed), "touches_files", and "seconds" (time spent on it).
+
+    """
+    if "version" not in config.db:
+        return []
+    start_version = get_file_version('file')
+    end_version = config.get_version('file_version')
+    pending = [v for v in sorted(MIGRATIONS) if start_version <= v < end_version]
+    reports = {v: {"version": v, "description": MIGRATIONS[v]["description"], "programs": 0,
+                   "touches_files": MIGRATIONS[v].get("touches_files", False), "seconds": 0.0} for v in pending}
+    config.vprint("Upgrading files and database from {} to {}.".format(start_version, end_version))
+    if dry_run:
+        db = {"options": copy.deepcopy(config.db["options"]), "version": copy.deepcopy(config.db["version"])}
+    else:
+        db = config.db
+
+    with config.transaction():
+        for v in pending:
+            if "once" in MIGRATIONS[v] and not (dry_run and reports[v]["touches_files"]):
+                config.vprint(MIGRATIONS[v]["description"])
+                start = time.perf_counter()
+                MIGRATIONS[v]["once"](db)
+                reports[v]["seconds"] += time.perf_counter() - start
+
+        program_steps = [v for v in pending if "program" in MIGRATIONS[v] and not (dry_run and reports[v]["touches_files"])]
+        if program_steps:
+            for program in config.db["programs"]:
+                info = config.db["programs"][program]
+                if dry_run:
+                    info = copy.deepcopy(info)
+                for v in program_steps:
+                    before = json.dumps(info, sort_keys=True)
+                    start = time.perf_counter()
+                    MIGRATIONS[v]["program"](program, info)
+                    reports[v]["seconds"] += time.perf_counter() - start
+                    if json.dumps(info, sort_keys=True) != before:
+                        reports[v]["programs"] += 1
+
+        if not dry_run:
+            config.db["version"]["file_version"] = end_version
+            config.write_db()
+
+    if not dry_run:
+        journal.checkpoint(config.db)
+
+    for v in pending:
+        config.vprint("Migration from file version {} took {:.4f} seconds.".format(v, reports[v]["seconds"]))
+    return [reports[v] for v in pending]
+
+
 def tarstall_startup(start_fts=False, del_lock=False, old_upgrade=False, force_fix=False):
     """Run on Startup.
 
@@ -217,11 +457,11 @@ def tarstall_startup(start_fts=False, del_lock=False, old_upgrade=False, force_f
 
     Args:
         start_fts (bool): Whether or not to start first time setup
-        del_lock (bool): Whether or not to remove the lock (if it exists)
+        del_lock (bool): Whether or not to remove a lock left behind by an old version of tarstall (if it exists)
 
     Returns:
         str: One of many different values indicating the status of tarstall. Those include:
-        "Not installed", "Locked", "Good" (nothing bad happened), "Root", "Old" (happens
+        "Not installed", "Locked" (another tarstall held the lock for too long), "Good" (nothing bad happened), "Root", "Old" (happens
         when upgrading from tarstall prog_version 1), and "Unlocked" if tarstall
         was successfully unlocked. Can also return a string from first_time_setup,
         "DB Broken" if the database is corrupt, or "Missing Deps" if missing one or more dependencies.
@@ -243,17 +483,13 @@ def tarstall_startup(start_fts=False, del_lock=False, old_upgrade=False, force_f
         missing_deps = True
     if missing_deps:
         final_status = "Missing Deps"
-    if file.locked():  # Lock check
-        config.vprint("Lock file detected at /tmp/tarstall-lock.")
-        if del_lock:
-            config.vprint("Deleting the lock and continuing execution!")
-            file.unlock()
-            return "Unlocked"
-        else:
-            config.vprint("Lock file removal not specified; staying locked.")
-            return "Locked"
-    else:
-        file.lock()
+    if del_lock:  # Locks are released when tarstall exits, so only ones left by old versions of tarstall can be stale
+        if file.remove_legacy_lock():
+            config.vprint("Removed lock left by an old version of tarstall.")
+        return "Unlocked"
+    if not file.lock(shared=True):
+        config.vprint("Another instance of tarstall held the lock for too long; giving up.")
+        return "Locked"
 
     if config.db == {"refresh": True}:  # Downgrade check
         config.vprint("Finishing downgrade")
@@ -271,7 +507,9 @@ def tarstall_startup(start_fts=False, del_lock=False, old_upgrade=False, force_f
         config.vprint("Downgrade complete, returning back to tarstall execution...")
 
     if start_fts:  # Check if -f or --first is supplied
-        return first_time_setup()
+        status = first_time_setup()
+        file.lock(shared=True)
+        return status
 
     if not(file.exists('~/.tarstall/tarstall_execs/tarstall')):  # Make sure tarstall is installed
         return "Not installed"
@@ -282,77 +520,18 @@ def tarstall_startup(start_fts=False, del_lock=False, old_upgrade=False, force_f
         else:
             return "DB Broken"
 
-    file_version = get_file_version('file')
-    while config.get_version('file_version') > file_version:  # Lingering upgrades check
-        config.vprint("Upgrading files and database from {} to {}.".format(file_version, config.get_version("file_version")))
-
-        if file_version == 11:
-            config.vprint("Adding 'update_url' key in database for all programs!")
-            for program in config.db["programs"]:
-                config.db["programs"][program]["update_url"] = None
-
-        elif file_version == 12:
-            config.vprint("Adding 'has_path' and 'binlinks' to programs.")
-            for program in config.db["programs"]:
-                config.db["programs"][program]["has_path"] = False
-                config.db["programs"][program]["binlinks"] = []
-
-        elif file_version == 13:
-            config.vprint("Adding 'UpdateURLPrograms' to config database.")
-            config.db["options"]["UpdateURLPrograms"] = False
-
-        elif file_version == 14:
-            config.vprint("Adding 'PressEnterKey' to config database.")
-            config.db["options"]["PressEnterKey"] = True
-
-        elif file_version == 15:
-            config.vprint("Swapping to new saving of program type")
-            for program in config.db["programs"]:
-                if config.db["programs"][program]["git_installed"]:
-                    config.db["programs"][program]["install_type"] = "git"
-                else:
-                    config.db["programs"][program]["install_type"] = "default"
-                del config.db["programs"][program]["git_installed"]
-
-        elif file_version == 16:
-            config.vprint("Adding WarnMissingDeps key...")
-            config.db["options"]["WarnMissingDeps"] = True
-
-        elif file_version == 17:
-            config.vprint("Moving .desktop files to tarstall subdirectory")
-            if not file.exists("~/.local/share/applications/tarstall"):
-                config.vprint("Creating tarstall .desktop directory")
-                os.mkdir(file.full("~/.local/share/applications/tarstall"))
-            for program in config.db["programs"]:
-                for desktop in config.db["programs"][program]["desktops"]:
-                    if file.exists("~/.local/share/applications/{}.desktop".format(desktop)):
-                        config.vprint("Moving {} to tarstall subdirectory".format(desktop))
-                        move(file.full("~/.local/share/applications/{}.desktop".format(desktop)), file.full("~/.local/share/applications/tarstall/{}.desktop".format(desktop)))
-                    elif file.exists("~/.local/share/applications/tarstall/{}.desktop".format(desktop)):
-                        config.vprint("Not moving {}, it's already in our new directory!".format(desktop))
-
-        elif file_version == 18:
-            config.vprint("Deleting version.json (if it exists!)")
-            if file.exists("~/.tarstall/version.json"):
-                os.remove(file.full("~/.tarstall/version.json"))
-
-        elif file_version == 19:
-            config.vprint("Upgrading all URL-updatable programs to specify archive type.")
-            for program in config.db["programs"]:
-                if config.db["programs"][program]["update_url"] is not None:
-                    config.db["programs"][program]["update_archive_type"] = ".tar.gz"
-                else:
-                    config.db["programs"][program]["update_archive_type"] = None
-
-        config.db["version"]["file_version"] += 1
-        file_version = get_file_version('file')
-        config.write_db()
+    if get_file_version('file') < config.get_version('file_version'):  # Lingering upgrades check
+        if not file.lock():
+            return "Locked"
+        run_migrations()
+        file.lock(shared=True)
 
     if get_file_version('prog') == 1:  # Online update broke between prog versions 1 and 2 of tarstall
         return "Old"
 
     if config.read_config("AutoInstall"):  # Auto-update, if enabled
         update(show_progress=False)
+        file.lock(shared=True)
 
     username = getpass.getuser()  # Root check
     if username == 'root':
@@ -388,6 +567,7 @@ def create_db():
     """Creates Database."""
     config.db = get_default_db()
     config.write_db()
+    journal.checkpoint(config.db)
 
 
 def update(force_update=False, show_progress=True):
@@ -404,7 +584,7 @@ def update(force_update=False, show_progress=True):
         an internet connection, "Newer version" if the installed
         version is newer than the one online, "No update" if there is no update,
         "Updated" upon a successful update, "No git" if git isn't installed,
-        or "Failed" if it failed.
+        "Locked" if other tarstalls kept running for too long, or "Failed" if it failed.
 
     """
     if not can_update and not force_update:
@@ -413,6 +593,8 @@ def update(force_update=False, show_progress=True):
     elif not file.check_bin("git"):
         config.vprint("git isn't installed.")
         return "No git"
+    elif not file.lock():
+        return "Locked"
     generic.progress(5, show_progress)
     prog_version_internal = config.get_version('prog_internal_version')
     if not force_update:
@@ -428,53 +610,44 @@ def update(force_update=False, show_progress=True):
         config.vprint('Version on GitHub: ' + str(final_version))
     generic.progress(10, show_progress)
     if force_update or final_version > prog_version_internal:
-        try:
-            rmtree("/tmp/tarstall-update")
-        except FileNotFoundError:
-            pass
-        os.chdir("/tmp/")
-        os.mkdir("tarstall-update")
-        os.chdir("/tmp/tarstall-update")
-        config.vprint("Cloning tarstall repository from git")
-        err = git_clone_with_progress("https://github.com/hammy275/tarstall.git", 10, 55, config.branch)
-        if err != 0:
-            generic.progress(100, show_progress)
-            return "Failed"
-        generic.progress(55, show_progress)
-        config.vprint("Removing old tarstall files")
-        os.chdir(file.full("~/.tarstall/"))
-        files = os.listdir()
-        to_keep = ["bin", "database", ".bashrc", ".fishrc"]
-        progress = 55
-        adder = 15 / int(len(files) - len(to_keep))
-        for f in files:
-            if f not in to_keep:
+        with config.workspace("update") as update_dir:
+            config.vprint("Cloning tarstall repository from git")
+            err = git_clone_with_progress("https://github.com/hammy275/tarstall.git", 10, 55, config.branch, cwd=update_dir)
+            if err != 0:
+                generic.progress(100, show_progress)
+                return "Failed"
+            generic.progress(55, show_progress)
+            config.vprint("Removing old tarstall files")
+            os.chdir(file.full("~/.tarstall/"))
+            files = os.listdir()
+            to_keep = ["bin", "database", "database.sqlite", "options_cache", "journal", "journal_checkpoint", "shims", "shim_index",
+                       "fish_functions", "store", "versions", "manifests", "cache", ".work", ".bashrc", ".fishrc"]
+            removable = [f for f in files if f not in to_keep]
+            progress = 55
+            adder = 15 / max(len(removable), 1)
+            for f in removable:
                 if os.path.isdir(file.full("~/.tarstall/{}".format(f))):
                     rmtree(file.full("~/.tarstall/{}".format(f)))
                 else:
                     os.remove(file.full("~/.tarstall/{}".format(f)))
                 progress += adder
                 generic.progress(progress, show_progress)
-        generic.progress(70, show_progress)
-        config.vprint("Moving in new tarstall files")
-        os.chdir("/tmp/tarstall-update/tarstall/")
-        files = os.listdir()
-        to_ignore = [".git", ".gitignore", "README.md", "readme-images", "COPYING", "requirements.txt",
-                     "requirements-gui.txt", "tests", "install_tarstall", "version", "version.json", "test.sh"]
-        progress = 70
-        adder = 25 / int(len(files) - len(to_ignore))
-        for f in files:
-            if f not in to_ignore:
-                move("/tmp/tarstall-update/tarstall/{}".format(f), file.full("~/.tarstall/{}".format(f)))
+            generic.progress(70, show_progress)
+            config.vprint("Moving in new tarstall files")
+            os.chdir(os.path.join(update_dir, "tarstall"))
+            files = os.listdir()
+            to_ignore = [".git", ".gitignore", "README.md", "readme-images", "COPYING", "requirements.txt",
+                         "requirements-gui.txt", "tests", "benchmarks", "install_tarstall", "version", "version.json", "test.sh"]
+            to_move = [f for f in files if f not in to_ignore]
+            progress = 70
+            adder = 25 / max(len(to_move), 1)
+            for f in to_move:
+                move(os.path.join(update_dir, "tarstall", f), file.full("~/.tarstall/{}".format(f)))
                 progress += adder
                 generic.progress(progress, show_progress)
-        generic.progress(95, show_progress)
-        config.vprint("Removing old tarstall temp directory")
-        os.chdir(file.full("~/.tarstall/"))
-        try:
-            rmtree("/tmp/tarstall-update")
-        except FileNotFoundError:
-            pass
+            generic.progress(95, show_progress)
+            config.vprint("Removing old tarstall temp directory")
+            os.chdir(file.full("~/.tarstall/"))
         if not force_update:
             config.db["version"]["prog_internal_version"] = final_version
             config.write_db()
@@ -492,12 +665,14 @@ def erase():
     """Remove tarstall.
 
     Returns:
-        str: "Erased" on success, "Not installed" if tarstall isn't installed, or "No line" if the shell
-        line couldn't be removed.
+        str: "Erased" on success, "Not installed" if tarstall isn't installed, "Locked" if other tarstalls kept
+        running for too long, or "No line" if the shell line couldn't be removed.
 
     """
     if not (file.exists(file.full("~/.tarstall/tarstall_execs/tarstall"))):
         return "Not installed"
+    if not file.lock():
+        return "Locked"
     config.vprint('Removing source line from bashrc and fishrc')
     if file.get_shell_file() is not None:
         if "fish" in file.get_shell_file():
@@ -519,7 +694,17 @@ def erase():
                     pass
     generic.progress(40)
     config.vprint('Removing tarstall directory')
+    work = file.full(config.read_config("WorkDir"))
     rmtree(file.full('~/.tarstall'))
+    if os.path.isdir(work):  # WorkDir is outside of ~/.tarstall, so only remove what tarstall put there
+        for name in os.listdir(work):
+            if name.startswith("tarstall-"):
+                rmtree(os.path.join(work, name), ignore_errors=True)
+        try:
+            os.rmdir(work)
+        except OSError:
+            pass
+    journal.reset()
     generic.progress(90)
     try:
         rmtree("/tmp/tarstall-temp")
@@ -547,12 +732,14 @@ def first_time_setup():
 
     Returns:
         str: "Already installed" if already installed, "Success" on installation success, "Unsupported shell"
-        on success but the shell being used isn't supported.
+        on success but the shell being used isn't supported, or "Locked" if other tarstalls kept running for too long.
 
     """
     os.chdir(os.path.dirname(__file__))
     if file.exists(file.full('~/.tarstall/tarstall_execs/tarstall')):
         return "Already installed"
+    if not file.lock():
+        return "Locked"
     print('Installing tarstall to your system...')
     generic.progress(5)
     try:
@@ -560,23 +747,16 @@ def first_time_setup():
     except FileExistsError:
         rmtree(file.full("~/.tarstall"))
         os.mkdir(file.full("~/.tarstall"))
-    try:
-        os.mkdir(file.full("/tmp/tarstall-temp/"))
-    except FileExistsError:
-        rmtree(file.full("/tmp/tarstall-temp"))
-        os.mkdir(file.full("/tmp/tarstall-temp/"))
     generic.progress(10)
     os.mkdir(file.full("~/.tarstall/bin"))
     file.create("~/.tarstall/database")
-    create_db()
-    file.create("~/.tarstall/.bashrc")  # Create directories and files
+    create_db()  # Also generates ~/.tarstall/.bashrc and ~/.tarstall/.fishrc
     if not file.exists("~/.config"):
         os.mkdir(file.full("~/.config"))
     if not file.exists("~/.config/fish"):
         os.mkdir(file.full("~/.config/fish"))
     if not file.exists("~/.config/fish/config.fish"):
         file.create("~/.config/fish/config.fish")
-    file.create("~/.tarstall/.fishrc")
     generic.progress(15)
     progress = 15
     files = os.listdir()
@@ -607,10 +787,6 @@ def first_time_setup():
         os.mkdir(file.full("~/.local/share/applications"))
     if not file.exists("~/.local/share/applications/tarstall"):
         os.mkdir(file.full("~/.local/share/applications/tarstall"))
-    generic.progress(92)
-    file.add_line("export PATH=$PATH:{}".format(
-                file.full("~/.tarstall/tarstall_execs")), "~/.tarstall/.bashrc")  # Add bashrc line
-    file.add_line("set PATH $PATH {}".format(file.full("~/.tarstall/tarstall_execs")), "~/.tarstall/.fishrc")
     generic.progress(95)
     os.system('sh -c "chmod +x ~/.tarstall/tarstall_execs/tarstall"')
     file.unlock()
@@ -646,8 +822,8 @@ def get_online_version(type_of_replacement, branch=None):
         return -1
     version_url = "https://raw.githubusercontent.com/hammy275/tarstall/{}/version.json".format(branch)
     try:
-        version_raw = requests.get(version_url)
-    except requests.ConnectionError:
+        version_raw = generic_manage.session().get(version_url, timeout=generic_manage.DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
         return -2
     version = json.loads(version_raw.text.replace("\n", "").replace(" ", "").replace("\r", ""))["versions"]
     return version[type_of_replacement]
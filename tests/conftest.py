@@ -1,3 +1,10 @@
+import functools
+import gzip
+import os
+import re
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 
 import prog_manage
@@ -15,4 +22,106 @@ def pre_test(monkeypatch):
     tarstall_manage.verbose_toggle()
 
     monkeypatch.setattr('sys.stdin', StringIO("n\n"*3))
-    prog_manage._archive_install("./tests/fake_packages/package.tar.gz", "package")
\ No newline at end of file
+    prog_manage._archive_install("./tests/fake_packages/package.tar.gz", "package")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Serves files without logging, supporting single byte ranges ("Range: bytes=START-[END]")."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().do_GET()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.wfile.write(f.read(end - start + 1))
+
+
+class CutOffHandler(QuietHandler):
+    """Drops the connection halfway through the first whole file it sends."""
+    cut = False
+
+    def do_GET(self):
+        if "Range" in self.headers or CutOffHandler.cut:
+            return super().do_GET()
+        CutOffHandler.cut = True
+        with open(self.translate_path(self.path), "rb") as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data[:len(data) // 2])
+        self.close_connection = True
+
+
+class GzipHandler(QuietHandler):
+    """Compresses whole files with gzip ("Content-Encoding: gzip") when the client accepts it."""
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if "gzip" not in self.headers.get("Accept-Encoding", "") or "Range" in self.headers or not os.path.isfile(path):
+            return super().do_GET()
+        with open(path, "rb") as f:
+            data = gzip.compress(f.read())
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(handler_class, directory=os.path.join(os.path.dirname(__file__), "fake_packages")):
+    """Serves directory (tests/fake_packages by default) over HTTP with handler_class, yielding the base URL."""
+    handler = functools.partial(handler_class, directory=str(directory))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def http_server():
+    """Serves tests/fake_packages over HTTP, yielding the base URL."""
+    yield from serve(QuietHandler)
+
+
+@pytest.fixture
+def cut_off_http_server():
+    """Like http_server, but the first download of a whole file is cut off halfway through."""
+    CutOffHandler.cut = False
+    yield from serve(CutOffHandler)
+
+
+@pytest.fixture
+def gzip_http_server():
+    """Like http_server, but whole files are gzipped if the client accepts it."""
+    yield from serve(GzipHandler)
+
+
+@pytest.fixture
+def tmp_http_server(tmp_path):
+    """Serves the test's tmp_path over HTTP, yielding the base URL."""
+    yield from serve(QuietHandler, tmp_path)
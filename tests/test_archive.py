@@ -0,0 +1,98 @@
+import lzma
+import os
+import tarfile
+import zipfile
+from shutil import rmtree
+
+import archive
+
+
+def make_dest():
+    rmtree("/tmp/tarstall-test-extract", ignore_errors=True)
+    os.mkdir("/tmp/tarstall-test-extract")
+    return "/tmp/tarstall-test-extract"
+
+
+def test_extract_zip():
+    with zipfile.ZipFile("/tmp/tarstall-test.zip", "w") as zf:
+        info = zipfile.ZipInfo("program/run.sh")
+        info.external_attr = 0o100755 << 16
+        zf.writestr(info, "echo hi\n")
+        zf.writestr("../escape.txt", "nope")
+    dest = make_dest()
+    assert archive.extract("/tmp/tarstall-test.zip", dest) == "Extracted"
+    assert os.access(os.path.join(dest, "program/run.sh"), os.X_OK)
+    assert not os.path.exists("/tmp/escape.txt")
+    assert archive.program_root(dest, "other") == os.path.join(dest, "program")
+    os.remove("/tmp/tarstall-test.zip")
+    rmtree(dest)
+
+
+def test_extract_zip_unsupported():
+    with zipfile.ZipFile("/tmp/tarstall-test.zip", "w") as zf:
+        zf.writestr("program/run.sh", "echo hi\n")
+    with open("/tmp/tarstall-test.zip", "rb") as f:
+        data = bytearray(f.read())
+    for signature, offset in [(b"PK\x03\x04", 8), (b"PK\x01\x02", 10)]:  # Compression method 99 (AES)
+        start = data.index(signature) + offset
+        data[start:start + 2] = (99).to_bytes(2, "little")
+    with open("/tmp/tarstall-test.zip", "wb") as f:
+        f.write(data)
+    dest = make_dest()
+    assert archive.extract("/tmp/tarstall-test.zip", dest) == "Error"
+    os.remove("/tmp/tarstall-test.zip")
+    rmtree(dest)
+
+
+def test_extract_tar():
+    with open("/tmp/tarstall-test-file", "w") as f:
+        f.write("test")
+    with tarfile.open("/tmp/tarstall-test.tar.xz", "w:xz") as tar:
+        tar.add("/tmp/tarstall-test-file", "a")
+        tar.add("/tmp/tarstall-test-file", "b")
+    dest = make_dest()
+    assert archive.extract("/tmp/tarstall-test.tar.xz", dest) == "Extracted"
+    assert sorted(os.listdir(dest)) == ["a", "b"]
+    assert archive.program_root(dest, "a") == dest  # "a" is a file, not a folder to strip
+    assert archive.extract("/tmp/tarstall-test-file", dest) == "Bad Filetype"
+    os.remove("/tmp/tarstall-test.tar.xz")
+    os.remove("/tmp/tarstall-test-file")
+    rmtree(dest)
+
+
+def test_extract_tar_padded():
+    with open("/tmp/tarstall-test-file", "w") as f:
+        f.write("test")
+    tar_path = "/tmp/tarstall-test.tar"
+    with tarfile.open(tar_path, "w") as tar:
+        tar.add("/tmp/tarstall-test-file", "a")
+    with open(tar_path, "rb") as f:
+        data = f.read() + bytes(8 * 1024 * 1024)  # Zeros after the end of the archive, like some tar writers leave
+    with open("/tmp/tarstall-test.tar.xz", "wb") as f:
+        f.write(lzma.compress(data))
+    dest = make_dest()
+    assert archive.extract("/tmp/tarstall-test.tar.xz", dest, threads=2) == "Extracted"
+    assert os.listdir(dest) == ["a"]
+    for path in [tar_path, "/tmp/tarstall-test.tar.xz", "/tmp/tarstall-test-file"]:
+        os.remove(path)
+    rmtree(dest)
+
+
+def test_extract_tar_threads():
+    os.makedirs("/tmp/tarstall-test-tree/program/bin", exist_ok=True)
+    for i in range(20):
+        with open("/tmp/tarstall-test-tree/program/bin/file{}".format(i), "w") as f:
+            f.write(str(i) * 1000)
+    os.chmod("/tmp/tarstall-test-tree/program/bin/file0", 0o755)
+    for ext, mode in [(".tar.gz", "w:gz"), (".tar.xz", "w:xz")]:
+        with tarfile.open("/tmp/tarstall-test" + ext, mode) as tar:
+            tar.add("/tmp/tarstall-test-tree/program", "program")
+        dest = make_dest()
+        assert archive.extract("/tmp/tarstall-test" + ext, dest, threads=4) == "Extracted"
+        assert len(os.listdir(os.path.join(dest, "program/bin"))) == 20
+        with open(os.path.join(dest, "program/bin/file7")) as f:
+            assert f.read() == "7" * 1000
+        assert os.access(os.path.join(dest, "program/bin/file0"), os.X_OK)
+        os.remove("/tmp/tarstall-test" + ext)
+    rmtree("/tmp/tarstall-test-tree")
+    rmtree(dest)
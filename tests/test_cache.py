@@ -0,0 +1,90 @@
+import os
+import time
+
+import cache
+import config
+import file
+import prog_manage
+
+
+def make_archive(name, size):
+    path = "/tmp/tarstall-test-" + name
+    with open(path, "wb") as f:
+        f.write(name.encode() * size)
+    return path
+
+
+def test_add_evicts_least_recently_used():
+    config.change_config("CacheSize", "change", 2500)
+    assert cache.add(make_archive("a", 1000), "http://example.com/a.zip", "a" * 64, ".zip", None)
+    assert cache.add(make_archive("b", 1000), "http://example.com/b.zip", "b" * 64, ".zip", None)
+    assert cache.lookup("http://example.com/a.zip")["sha256"] == "a" * 64
+    assert cache.fetch_hash("a" * 64, ".zip", "/tmp/tarstall-test-fetched")
+    os.remove("/tmp/tarstall-test-fetched")
+    assert cache.add(make_archive("c", 1000), "http://example.com/c.zip", "c" * 64, ".zip", None)
+    assert [entry["name"] for entry in cache.entries()] == ["c" * 64 + ".zip", "a" * 64 + ".zip"]
+    assert cache.lookup("http://example.com/b.zip") is None
+    assert not os.path.exists(cache.object_path("b" * 64 + ".zip"))
+    assert not cache.add(make_archive("d", 3000), "http://example.com/d.zip", "d" * 64, ".zip", None)
+
+
+def test_prune():
+    config.change_config("CacheSize", "change", 5000)
+    cache.add(make_archive("a", 1000), "http://example.com/a.zip", "a" * 64, ".zip", None)
+    cache.add(make_archive("b", 1000), "http://example.com/b.zip", "b" * 64, ".zip", None)
+    with open(cache.object_path("unknown"), "w") as f:
+        f.write("x")
+    assert cache.prune() == (1, 1)
+    config.change_config("CacheSize", "change", 1500)
+    assert cache.prune() == (1, 1000)
+    assert [entry["name"] for entry in cache.entries()] == ["b" * 64 + ".zip"]
+    config.change_config("CacheSize", "change", 0)
+    assert cache.prune() == (1, 1000)
+    assert cache.entries() == []
+
+
+def test_install_from_cache(http_server, monkeypatch):
+    assert not cache.enabled()  # Off by default
+    config.change_config("CacheSize", "change", 1024 * 1024)
+    url = http_server + "package.tar.gz"
+    assert prog_manage.install(url, override_name="cached") == ("Installed", "cached")
+    assert [entry["urls"] for entry in cache.entries()] == [[url]]
+    fetched = []
+    fetch_hash = cache.fetch_hash
+    monkeypatch.setattr(cache, "fetch_hash", lambda *args: fetched.append(cache.lookup(url)) or fetch_hash(*args))
+    assert prog_manage.uninstall("cached") == "Success"
+    assert prog_manage.install(url, override_name="cached") == ("Installed", "cached")
+    assert fetched[0]["validators"] == config.db["programs"]["cached"]["update_validators"]
+    assert os.path.isfile(file.full("~/.tarstall/bin/cached/test.sh"))
+    assert prog_manage.install_batch([(url, "batched")], show_progress=False)[0][1] == "Installed"
+    assert fetched[1] is not None
+    assert os.path.isfile(file.full("~/.tarstall/bin/batched/test.sh"))
+    assert len(cache.entries()) == 1
+
+
+def test_install_changed_skips_cache(tmp_http_server, tmp_path, monkeypatch):
+    config.change_config("CacheSize", "change", 1024 * 1024)
+    with open("tests/fake_packages/package.tar.gz", "rb") as f:
+        (tmp_path / "package.tar.gz").write_bytes(f.read())
+    url = tmp_http_server + "package.tar.gz"
+    assert prog_manage.install(url, override_name="cached") == ("Installed", "cached")
+    fetched = []
+    monkeypatch.setattr(cache, "fetch_hash", lambda *args: fetched.append(args))
+    os.utime(tmp_path / "package.tar.gz", (time.time() + 3600,) * 2)  # A new Last-Modified, so the cached archive is out of date
+    assert prog_manage.update_program("cached", show_progress=False) == "Success"
+    os.utime(tmp_path / "package.tar.gz", (time.time() + 7200,) * 2)
+    assert prog_manage.install_batch([(url, "batched")], show_progress=False)[0][1] == "Installed"
+    assert fetched == []
+
+
+def test_install_from_cache_by_sha256(http_server):
+    config.change_config("CacheSize", "change", 1024 * 1024)
+    assert prog_manage.install(http_server + "package.tar.gz", override_name="cached") == ("Installed", "cached")
+    sha256 = cache.entries()[0]["name"].partition(".")[0]
+    assert prog_manage.install(http_server + "mirror/package.tar.gz", override_name="mirrored",
+                               sha256=sha256) == ("Installed", "mirrored")  # Not on the server, so only in the cache
+    assert os.path.isfile(file.full("~/.tarstall/bin/mirrored/test.sh"))
+    validators = {"etag": '"old"', "last_modified": None, "length": 1}
+    assert prog_manage._download_install(http_server + "mirror/package.tar.gz", "mirrored", ".tar.gz", show_progress=False,
+                                         validators=validators, sha256=sha256) == ("Installed", sha256)
+    assert validators == {"etag": '"old"', "last_modified": None, "length": 1}  # Kept, since the server wasn't asked
@@ -1,6 +1,7 @@
 import config
 
 import file
+import os
 import json
 
 import tarstall_manage
@@ -43,7 +44,11 @@ def test_get_db():
                 "post_upgrade_script": None,
                 "update_url": None,
                 "has_path": False,
-                "binlinks": []
+                "binlinks": [],
+                "binlink_files": {},
+                "update_validators": None,
+                "sha256": None,
+                "sha256_url": None
             }
         }
     }
@@ -57,3 +62,66 @@ def test_write_db():
     with open(file.full("~/.tarstall/database")) as f:
         db = json.load(f)
     assert old_db == db
+
+
+def test_transaction():
+    with open(file.full("~/.tarstall/database")) as f:
+        before = f.read()
+    with config.transaction():
+        config.change_config("AutoInstall", "flip")
+        config.change_config("SkipQuestions", "flip")
+        with open(file.full("~/.tarstall/database")) as f:
+            assert f.read() == before
+    assert file.get_db()["options"]["AutoInstall"] is True
+    assert file.get_db()["options"]["SkipQuestions"] is True
+
+
+def test_transaction_rollback():
+    try:
+        with config.transaction():
+            config.change_config("AutoInstall", "flip")
+            raise ValueError
+    except ValueError:
+        pass
+    assert config.read_config("AutoInstall") is False
+    assert file.get_db()["options"]["AutoInstall"] is False
+
+
+def test_workspace():
+    with config.workspace("test") as first, config.workspace("test") as second:
+        assert first != second
+        assert os.path.dirname(first) == config.work_dir()
+    assert not os.path.exists(first) and not os.path.exists(second)
+    try:
+        with config.workspace("test") as failed:
+            raise ValueError
+    except ValueError:
+        pass
+    assert not os.path.exists(failed)
+
+
+def test_write_db_merges():
+    assert "package" in config.db["programs"]
+    with open(file.full("~/.tarstall/database")) as f:
+        other = json.load(f)  # Another tarstall installs a program after this one read the database
+    other["programs"]["other"] = dict(other["programs"]["package"])
+    file.atomic_write(json.dumps(other), "~/.tarstall/database")
+    import prog_manage
+    assert prog_manage.pathify("package") == "Complete"
+    assert config.db["programs"]["other"] == other["programs"]["package"]
+    db = file.get_db()
+    assert "other" in db["programs"]
+    assert db["programs"]["package"]["has_path"] is True
+
+
+def test_write_db_shell_files(monkeypatch):
+    import prog_manage
+    import shell
+    written = []
+    monkeypatch.setattr(shell, "write_shell_files", lambda db: written.append(db))
+    config.change_config("AutoInstall", "flip")
+    assert written == []
+    assert prog_manage.pathify("package") == "Complete"
+    assert len(written) == 1
+    config.change_config("UseShims", "flip")
+    assert len(written) == 2
@@ -1,4 +1,14 @@
+import errno
+import fcntl
 import os
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
 
 import file
 
@@ -79,15 +89,187 @@ def test_replace_in_file():
     os.remove("/tmp/tarstall-test-temp")
 
 
+def _hold_lock(lock_name, mode):
+    """Start another process holding a lock, returning it once the lock is held."""
+    proc = subprocess.Popen([sys.executable, "-c", "import fcntl, sys, time\n"
+                             "f = open(sys.argv[1], 'a')\nfcntl.flock(f, int(sys.argv[2]))\nprint('held', flush=True)\ntime.sleep(30)",
+                             os.path.join(file.LOCKS_PATH, lock_name + ".lock"), str(mode)], stdout=subprocess.PIPE, text=True)
+    assert proc.stdout.readline() == "held\n"
+    return proc
+
+
 def test_lock():
-    file.lock()
-    assert os.path.isfile("/tmp/tarstall-lock")
+    assert file.lock(shared=True)
+    assert not file.locked()
+    assert file.lock()
+    assert file.lock(shared=True)
+    file.unlock()
+    proc = _hold_lock("tarstall", fcntl.LOCK_SH)
+    try:
+        assert file.lock(shared=True, timeout=0.2)  # Any number of tarstalls can share it
+        assert not file.lock(timeout=0.2)
+        assert file.lock(shared=True, timeout=0)  # Still held after failing to upgrade
+    finally:
+        proc.kill()
+        proc.wait()
+    assert file.lock(timeout=1)
+    file.unlock()
 
 
 def test_locked():
-    assert file.locked() == os.path.isfile("/tmp/tarstall-lock")
+    file.unlock()
+    proc = _hold_lock("tarstall", fcntl.LOCK_EX)
+    try:
+        assert file.locked()
+        assert not file.lock(shared=True, timeout=0.2)
+    finally:
+        proc.kill()
+        proc.wait()
+    assert not file.locked()
+
+
+def test_program_lock():
+    proc = _hold_lock("program-package", fcntl.LOCK_EX)
+    try:
+        with file.program_lock(["other", "package"], timeout=0.2) as locked:
+            assert not locked
+        with file.program_lock("other", timeout=0.2) as locked:
+            assert locked
+            with file.program_lock("other", timeout=0) as locked_again:
+                assert locked_again
+    finally:
+        proc.kill()
+        proc.wait()
+    with file.program_lock(["other", "package"], timeout=1) as locked:
+        assert locked
+    assert "program-other" not in file._locks
+
+
+def test_db_lock():
+    proc = _hold_lock("database", fcntl.LOCK_EX)
+    try:
+        with pytest.raises(TimeoutError):
+            with file.db_lock(timeout=0.2):
+                pass
+    finally:
+        proc.kill()
+        proc.wait()
+    with file.db_lock(timeout=1):
+        assert "database" in file._locks
+    assert "database" not in file._locks
+
+
+def test_lock_threads():
+    inside = []
+    overlapped = []
+
+    def hold():
+        with file.cache_lock(timeout=5):
+            inside.append(1)
+            overlapped.append(len(inside) > 1)
+            time.sleep(0.05)
+            inside.pop()
+
+    threads = [threading.Thread(target=hold) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlapped == [False] * 4
+    with file.cache_lock():
+        result = []
+        thread = threading.Thread(target=lambda: result.append(file._acquire("cache", fcntl.LOCK_EX, 0.1)))
+        thread.start()
+        thread.join()
+        assert result == [False]
+    assert "cache" not in file._locks
 
 
 def test_unlock():
+    file.lock()
     file.unlock()
-    assert not os.path.isfile("/tmp/tarstall-lock")
\ No newline at end of file
+    assert "tarstall" not in file._locks
+
+
+def test_remove_legacy_lock():
+    file.create("/tmp/tarstall-lock")
+    assert file.remove_legacy_lock()
+    assert not os.path.isfile("/tmp/tarstall-lock")
+    assert not file.remove_legacy_lock()
+
+
+def test_rewrite_file():
+    with open("/tmp/tarstall-test-temp", "w") as f:
+        f.write("keep # a\nremove # a\nreplace me\n")
+    counts = file.rewrite_file("/tmp/tarstall-test-temp", [("remove", None),
+                                                           (lambda l: l.startswith("replace"), lambda l: l.replace("me", "you"))])
+    assert counts == [1, 1]
+    with open("/tmp/tarstall-test-temp") as f:
+        assert f.read() == "keep # a\nreplace you\n"
+    mtime = os.stat("/tmp/tarstall-test-temp").st_mtime_ns
+    assert file.rewrite_file("/tmp/tarstall-test-temp", [("not here", None)]) == [0]
+    assert os.stat("/tmp/tarstall-test-temp").st_mtime_ns == mtime
+    os.remove("/tmp/tarstall-test-temp")
+
+
+def make_copy_tree(root):
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(os.path.join(root, "bin"))
+    with open(os.path.join(root, "bin", "run"), "w") as f:
+        f.write("echo hi\n" * 1000)
+    os.chmod(os.path.join(root, "bin", "run"), 0o755)
+    os.link(os.path.join(root, "bin", "run"), os.path.join(root, "run-link"))
+    os.symlink("bin/run", os.path.join(root, "run"))
+    os.utime(os.path.join(root, "bin"), ns=(10 ** 18, 10 ** 18))
+
+
+def check_copied_tree(source_stats, dest):
+    assert os.readlink(os.path.join(dest, "run")) == "bin/run"
+    st = os.stat(os.path.join(dest, "bin", "run"))
+    assert stat.S_IMODE(st.st_mode) == 0o755
+    assert st.st_mtime_ns == source_stats["run"].st_mtime_ns
+    assert os.stat(os.path.join(dest, "bin")).st_mtime_ns == 10 ** 18
+    assert os.path.samefile(os.path.join(dest, "bin", "run"), os.path.join(dest, "run-link"))
+    with open(os.path.join(dest, "run-link")) as f:
+        assert f.read() == "echo hi\n" * 1000
+
+
+def test_copy_tree():
+    make_copy_tree("/tmp/tarstall-test-copy")
+    stats = {"run": os.stat("/tmp/tarstall-test-copy/bin/run")}
+    shutil.rmtree("/tmp/tarstall-test-copied", ignore_errors=True)
+    counts = file.copy_tree("/tmp/tarstall-test-copy", "/tmp/tarstall-test-copied", threads=2)
+    assert counts["hardlink"] == 1
+    assert sum(counts.values()) == 2
+    check_copied_tree(stats, "/tmp/tarstall-test-copied")
+    shutil.rmtree("/tmp/tarstall-test-copy")
+    shutil.rmtree("/tmp/tarstall-test-copied")
+
+
+def test_copy_file_fallback(monkeypatch):
+    with open("/tmp/tarstall-test-temp", "wb") as f:
+        f.write(os.urandom(100000))
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(fcntl, "ioctl", unsupported)
+    monkeypatch.setattr(os, "copy_file_range", unsupported)
+    assert file.copy_file("/tmp/tarstall-test-temp", "/tmp/tarstall-test-temp-two") == "sendfile"
+    monkeypatch.setattr(os, "sendfile", unsupported)
+    assert file.copy_file("/tmp/tarstall-test-temp", "/tmp/tarstall-test-temp-two") == "userspace"
+    assert file.hash_file("/tmp/tarstall-test-temp") == file.hash_file("/tmp/tarstall-test-temp-two")
+    os.remove("/tmp/tarstall-test-temp")
+    os.remove("/tmp/tarstall-test-temp-two")
+
+
+def test_move_tree():
+    if not os.path.isdir("/dev/shm") or os.stat("/dev/shm").st_dev == os.stat("/tmp").st_dev:
+        pytest.skip("Needs /dev/shm on another filesystem than /tmp")
+    make_copy_tree("/dev/shm/tarstall-test-move")
+    stats = {"run": os.stat("/dev/shm/tarstall-test-move/bin/run")}
+    shutil.rmtree("/tmp/tarstall-test-moved", ignore_errors=True)
+    file.move_tree("/dev/shm/tarstall-test-move", "/tmp/tarstall-test-moved")
+    assert not os.path.exists("/dev/shm/tarstall-test-move")
+    check_copied_tree(stats, "/tmp/tarstall-test-moved")
+    file.move_tree("/tmp/tarstall-test-moved", "/tmp/tarstall-test-renamed")
+    assert os.path.isdir("/tmp/tarstall-test-renamed")
+    shutil.rmtree("/tmp/tarstall-test-renamed")
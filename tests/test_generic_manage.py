@@ -0,0 +1,137 @@
+import hashlib
+import os
+import threading
+import types
+import urllib.parse
+
+import pytest
+
+import config
+import generic_manage
+
+PACKAGE = os.path.join(os.path.dirname(__file__), "fake_packages/package.tar.gz")
+
+
+def package_hash():
+    with open(PACKAGE, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_download_stream(http_server):
+    download = generic_manage.Download(http_server + "package.tar.gz")
+    assert download.size == os.path.getsize(PACKAGE)
+    assert download.offset == 0
+    data = download.read()
+    download.close()
+    assert hashlib.sha256(data).hexdigest() == package_hash()
+
+
+def test_download_stream_uncompressed(gzip_http_server):
+    download = generic_manage.Download(gzip_http_server + "package.tar.gz")
+    data = download.read()
+    download.close()
+    assert hashlib.sha256(data).hexdigest() == package_hash()
+
+
+def test_download(http_server):
+    hasher = hashlib.sha256()
+    generic_manage.download(http_server + "package.tar.gz", "/tmp/tarstall-test-download", hasher=hasher,
+                            show_progress=False)
+    assert hasher.hexdigest() == package_hash()
+    assert generic_manage.session() is generic_manage.session()
+    os.remove("/tmp/tarstall-test-download")
+
+
+def test_download_not_modified(http_server):
+    url = http_server + "package.tar.gz"
+    validators = generic_manage.download(url, "/tmp/tarstall-test-download", show_progress=False)
+    os.remove("/tmp/tarstall-test-download")
+    assert validators["length"] == os.path.getsize(PACKAGE)
+    assert generic_manage.download(url, "/tmp/tarstall-test-download", show_progress=False,
+                                   validators=validators) is None
+    assert not os.path.exists("/tmp/tarstall-test-download")
+    dl = generic_manage.Download(url, validators={"etag": None, "last_modified": "Thu, 01 Jan 1970 00:00:00 GMT"})
+    assert not dl.not_modified
+    dl.close()
+
+
+def test_download_replaces(http_server):
+    with open(PACKAGE, "rb") as f:
+        data = f.read()
+    for existing in [b"x" * 100, data]:  # Never mistaken for the start of the download
+        with open("/tmp/tarstall-test-download", "wb") as f:
+            f.write(existing)
+        hasher = hashlib.sha256()
+        generic_manage.download(http_server + "package.tar.gz", "/tmp/tarstall-test-download", hasher=hasher,
+                                show_progress=False)
+        assert hasher.hexdigest() == package_hash()
+        with open("/tmp/tarstall-test-download", "rb") as f:
+            assert hashlib.sha256(f.read()).hexdigest() == package_hash()
+    os.remove("/tmp/tarstall-test-download")
+
+
+def test_download_cut_off(cut_off_http_server):
+    hasher = hashlib.sha256()
+    generic_manage.download(cut_off_http_server + "package.tar.gz", "/tmp/tarstall-test-download", hasher=hasher,
+                            show_progress=False)
+    assert hasher.hexdigest() == package_hash()
+    os.remove("/tmp/tarstall-test-download")
+
+
+def test_download_missing(http_server):
+    with pytest.raises(OSError):
+        generic_manage.Download(http_server + "missing.tar.gz")
+    with pytest.raises(OSError):
+        generic_manage.download(http_server + "missing.tar.gz", "/tmp/tarstall-test-download", show_progress=False)
+    assert not os.path.exists("/tmp/tarstall-test-download")
+
+
+class CountingSemaphore(threading.BoundedSemaphore):
+    """Semaphore that records how many times it was acquired, and the most holders it had at once."""
+
+    def __init__(self, value):
+        super().__init__(value)
+        self._count_lock = threading.Lock()
+        self.held = self.most = self.acquired = 0
+
+    def acquire(self, *args, **kwargs):
+        result = super().acquire(*args, **kwargs)
+        with self._count_lock:
+            self.held += 1
+            self.acquired += 1
+            self.most = max(self.most, self.held)
+        return result
+
+    def release(self):
+        with self._count_lock:
+            self.held -= 1
+        super().release()
+
+
+def test_download_segments(tmp_http_server, tmp_path, monkeypatch):
+    data = os.urandom(1024 * 1024)
+    (tmp_path / "big.zip").write_bytes(data)
+    monkeypatch.setattr(generic_manage, "SEGMENT_MIN_SIZE", 128 * 1024)
+    config.change_config("DownloadSegments", "change", 4)
+    slot = CountingSemaphore(2)
+    monkeypatch.setitem(generic_manage._host_slots, urllib.parse.urlsplit(tmp_http_server).netloc, slot)
+    hasher = hashlib.sha256()
+    validators = generic_manage.download(tmp_http_server + "big.zip", "/tmp/tarstall-test-download", hasher=hasher,
+                                         show_progress=False)
+    assert validators["length"] == len(data)
+    assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+    with open("/tmp/tarstall-test-download", "rb") as f:
+        assert f.read() == data
+    assert slot.acquired == 4  # One connection per segment
+    assert slot.most == 2
+    assert slot.held == 0
+    os.remove("/tmp/tarstall-test-download")
+
+
+def test_segment_count(monkeypatch):
+    monkeypatch.setattr(generic_manage, "SEGMENT_MIN_SIZE", 1)
+    config.change_config("DownloadSegments", "change", 4)
+    dl = types.SimpleNamespace(ranges=True, size=100, validators={"etag": '"abc"', "last_modified": None})
+    assert generic_manage.segment_count(dl) == 4
+    dl.validators = {"etag": 'W/"abc"', "last_modified": None}  # Nothing to send If-Range with
+    assert generic_manage.segment_count(dl) == 1
@@ -0,0 +1,54 @@
+import os
+
+import config
+import file
+import manifest
+import prog_manage
+
+
+def test_verify():
+    assert manifest.verify("package") == {"missing": [], "changed": [], "extra": []}
+    with open(file.full("~/.tarstall/bin/package/test.sh"), "a") as f:
+        f.write("echo changed\n")
+    with open(file.full("~/.tarstall/bin/package/new.txt"), "w") as f:
+        f.write("new")
+    assert manifest.verify("package") == {"missing": [], "changed": ["test.sh"], "extra": ["new.txt"]}
+    os.remove(file.full("~/.tarstall/bin/package/test.sh"))
+    assert manifest.verify("package")["missing"] == ["test.sh"]
+    manifest.remove("package")
+    assert manifest.verify("package") is None
+
+
+def test_disk_usage():
+    size = os.path.getsize(file.full("~/.tarstall/bin/package/test.sh"))
+    assert manifest.disk_usage("package") >= size
+    manifest.remove("package")
+    assert manifest.disk_usage("package") >= size
+
+
+def test_rename_and_uninstall():
+    prog_manage.rename("package", "renamed")
+    assert manifest.read("package") is None
+    assert "test.sh" in manifest.read("renamed")
+    prog_manage.uninstall("renamed")
+    assert manifest.read("renamed") is None
+
+
+def test_link_unchanged():
+    os.chdir(os.path.realpath(__file__)[:-17])
+    config.change_config("VersionedInstalls", "change", True)
+    prog_manage.install("./fake_packages/package.tar.gz", overwrite=True)
+    prog_manage.install("./fake_packages/package.tar.gz", overwrite=True)
+    old = os.stat(file.full("~/.tarstall/versions/package/1/test.sh"))
+    new = os.stat(file.full("~/.tarstall/versions/package/2/test.sh"))
+    assert old.st_ino == new.st_ino
+    assert manifest.verify("package") == {"missing": [], "changed": [], "extra": []}
+
+
+def test_place_without_hashes(monkeypatch):
+    os.chdir(os.path.realpath(__file__)[:-17])
+    monkeypatch.setattr(file, "hash_file", None)  # Nothing reuses the hashes without the store or VersionedInstalls
+    monkeypatch.setattr(manifest, "link_unchanged", None)
+    assert prog_manage.install("./fake_packages/package.tar.gz", overwrite=True) == ("Installed", "package")
+    assert manifest.read("package")["test.sh"][3] is None
+    assert manifest.verify("package", check_hashes=False) == {"missing": [], "changed": [], "extra": []}
@@ -1,5 +1,14 @@
+import hashlib
 import os
+import shutil
+import subprocess
+import sys
+from contextlib import contextmanager
 
+import pytest
+
+import archive
+import config
 import file
 import prog_manage
 
@@ -8,7 +17,6 @@ To write tests for:
 update
 
 manage
-binlink
 dirinstall
 get_online_version
 get_file_version
@@ -31,6 +39,72 @@ def test_pathify():
     assert file.check_line("export PATH=$PATH:~/.tarstall/bin/package # package", "~/.tarstall/.bashrc", "fuzzy")
 
 
+def test_add_binlink():
+    assert prog_manage.add_binlink("test.sh", "package") == "Added"
+    assert prog_manage.add_binlink("test.sh", "package") == "Already there"
+    assert file.check_line("alias test.sh='cd {}/ && ./test.sh' # package".format(file.full("~/.tarstall/bin/package")),
+                           "~/.tarstall/.bashrc", "fuzzy")
+
+
+def test_rename():
+    prog_manage.pathify("package")
+    prog_manage.add_binlink("test.sh", "package")
+    assert prog_manage.rename("package", "renamed") == "renamed"
+    assert file.check_line("export PATH=$PATH:~/.tarstall/bin/renamed # renamed", "~/.tarstall/.bashrc", "fuzzy")
+    assert file.check_line("# package", "~/.tarstall/.bashrc", "fuzzy") is False
+    assert file.check_line("set PATH $PATH ~/.tarstall/bin/renamed # renamed", "~/.tarstall/.fishrc", "fuzzy")
+
+
+def test_shims_after_script_update(tmp_path):
+    config.change_config("UseShims", "change", True)
+    prog_manage.pathify("package")
+    script = tmp_path / "build.sh"
+    script.write_text("#!/bin/sh\nprintf '#!/bin/sh\\n' > built.sh\nchmod +x built.sh\n")
+    script.chmod(0o755)
+    prog_manage.update_script("package", str(script))
+    assert prog_manage.update_program("package", show_progress=False) == "Success"
+    assert os.readlink(file.full("~/.tarstall/shims/built.sh")) == file.full("~/.tarstall/bin/package/built.sh")
+
+
+def test_rename_locked(monkeypatch):
+    @contextmanager
+    def db_lock(timeout=None):
+        raise TimeoutError("Another tarstall held the database lock for too long")
+        yield
+
+    monkeypatch.setattr(config, "db_lock", db_lock)
+    assert prog_manage.rename("package", "renamed") == "Locked"
+    assert "package" in config.db["programs"] and "renamed" not in config.db["programs"]
+    assert os.path.isfile(file.full("~/.tarstall/bin/package/test.sh"))
+    assert not os.path.exists(file.full("~/.tarstall/bin/renamed"))
+
+
+def test_shims():
+    config.change_config("UseShims", "change", True)
+    prog_manage.pathify("package")
+    assert os.readlink(file.full("~/.tarstall/shims/test.sh")) == file.full("~/.tarstall/bin/package/test.sh")
+    prog_manage.rename("package", "renamed")
+    assert os.readlink(file.full("~/.tarstall/shims/test.sh")) == file.full("~/.tarstall/bin/renamed/test.sh")
+    prog_manage.add_binlink("test.sh", "renamed")
+    assert not os.path.islink(file.full("~/.tarstall/shims/test.sh"))  # Binlinks take priority over PATH
+    assert os.access(file.full("~/.tarstall/shims/test.sh"), os.X_OK)
+    assert file.check_line("# renamed", "~/.tarstall/.bashrc", "fuzzy") is False
+    assert file.check_line("export PATH=$PATH:{}".format(file.full("~/.tarstall/shims")), "~/.tarstall/.bashrc", "fuzzy")
+    config.change_config("UseShims", "change", False)
+    assert not os.path.isdir(file.full("~/.tarstall/shims"))
+
+
+def test_fish_autoload():
+    config.change_config("FishAutoload", "change", True)
+    prog_manage.add_binlink("test.sh", "package")
+    assert file.exists("~/.tarstall/fish_functions/test.sh.fish")
+    assert file.check_line("function test.sh", "~/.tarstall/.fishrc", "fuzzy") is False
+    prog_manage.rename("package", "renamed")
+    assert file.check_line("# renamed", "~/.tarstall/fish_functions/test.sh.fish", "fuzzy")
+    prog_manage.uninstall("renamed")
+    assert not file.exists("~/.tarstall/fish_functions/test.sh.fish")
+
+
 def test_list_programs(capsys):
     assert prog_manage.list_programs() == ["package"]
 
@@ -64,3 +138,140 @@ def test_install_archive(monkeypatch):
     assert os.path.isfile(os.path.expanduser("~/.tarstall/bin/package/test.sh"))
 
 
+def test_install_archive_overwrite():
+    os.chdir(os.path.realpath(__file__)[:-19])
+    with open(file.full("~/.tarstall/bin/package/stale.txt"), "w") as f:
+        f.write("From an older version")
+    assert prog_manage.install("./fake_packages/package.tar.gz", overwrite=True) == ("Installed", "package")
+    assert os.path.isfile(file.full("~/.tarstall/bin/package/test.sh"))
+    assert not file.exists("~/.tarstall/bin/package/stale.txt")
+    assert os.listdir(config.work_dir()) == []
+
+
+def test_versioned_install():
+    os.chdir(os.path.realpath(__file__)[:-19])
+    config.change_config("VersionedInstalls", "change", True)
+    for _ in range(3):
+        assert prog_manage.install("./fake_packages/package.tar.gz", overwrite=True) == ("Installed", "package")
+    assert os.readlink(file.full("~/.tarstall/bin/package")) == file.full("~/.tarstall/versions/package/3")
+    assert sorted(os.listdir(file.full("~/.tarstall/versions/package"))) == ["2", "3"]
+    assert os.path.isfile(file.full("~/.tarstall/bin/package/test.sh"))
+    prog_manage.rename("package", "renamed")
+    assert os.readlink(file.full("~/.tarstall/bin/renamed")) == file.full("~/.tarstall/versions/renamed/3")
+    assert os.path.isfile(file.full("~/.tarstall/bin/renamed/test.sh"))
+    prog_manage.uninstall("renamed")
+    assert not os.path.lexists(file.full("~/.tarstall/bin/renamed"))
+    assert not file.exists("~/.tarstall/versions/renamed")
+
+
+def test_install_batch():
+    os.chdir(os.path.realpath(__file__)[:-19])
+    os.makedirs("/tmp/tarstall-batch/dirprog", exist_ok=True)
+    with open("/tmp/tarstall-batch/dirprog/run.sh", "w") as f:
+        f.write("echo hi\n")
+    with open("/tmp/tarstall-batch/single.sh", "w") as f:
+        f.write("echo hi\n")
+    with open("/tmp/tarstall-batch/list.txt", "w") as f:
+        f.write("# Tools\n./fake_packages/package.tar.gz other\n\n/tmp/tarstall-batch/single.sh\n")
+    programs = prog_manage.read_batch_file("/tmp/tarstall-batch/list.txt")
+    assert programs == [("./fake_packages/package.tar.gz", "other"), ("/tmp/tarstall-batch/single.sh", None)]
+    programs += [("/tmp/tarstall-batch/dirprog", None), ("./fake_packages/package.tar.gz", None),
+                 ("/tmp/tarstall-batch/missing.tar.gz", None)]
+    results = prog_manage.install_batch(programs, show_progress=False)
+    assert [r[1] for r in results] == ["Installed", "Installed", "Installed", "Application exists", "Bad file"]
+    assert os.path.isfile(file.full("~/.tarstall/bin/other/test.sh"))
+    assert os.access(file.full("~/.tarstall/bin/single/single"), os.X_OK)
+    assert os.path.isfile(file.full("~/.tarstall/bin/dirprog/run.sh"))
+    assert config.db["programs"]["single"]["install_type"] == "single"
+    assert sorted(prog_manage.list_programs()) == ["dirprog", "other", "package", "single"]
+    assert os.listdir(config.work_dir()) == []
+    os.remove("/tmp/tarstall-batch/list.txt")
+    os.rmdir("/tmp/tarstall-batch")
+
+
+def test_install_batch_unexpected_error(monkeypatch):
+    os.chdir(os.path.realpath(__file__)[:-19])
+
+    def broken_build(job, threads):
+        raise NotImplementedError("That compression method is not supported")
+
+    monkeypatch.setattr(prog_manage, "_batch_build", broken_build)
+    results = prog_manage.install_batch([("./fake_packages/package.tar.gz", "broken")], show_progress=False)
+    assert results[0][1] == "Error"
+    assert "broken" not in config.db["programs"]
+
+
+def test_install_url(http_server):
+    path = os.path.join(os.path.realpath(__file__)[:-19], "fake_packages/package.tar.gz")
+    with open(path, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    assert prog_manage._download_install(http_server + "package.tar.gz", "urlpkg", ".tar.gz") == ("Installed", sha256)
+    assert os.path.isfile(file.full("~/.tarstall/bin/urlpkg/test.sh"))
+    assert prog_manage.install(http_server + "package.tar.gz", override_name="streamed") == ("Installed", "streamed")
+    assert config.db["programs"]["streamed"]["update_url"] == http_server + "package.tar.gz"
+    validators = config.db["programs"]["streamed"]["update_validators"]
+    assert validators["length"] == os.path.getsize(path) and validators["last_modified"] is not None
+    assert prog_manage.update_program("streamed") == "No update"
+    prog_manage.set_update_validators("streamed", None)
+    assert prog_manage.update_program("streamed") == "Success"
+    assert config.db["programs"]["streamed"]["update_validators"] == validators
+    assert prog_manage.install(http_server + "missing.tar.gz", override_name="missing") == ("Download error", "missing")
+    assert "missing" not in config.db["programs"]
+    assert os.listdir(config.work_dir()) == []
+
+
+def test_install_url_sha256(tmp_http_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "extract_stream", None)  # Archives with a known hash are checked before extracting
+    path = os.path.join(os.path.realpath(__file__)[:-19], "fake_packages/package.tar.gz")
+    shutil.copy(path, tmp_path / "package.tar.gz")
+    with open(path, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    url = tmp_http_server + "package.tar.gz"
+    assert prog_manage.install(url, override_name="badsum", sha256="0" * 64) == ("Bad checksum", "badsum")
+    assert "badsum" not in config.db["programs"]
+    assert prog_manage.install(url, override_name="badsum", sha256="nothex") == ("Bad sha256", "badsum")
+    assert prog_manage.install(url, override_name="pinned", sha256=sha256.upper()) == ("Installed", "pinned")
+    assert config.db["programs"]["pinned"]["sha256"] == sha256
+    assert prog_manage.update_program("pinned") == "No update"
+
+    (tmp_path / "package.tar.gz.sha256").write_text("{}  other.tar.gz\n{}  package.tar.gz\n".format("1" * 64, sha256))
+    assert prog_manage.install(url, override_name="sidecar", sha256=url + ".sha256") == ("Installed", "sidecar")
+    assert config.db["programs"]["sidecar"]["sha256_url"] == url + ".sha256"
+    assert prog_manage.update_program("sidecar") == "No update"
+    (tmp_path / "package.tar.gz.sha256").write_text("2" * 64 + "\n")
+    prog_manage.set_update_validators("sidecar", None)
+    assert prog_manage.update_program("sidecar") == "Bad checksum"
+    assert config.db["programs"]["sidecar"]["sha256"] == sha256
+    assert os.path.isfile(file.full("~/.tarstall/bin/sidecar/test.sh"))
+
+
+def test_work_dir():
+    os.chdir(os.path.realpath(__file__)[:-19])
+    assert config.work_dir() == file.full("~/.tarstall/.work")
+    if not os.path.isdir("/dev/shm"):
+        pytest.skip("Needs /dev/shm to test a work directory on another filesystem")
+    config.change_config("WorkDir", "change", "/dev/shm/tarstall-test-work")
+    assert config.work_dir() == "/dev/shm/tarstall-test-work"
+    assert prog_manage.install("./fake_packages/package.tar.gz", overwrite=True) == ("Installed", "package")
+    assert os.path.isfile(file.full("~/.tarstall/bin/package/test.sh"))
+    assert not os.path.lexists(file.full("~/.tarstall/bin/package.tarstall-incoming"))
+    os.rmdir("/dev/shm/tarstall-test-work")
+
+
+def test_program_locked(monkeypatch):
+    os.chdir(os.path.realpath(__file__)[:-19])
+    monkeypatch.setattr(file, "LOCK_TIMEOUT", 0.2)
+    proc = subprocess.Popen([sys.executable, "-c", "import fcntl, sys, time\n"
+                             "f = open(sys.argv[1], 'a')\nfcntl.flock(f, fcntl.LOCK_EX)\nprint('held', flush=True)\ntime.sleep(30)",
+                             os.path.join(file.LOCKS_PATH, "program-package.lock")], stdout=subprocess.PIPE, text=True)
+    try:
+        assert proc.stdout.readline() == "held\n"
+        assert prog_manage.uninstall("package") == "Locked"
+        assert prog_manage.rename("package", "renamed") == "Locked"
+        assert prog_manage.install("./fake_packages/package.tar.gz", overwrite=True) == ("Locked", "package")
+        shutil.copytree("./fake_packages/folder_package", "/tmp/tarstall-test-other")
+        assert prog_manage.install("/tmp/tarstall-test-other") == ("Installed", "tarstall-test-other")  # Others aren't blocked
+    finally:
+        proc.kill()
+        proc.wait()
+    assert prog_manage.uninstall("package") == "Success"
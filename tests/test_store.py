@@ -0,0 +1,66 @@
+import os
+import threading
+
+import pytest
+
+import config
+import file
+import prog_manage
+import store
+
+
+def test_add_program():
+    config.change_config("UseStore", "change", True)
+    store.add_program("package")
+    prog_manage.install("./tests/fake_packages/package.tar.gz", override_name="package2")
+    first = os.stat(file.full("~/.tarstall/bin/package/test.sh"))
+    second = os.stat(file.full("~/.tarstall/bin/package2/test.sh"))
+    assert first.st_ino == second.st_ino
+    assert first.st_nlink == 3  # Both programs and the store's object
+    assert os.access(file.full("~/.tarstall/bin/package2/test.sh"), os.X_OK)
+
+
+def test_add_program_unchanged(monkeypatch):
+    config.change_config("UseStore", "change", True)
+    store.add_program("package")
+    hashed = []
+    hash_file = file.hash_file
+    monkeypatch.setattr(file, "hash_file", lambda path: hashed.append(path) or hash_file(path))
+    assert store.add_program("package")["files"] > 0
+    assert hashed == []  # Every file still matches the manifest
+
+
+def test_gc():
+    config.change_config("UseStore", "change", True)
+    store.add_program("package")
+    assert store.gc() == (0, 0)
+    prog_manage.uninstall("package")
+    removed, freed = store.gc()
+    assert removed == 1
+    assert freed > 0
+
+
+def test_gc_locked(monkeypatch):
+    config.change_config("UseStore", "change", True)
+    store.add_program("package")
+    prog_manage.uninstall("package")
+    holding = threading.Event()
+    done = threading.Event()
+
+    def hold():
+        file.lock(shared=True)
+        holding.set()
+        done.wait()
+        file.unlock()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait()
+    monkeypatch.setattr(file, "LOCK_TIMEOUT", 0.1)
+    try:
+        with pytest.raises(TimeoutError):
+            store.gc()
+    finally:
+        done.set()
+        thread.join()
+    assert store.gc()[0] == 1  # The unused object survived until nothing else held the lock
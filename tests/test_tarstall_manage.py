@@ -2,6 +2,9 @@ import os
 
 import config
 import file
+import journal
+import prog_manage
+import sqlite_db
 import tarstall_manage
 
 
@@ -18,10 +21,71 @@ def test_verbose_toggle():
 
 
 def test_repair_db():
-    tarstall_manage.repair_db()
+    prog_manage.pathify("package")
+    prog_manage.add_upgrade_url("package", "https://example.com/package.tar.gz")
+    os.remove(file.full("~/.tarstall/database"))
+    assert tarstall_manage.repair_db() == "Journal"
+    assert config.db["programs"]["package"]["install_type"] == "default"
+    assert config.db["programs"]["package"]["has_path"] is True
+    assert config.db["programs"]["package"]["update_url"] == "https://example.com/package.tar.gz"
+
+
+def test_repair_db_checkpoint_during_transaction():
+    for _ in range(3):
+        config.change_config("AutoInstall", "flip")
+    with config.transaction():
+        prog_manage.pathify("package")
+        journal.checkpoint(file.get_db())  # Another tarstall checkpoints before this transaction commits
+    config.change_config("AutoInstall", "flip")
+    os.remove(file.full("~/.tarstall/database"))
+    assert tarstall_manage.repair_db() == "Journal"
+    assert config.db["programs"]["package"]["has_path"] is True
+    assert config.db["options"]["AutoInstall"] is False
+
+
+def test_repair_db_rescan():
+    os.remove(file.full(journal.CHECKPOINT_PATH))
+    assert tarstall_manage.repair_db() == "Rescan"
     assert config.db["programs"]["package"]["install_type"] == "single"  # Since the archive only contains one file, it gets re-detected as single-file
 
 
+def test_convert_db_to_sqlite():
+    assert tarstall_manage.convert_db_to_sqlite() == "Converted"
+    assert sqlite_db.enabled()
+    assert config.db["programs"]["package"]["install_type"] == "default"
+    prog_manage.pathify("package")
+    assert file.get_db()["programs"]["package"]["has_path"] is True
+    assert prog_manage.list_programs() == ["package"]
+    assert tarstall_manage.convert_db_to_sqlite() == "Already converted"
+
+
+def test_run_migrations():
+    config.db["version"]["file_version"] = 18
+    del config.db["programs"]["package"]["binlink_files"]
+    reports = tarstall_manage.run_migrations(dry_run=True)
+    assert [r["version"] for r in reports] == [18, 19, 20, 21, 22]
+    assert reports[0]["touches_files"] is True
+    assert reports[1]["programs"] == 1
+    assert reports[2]["programs"] == 1
+    assert "update_archive_type" not in config.db["programs"]["package"]
+    assert tarstall_manage.get_file_version("file") == 18
+
+    tarstall_manage.run_migrations()
+    assert config.db["programs"]["package"]["update_archive_type"] is None
+    assert config.db["programs"]["package"]["binlink_files"] == {}
+    assert file.get_db()["version"]["file_version"] == config.file_version
+
+
+def test_regen_shell():
+    prog_manage.pathify("package")
+    with open(file.full("~/.tarstall/.bashrc"), "a") as f:
+        f.write("export PATH=$PATH:~/.tarstall/bin/gone # gone\n")
+    assert tarstall_manage.regen_shell() == "Regenerated"
+    assert file.check_line("export PATH=$PATH:~/.tarstall/bin/package # package", "~/.tarstall/.bashrc", "fuzzy")
+    assert file.check_line("gone", "~/.tarstall/.bashrc", "fuzzy") is False
+    assert tarstall_manage.regen_shell() == "Up to date"
+
+
 def test_create_db():
     tarstall_manage.create_db()
     #TODO: Fake os so we can test get_shell_file in any environment